@@ -0,0 +1,220 @@
+"""
+Benchmark: building and encoding grading responses, before vs after the
+NumPy payload builders + orjson response path.
+
+"before" = the previous per-group pandas summaries, DataFrame.to_dict and
+FastAPI's jsonable_encoder + json.dumps (what JSONResponse did).
+"after"  = vectorized summaries, fast_json.records and fast_json.dumps.
+
+Run from the repository root:
+    python -m backend.benchmarks.bench_serialization --rows 10000 100000
+"""
+import argparse
+import gzip
+import json
+import time
+
+import pandas as pd
+from fastapi.encoders import jsonable_encoder
+
+from backend import fast_json, grading_utils
+from backend.benchmarks import synthetic
+from backend.grading_utils import num_to_cn
+
+
+# --- Previous implementations, kept here as the baseline ---
+
+def legacy_generate_summary(df):
+    """Generate summary dataframe for visualization (Keep existing for UI charts)."""
+    total_cust = len(df)
+    summary_rows = []
+    
+    for g in range(30, 0, -1):
+        g_cn = num_to_cn(g)
+        subset = df[df['新档位_Num'] == g]
+        count = len(subset)
+        pct = count / total_cust if total_cust > 0 else 0
+        
+        up = (subset['原档位_Num'] < g).sum()
+        down = (subset['原档位_Num'] > g).sum()
+        
+        min_score = subset['总分'].min() if count > 0 else 0
+        max_score = subset['总分'].max() if count > 0 else 0
+        
+        # Calculate Old Counts for this grade number
+        pre_count = len(df[df['原档位_Num'] == g])
+        
+        # Calculate Rates (as percentage of the new grade count)
+        # Avoid division by zero
+        up_rate = up / count if count > 0 else 0
+        down_rate = down / count if count > 0 else 0
+        
+        summary_rows.append({
+            'Grade': g,
+            'GradeName': g_cn,
+            'Count': int(count),
+            'PreCount': int(pre_count),
+            'Percentage': pct,
+            'Upgrades': int(up),
+            'Downgrades': int(down),
+            'UpgradeRate': float(up_rate),
+            'DowngradeRate': float(down_rate),
+            'MinScore': float(min_score),
+            'MaxScore': float(max_score)
+        })
+        
+    return pd.DataFrame(summary_rows)
+
+def legacy_generate_district_summary(df):
+    """
+    Generate summary statistics grouped by District.
+    Returns a list of dicts.
+    """
+    if '所属区县' not in df.columns:
+        return []
+        
+    districts = df['所属区县'].unique()
+    stats = []
+    
+    for district in districts:
+        subset = df[df['所属区县'] == district]
+        total = len(subset)
+        if total == 0: continue
+        
+        # Upgrades: New > Old
+        up = (subset['新档位_Num'] > subset['原档位_Num']).sum()
+        # Downgrades: New < Old
+        down = (subset['新档位_Num'] < subset['原档位_Num']).sum()
+        
+        stats.append({
+            'District': str(district),
+            'Total': int(total),
+            'Upgrades': int(up),
+            'Downgrades': int(down),
+            'UpgradeRate': float(up / total),
+            'DowngradeRate': float(down / total)
+        })
+    
+    # Sort by District name
+    stats.sort(key=lambda x: x['District'])
+    return stats
+
+def legacy_generate_district_grade_detail(df):
+    """
+    Generate detailed stats: District -> Grade -> {Up, Down, Count}
+    """
+    if '所属区县' not in df.columns:
+        return {}
+        
+    districts = df['所属区县'].unique()
+    detail = {}
+    
+    for district in districts:
+        district_data = []
+        d_subset = df[df['所属区县'] == district]
+        
+        # Iterate grades 1-30
+        for g in range(1, 31):
+            g_subset = d_subset[d_subset['新档位_Num'] == g]
+            count = len(g_subset)
+            
+            up = (g_subset['原档位_Num'] < g).sum()
+            down = (g_subset['原档位_Num'] > g).sum()
+            
+            district_data.append({
+                'Grade': g,
+                'Count': int(count),
+                'Upgrades': int(up),
+                'Downgrades': int(down)
+            })
+            
+        # Sort by Grade
+        district_data.sort(key=lambda x: x['Grade'])
+        detail[str(district)] = district_data
+        
+    return detail
+
+
+def build_before(df):
+    summary_df = legacy_generate_summary(df)
+    return {
+        "summary": summary_df.to_dict(orient="records"),
+        "district_stats": legacy_generate_district_summary(df),
+        "district_detail": legacy_generate_district_grade_detail(df),
+        "top50": df.head(50).fillna("").to_dict(orient="records"),
+    }
+
+
+def encode_before(payload):
+    # Starlette JSONResponse.render after FastAPI's jsonable_encoder
+    return json.dumps(jsonable_encoder(payload), ensure_ascii=False, allow_nan=False,
+                      indent=None, separators=(",", ":")).encode("utf-8")
+
+
+def build_after(df):
+    return {
+        "summary": fast_json.records(grading_utils.generate_summary(df)),
+        "district_stats": grading_utils.generate_district_summary(df),
+        "district_detail": grading_utils.generate_district_grade_detail(df),
+        "top50": fast_json.records(df.head(50), fill=""),
+    }
+
+
+def best_of(fn, repeat):
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - t0)
+    return best, result
+
+
+def run(rows, repeat):
+    results = []
+    for n in rows:
+        df = synthetic.make_graded(n)
+        t_build_b, payload_b = best_of(lambda: build_before(df), repeat)
+        t_enc_b, body_b = best_of(lambda: encode_before(payload_b), repeat)
+        t_build_a, payload_a = best_of(lambda: build_after(df), repeat)
+        t_enc_a, body_a = best_of(lambda: fast_json.dumps(payload_a), repeat)
+        t_gzip, gz = best_of(lambda: gzip.compress(body_a, fast_json.GZIP_LEVEL), repeat)
+
+        # Same response content either way
+        assert json.loads(body_a) == json.loads(body_b), "payload mismatch"
+
+        results.append({
+            "rows": n,
+            "before_build_ms": t_build_b * 1000,
+            "before_encode_ms": t_enc_b * 1000,
+            "after_build_ms": t_build_a * 1000,
+            "after_encode_ms": t_enc_a * 1000,
+            "gzip_ms": t_gzip * 1000,
+            "bytes": len(body_a),
+            "gzip_bytes": len(gz),
+            "encoder": "orjson" if fast_json.orjson is not None else "json",
+        })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    results = run(args.rows, args.repeat)
+    for r in results:
+        before = r["before_build_ms"] + r["before_encode_ms"]
+        after = r["after_build_ms"] + r["after_encode_ms"]
+        print(f"{r['rows']:>9} rows | before build {r['before_build_ms']:8.2f} ms  encode {r['before_encode_ms']:6.2f} ms"
+              f" | after build {r['after_build_ms']:7.2f} ms  encode {r['after_encode_ms']:5.2f} ms ({r['encoder']})"
+              f" | x{before / after:5.1f} | {r['bytes']} B, gzip {r['gzip_bytes']} B in {r['gzip_ms']:.2f} ms")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
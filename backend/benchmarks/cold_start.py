@@ -0,0 +1,92 @@
+"""
+Cold-start benchmark for backend.main:app.
+
+Every sample runs in a fresh interpreter (like a uvicorn worker after a
+deploy) and measures:
+  - import:        `import backend.main`
+  - warm_up:       the startup hook (lifespan), 0 with GRADING_WARMUP=0
+  - first_request: first GET /api/results on a prepared result
+  - first_cockpit_engine: first get_cockpit_engine() call after startup
+Samples are taken with and without the warm-up so the difference shows
+what the hook moves out of the first requests.
+
+Run from the repository root:
+    python -m backend.benchmarks.cold_start --samples 5 --rows 10000
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+from backend.benchmarks import synthetic
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+CHILD = r"""
+import json, time
+t0 = time.perf_counter()
+import backend.main as main
+t1 = time.perf_counter()
+from fastapi.testclient import TestClient
+with TestClient(main.app) as client:       # runs the lifespan (warm-up)
+    t2 = time.perf_counter()
+    r = client.get('/api/results', params={'limit': 50})
+    t3 = time.perf_counter()
+    assert r.status_code == 200, r.text
+    try:
+        main.get_cockpit_engine()
+    except Exception:
+        pass
+    t4 = time.perf_counter()
+print(json.dumps({'import': t1 - t0, 'warm_up': t2 - t1, 'first_request': t3 - t2,
+                  'first_cockpit_engine': t4 - t3}))
+"""
+
+
+def _prepare(data_dir, rows):
+    """Write a graded result for the first request to read."""
+    graded = synthetic.make_graded(rows)
+    graded.to_excel(os.path.join(data_dir, 'result_data.xlsx'), index=False)
+
+
+def _sample(data_dir, warm_up):
+    env = dict(os.environ, GRADING_DATA_DIR=data_dir, GRADING_WARMUP='1' if warm_up else '0')
+    out = subprocess.run([sys.executable, '-c', CHILD], cwd=REPO_ROOT, env=env,
+                         capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def run(samples=5, rows=10_000):
+    with tempfile.TemporaryDirectory(prefix='grading-cold-') as data_dir:
+        _prepare(data_dir, rows)
+        report = {}
+        for warm_up in (False, True):
+            runs = [_sample(data_dir, warm_up) for _ in range(samples)]
+            report['warm_up' if warm_up else 'no_warm_up'] = {
+                key: statistics.median(r[key] for r in runs) for key in runs[0]
+            }
+        return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold-start benchmark for backend.main:app")
+    parser.add_argument('--samples', type=int, default=5)
+    parser.add_argument('--rows', type=int, default=10_000, help="rows of the prepared result")
+    parser.add_argument('--out', help="write JSON results to this file")
+    args = parser.parse_args()
+
+    report = run(args.samples, args.rows)
+    for mode, r in report.items():
+        total = sum(r.values())
+        print(f"{mode:<11} " + "  ".join(f"{k} {v * 1000:8.1f} ms" for k, v in r.items())
+              + f"  | total {total * 1000:8.1f} ms")
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
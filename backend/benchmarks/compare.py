@@ -0,0 +1,59 @@
+"""
+Compare two benchmark result files written by benchmarks/run.py.
+
+    python -m backend.benchmarks.compare base.json new.json --threshold 0.10
+
+Prints the median time ratio (new / base) per case and size, and flags
+cases slower than base by more than the threshold. Exits with status 1
+on any regression when --fail is given (for CI).
+"""
+import argparse
+import json
+
+
+def _index(report):
+    return {(r['name'], r['rows']): r for r in report['results'] if 'skipped' not in r}
+
+
+def compare(base, new, threshold=0.10):
+    """List of (name, rows, base_s, new_s, ratio, regressed) for cases present in both."""
+    base_idx = _index(base)
+    rows = []
+    for key, r in _index(new).items():
+        b = base_idx.get(key)
+        if b is None:
+            continue
+        ratio = r['median_s'] / b['median_s'] if b['median_s'] > 0 else float('inf')
+        rows.append((key[0], key[1], b['median_s'], r['median_s'], ratio, ratio > 1 + threshold))
+    rows.sort(key=lambda x: (x[1], x[0]))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two benchmark runs")
+    parser.add_argument('base')
+    parser.add_argument('new')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help="relative slowdown counted as a regression (default 0.10)")
+    parser.add_argument('--fail', action='store_true', help="exit 1 if anything regressed")
+    args = parser.parse_args()
+
+    with open(args.base, encoding='utf-8') as f:
+        base = json.load(f)
+    with open(args.new, encoding='utf-8') as f:
+        new = json.load(f)
+
+    print(f"base {base['meta'].get('commit')}  ->  new {new['meta'].get('commit')}")
+    rows = compare(base, new, args.threshold)
+    for name, n, b, r, ratio, regressed in rows:
+        flag = '  REGRESSION' if regressed else ''
+        print(f"{n:>9} rows  {name:<42} {b * 1000:10.2f} ms -> {r * 1000:10.2f} ms  x{ratio:5.2f}{flag}")
+
+    regressions = [x for x in rows if x[5]]
+    print(f"{len(rows)} cases compared, {len(regressions)} regressions")
+    if args.fail and regressions:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,400 @@
+"""
+Load test for backend.main:app: several users hitting the API at once.
+
+Starts uvicorn (--workers N) on a free port with its working files in a
+temporary directory and the cockpit upload pointed at a local SQLite file
+(GRADING_COCKPIT_DB_URL), or targets a running server with --url. After
+an untimed setup (upload + a manual grading), every simulated user picks
+actions by weight until --duration is over:
+
+  preview     a burst of /api/preview-manual-grade (dragging a threshold),
+              sometimes saved with /api/manual-grade
+  browse      /api/results pages with sorting / district filters
+  diff        /api/result-diff of the current result
+  download    /api/download (xlsx)
+  export      /api/export/detail (CSV stream)
+  cockpit     /api/cockpit-upload of the downloaded workbook
+  auto_grade  /api/auto-grade (warm start)
+  upload      /api/upload of the same data (invalidates caches, result goes stale)
+
+and reports throughput, errors (timeouts included) and latency
+percentiles per endpoint.
+
+A server given with --url is only read from unless --allow-writes is
+passed: no setup (it must already have data and a result), no cockpit
+upload, upload or auto-grading, and previews are never saved.
+
+Run from the repository root:
+    python -m backend.benchmarks.load_test --users 8 --duration 60 --rows 20000 --workers 2
+    python -m backend.benchmarks.load_test --mix preview=1 --users 16 --max-p95 preview-manual-grade=2000
+    python -m backend.benchmarks.load_test --url http://127.0.0.1:8000
+    python -m backend.benchmarks.load_test --url http://staging:8000 --allow-writes --mix cockpit=0
+"""
+import argparse
+import datetime
+import io
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import httpx
+import numpy as np
+
+from backend.benchmarks import synthetic
+from backend.benchmarks.run import _git_commit
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Action -> relative weight (override with --mix name=weight)
+MIX = {
+    'preview': 10,
+    'browse': 6,
+    'diff': 1,
+    'download': 2,
+    'export': 2,
+    'cockpit': 1,
+    'auto_grade': 1,
+    'upload': 0.5,
+}
+# Actions that change the server's data (or the cockpit database)
+WRITE_ACTIONS = ('cockpit', 'auto_grade', 'upload')
+PERCENTILES = (50, 90, 95, 99)
+
+# Columns cockpit_upload writes (see col_map_detail / final_cols_summary in main.py)
+COCKPIT_TABLES = {
+    'grading_data': [
+        'license_no', 'original_level', 'new_level', 'level_code',
+        'purchase_amount_val', 'purchase_amount_rank', 'purchase_amount_score',
+        'credit_rating_val', 'credit_rating_score', 'counter_display_score',
+        'placement_rule_score', 'damage_crease_score', 'theme_display_score',
+        'pricing_tag_score', 'transaction_data_val', 'transaction_data_score',
+        'consumption_env_score', 'marketing_route', 'total_score',
+        'total_score_rank', 'district', 'date_str',
+    ],
+    'grading_line': ['new_level', 'score', 'date_str', 'remark', 'remark1'],
+}
+
+
+def create_cockpit_db(path):
+    """SQLite stand-in for the cockpit MySQL database; returns its URL."""
+    from sqlalchemy import Column, MetaData, Table, Text, create_engine
+
+    url = f"sqlite:///{path}?timeout=30"
+    metadata = MetaData()
+    for name, columns in COCKPIT_TABLES.items():
+        Table(name, metadata, *[Column(c, Text) for c in columns])
+    engine = create_engine(url)
+    metadata.create_all(engine)
+    engine.dispose()
+    return url
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(data_dir, cockpit_url, workers):
+    """uvicorn subprocess serving backend.main:app; returns (process, base url)."""
+    port = _free_port()
+    env = dict(os.environ, GRADING_DATA_DIR=data_dir, GRADING_COCKPIT_DB_URL=cockpit_url)
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'backend.main:app', '--host', '127.0.0.1',
+         '--port', str(port), '--workers', str(workers), '--log-level', 'warning'],
+        cwd=REPO_ROOT, env=env)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"uvicorn exited with {proc.returncode}")
+        try:
+            if httpx.get(f"{url}/api/cache-stats", timeout=1).status_code == 200:
+                return proc, url
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError("uvicorn did not start within 60 s")
+
+
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = []   # (endpoint, latency s, ok, status)
+
+    def call(self, client, endpoint, method, url, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            r = client.request(method, url, **kwargs)
+            status = r.status_code
+        except httpx.TimeoutException:
+            r, status = None, 'timeout'
+        except httpx.HTTPError as e:
+            r, status = None, type(e).__name__
+        latency = time.perf_counter() - t0
+        with self._lock:
+            self.samples.append((endpoint, latency, status == 200, status))
+        return r if status == 200 else None
+
+
+class Workload:
+    """Inputs shared by all users: the data workbook, thresholds, a result workbook."""
+
+    def __init__(self, rows, seed):
+        graded = synthetic.make_graded(rows, seed)
+        self.thresholds = synthetic.default_thresholds(graded)
+        buf = io.BytesIO()
+        synthetic.make_customers(rows, seed).to_excel(buf, index=False)
+        self.data_xlsx = buf.getvalue()
+        self.districts = list(synthetic.DISTRICTS)
+        self.result_xlsx = None
+        self.saves = True   # previews are sometimes saved with /api/manual-grade
+
+    def setup(self, client):
+        """Untimed: upload the data and save a manual grading (+ keep its workbook)."""
+        for method, url, kwargs in (
+            ('POST', '/api/upload', {'files': {'file': ('data.xlsx', self.data_xlsx)}}),
+            ('POST', '/api/manual-grade', {'json': {'thresholds': self.thresholds}}),
+            ('GET', '/api/download', {}),
+        ):
+            r = client.request(method, url, **kwargs)
+            if r.status_code != 200:
+                raise RuntimeError(f"setup {method} {url} -> {r.status_code}: {r.text[:200]}")
+        self.result_xlsx = r.content
+
+    def jittered(self, rng):
+        """Thresholds with one grade line moved, as while dragging a slider."""
+        thresholds = dict(self.thresholds)
+        grade = rng.choice(list(thresholds))
+        thresholds[grade] += rng.uniform(-0.5, 0.5)
+        return thresholds
+
+
+# --- actions: (user, rng, client, rec, workload) ---
+
+def preview(user, rng, client, rec, w):
+    for _ in range(rng.randint(5, 15)):
+        rec.call(client, 'preview-manual-grade', 'POST', '/api/preview-manual-grade',
+                 json={'thresholds': w.jittered(rng)})
+    if w.saves and rng.random() < 0.3:
+        rec.call(client, 'manual-grade', 'POST', '/api/manual-grade',
+                 json={'thresholds': w.jittered(rng)})
+
+
+def browse(user, rng, client, rec, w):
+    params = {'sort': rng.choice(['总分', '新档位_Num', '许可证号']),
+              'order': rng.choice(['asc', 'desc']), 'limit': 100}
+    if rng.random() < 0.5:
+        params['district'] = rng.choice(w.districts)
+    for _ in range(rng.randint(1, 3)):
+        r = rec.call(client, 'results', 'GET', '/api/results', params=params)
+        if r is None or not r.json().get('next_cursor'):
+            break
+        params['cursor'] = r.json()['next_cursor']
+
+
+def diff(user, rng, client, rec, w):
+    # 400 until a second result version exists: not an error of the server
+    r = client.get('/api/result-versions')
+    if r.status_code == 200 and len(r.json()['versions']) > 1:
+        rec.call(client, 'result-diff', 'GET', '/api/result-diff', params={'limit': 100})
+
+
+def download(user, rng, client, rec, w):
+    rec.call(client, 'download', 'GET', '/api/download')
+
+
+def export(user, rng, client, rec, w):
+    rec.call(client, 'export/detail', 'GET', '/api/export/detail', params={'format': 'csv'})
+
+
+def cockpit(user, rng, client, rec, w):
+    rec.call(client, 'cockpit-upload', 'POST', '/api/cockpit-upload',
+             files={'file': ('result.xlsx', w.result_xlsx)}, data={'date': f'loadtest-{user}'})
+
+
+def auto_grade(user, rng, client, rec, w):
+    rec.call(client, 'auto-grade', 'POST', '/api/auto-grade', json={'warm_start': True})
+
+
+def upload(user, rng, client, rec, w):
+    rec.call(client, 'upload', 'POST', '/api/upload', files={'file': ('data.xlsx', w.data_xlsx)})
+
+
+ACTIONS = {f.__name__: f for f in (preview, browse, diff, download, export, cockpit, auto_grade, upload)}
+
+
+def _user(user, url, mix, deadline, think, timeout, seed, rec, workload):
+    rng = random.Random(seed * 1000 + user)
+    names = [n for n in mix if mix[n] > 0]
+    weights = [mix[n] for n in names]
+    with httpx.Client(base_url=url, timeout=timeout) as client:
+        while time.monotonic() < deadline:
+            ACTIONS[rng.choices(names, weights)[0]](user, rng, client, rec, workload)
+            if think:
+                time.sleep(rng.uniform(0, think))
+
+
+def summarize(samples, elapsed):
+    """Per-endpoint count, errors, throughput and latency percentiles (ms)."""
+    by_endpoint = {}
+    for endpoint, latency, ok, status in samples:
+        by_endpoint.setdefault(endpoint, []).append((latency, ok, status))
+    report = {}
+    for endpoint, rows in sorted(by_endpoint.items()):
+        latency = np.array([r[0] for r in rows]) * 1000
+        errors = {}
+        for _, ok, status in rows:
+            if not ok:
+                errors[str(status)] = errors.get(str(status), 0) + 1
+        entry = {
+            'count': len(rows),
+            'errors': sum(errors.values()),
+            'error_status': errors,
+            'rps': len(rows) / elapsed,
+            'mean_ms': float(latency.mean()),
+            'max_ms': float(latency.max()),
+        }
+        for p, value in zip(PERCENTILES, np.percentile(latency, PERCENTILES)):
+            entry[f'p{p}_ms'] = float(value)
+        report[endpoint] = entry
+    return report
+
+
+def format_report(report):
+    head = f"{'endpoint':<24}{'count':>7}{'err':>6}{'req/s':>8}" + ''.join(
+        f"{f'p{p}':>9}" for p in PERCENTILES) + f"{'max':>9}  (ms)"
+    lines = [head]
+    for endpoint, e in report.items():
+        lines.append(f"{endpoint:<24}{e['count']:>7}{e['errors']:>6}{e['rps']:>8.2f}" + ''.join(
+            f"{e[f'p{p}_ms']:>9.0f}" for p in PERCENTILES) + f"{e['max_ms']:>9.0f}")
+    return '\n'.join(lines)
+
+
+def action_mix(mix=None, writes=True):
+    """MIX with the `mix` overrides; write actions get weight 0 unless `writes`."""
+    mix = dict(MIX, **(mix or {}))
+    if not writes:
+        mix.update({name: 0 for name in WRITE_ACTIONS})
+    if not any(weight > 0 for weight in mix.values()):
+        raise ValueError(f"no action has a positive weight{'' if writes else ' (read-only: writes are 0)'}: {mix}")
+    return mix
+
+
+def run(users=8, duration=60, rows=20_000, workers=1, url=None, mix=None, think=0.5,
+        timeout=60, seed=0, allow_writes=False, log=print):
+    """
+    `url`: test that server instead of starting one; it is only read from
+    unless `allow_writes`.
+    """
+    writes = url is None or allow_writes
+    mix = action_mix(mix, writes)
+    workload = Workload(rows, seed)
+    if not writes:
+        workload.saves = False
+    with tempfile.TemporaryDirectory(prefix='grading-load-') as tmp:
+        proc = None
+        if url is None:
+            cockpit_url = create_cockpit_db(os.path.join(tmp, 'cockpit.db'))
+            data_dir = os.path.join(tmp, 'data')
+            os.makedirs(data_dir)
+            proc, url = start_server(data_dir, cockpit_url, workers)
+        try:
+            if writes:
+                with httpx.Client(base_url=url, timeout=max(timeout, 600)) as client:
+                    workload.setup(client)
+            log(f"{users} users, {duration} s against {url} ({rows} rows, mix {mix}"
+                f"{'' if writes else ', read-only'})")
+
+            rec = Recorder()
+            start = time.monotonic()
+            threads = [threading.Thread(target=_user, args=(
+                u, url, mix, start + duration, think, timeout, seed, rec, workload))
+                for u in range(users)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            elapsed = time.monotonic() - start
+        finally:
+            if proc is not None:
+                proc.terminate()
+                proc.wait(timeout=30)
+
+    report = summarize(rec.samples, elapsed)
+    return {
+        'meta': {
+            'commit': _git_commit(),
+            'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+            'users': users, 'duration_s': elapsed, 'rows': rows, 'workers': workers,
+            'mix': mix, 'think_s': think, 'timeout_s': timeout, 'seed': seed, 'writes': writes,
+            'total_rps': len(rec.samples) / elapsed,
+        },
+        'endpoints': report,
+    }
+
+
+def _pairs(values, cast):
+    out = {}
+    for item in values or []:
+        name, _, value = item.partition('=')
+        out[name] = cast(value)
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent-user load test for backend.main:app")
+    parser.add_argument('--users', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=60, help="seconds of traffic")
+    parser.add_argument('--rows', type=int, default=20_000, help="customers in the uploaded data")
+    parser.add_argument('--workers', type=int, default=1, help="uvicorn workers")
+    parser.add_argument('--url', help="test a running server instead, read-only (its own cockpit DB config applies)")
+    parser.add_argument('--allow-writes', action='store_true',
+                        help="--url: also upload data, save gradings and upload to the cockpit")
+    parser.add_argument('--mix', nargs='+', metavar='ACTION=WEIGHT',
+                        help=f"override action weights (default {MIX})")
+    parser.add_argument('--think', type=float, default=0.5, help="max pause between a user's actions (s)")
+    parser.add_argument('--timeout', type=float, default=60, help="client timeout per request (s)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-p95', nargs='+', metavar='ENDPOINT=MS',
+                        help="exit with status 1 if an endpoint's p95 latency exceeds MS")
+    parser.add_argument('--out', help="write JSON results to this file")
+    args = parser.parse_args()
+
+    mix = _pairs(args.mix, float)
+    unknown = [name for name in mix if name not in ACTIONS]
+    if unknown:
+        parser.error(f"unknown actions {unknown}, expected some of {list(ACTIONS)}")
+    try:
+        action_mix(mix, args.url is None or args.allow_writes)
+    except ValueError as e:
+        parser.error(str(e))
+    result = run(users=args.users, duration=args.duration, rows=args.rows, workers=args.workers,
+                 url=args.url, mix=mix, think=args.think, timeout=args.timeout, seed=args.seed,
+                 allow_writes=args.allow_writes)
+    print(format_report(result['endpoints']))
+    print(f"total {result['meta']['total_rps']:.2f} req/s")
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"Results written to {args.out}")
+
+    failed = []
+    for endpoint, limit in _pairs(args.max_p95, float).items():
+        entry = result['endpoints'].get(endpoint)
+        if entry is not None and entry['p95_ms'] > limit:
+            failed.append(f"{endpoint}: p95 {entry['p95_ms']:.0f} ms > {limit:.0f} ms")
+    if failed:
+        print("\n".join(failed))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,365 @@
+"""
+Benchmark suite for the grading hot paths.
+
+Times every grading_utils step and the FastAPI endpoints (in-process
+TestClient) on synthetic data, records peak traced memory per case and
+writes JSON that benchmarks/compare.py can diff across commits.
+
+Run from the repository root:
+    python -m backend.benchmarks.run --rows 1000 10000 100000 --out bench.json
+    python -m backend.benchmarks.run --only optimize_grading auto-grade --rows 1000
+
+Cases that would take too long at a size (the optimizer, xlsx round trips)
+are skipped above their row limit; raise it with --max-rows-slow. Peak
+memory comes from one extra run under tracemalloc, which single-run cases
+skip unless --memory-all is given.
+"""
+import argparse
+import datetime
+import io
+import itertools
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from backend import delta_ingest, grading_utils, result_diff
+from backend.benchmarks import synthetic
+
+# Row limit for cases that are too slow to run on every size by default
+SLOW_MAX_ROWS = 10_000
+XLSX_MAX_ROWS = 100_000
+
+
+class Case:
+    def __init__(self, name, group, setup, run, max_rows=None, repeat=None):
+        self.name = name
+        self.group = group
+        self.setup = setup        # (n, ctx) -> state, not timed
+        self.run = run            # state -> anything, timed
+        self.max_rows = max_rows
+        self.repeat = repeat
+
+
+# --- grading_utils functions ---
+
+def _raw(n, ctx):
+    return ctx.raw(n)
+
+def _scored(n, ctx):
+    return ctx.scored(n)
+
+def _graded(n, ctx):
+    return ctx.graded(n)
+
+def _scored_thresholds(n, ctx):
+    return ctx.scored(n), synthetic.default_thresholds(ctx.graded(n))
+
+def _delta(n, ctx):
+    """1% of the customers (at least one) with a corrected purchase amount."""
+    rows = ctx.raw(n).sample(max(1, n // 100), random_state=ctx.seed)
+    delta = rows[['许可证号', '卷烟购进金额指标值']].copy()
+    delta['卷烟购进金额指标值'] *= 1.1
+    return delta
+
+def _scoring_delta(n, ctx):
+    return ctx.raw(n), delta_ingest.ScoringState(ctx.scored(n)), _delta(n, ctx)
+
+def _scored_previous_shifts(n, ctx):
+    """Scored data + the shifts a cold search picks on last period's data (another seed)."""
+    def build():
+        previous = grading_utils.calculate_metrics(synthetic.make_customers(n, ctx.seed + 1))
+        return grading_utils.optimize_grading(previous)[1]['shifts']
+    return ctx.scored(n), ctx._memo(('previous_shifts', n), build)
+
+def _two_snapshots(n, ctx):
+    """Diff snapshots of the auto-style result and a manual regrade of it."""
+    manual = grading_utils.assign_grades_by_thresholds(
+        ctx.scored(n), synthetic.default_thresholds(ctx.graded(n)))
+    return result_diff.snapshot(ctx.graded(n)), result_diff.snapshot(manual)
+
+
+FUNCTION_CASES = [
+    Case('calculate_metrics', 'function', _raw, grading_utils.calculate_metrics),
+    Case('assign_grades_by_percentiles', 'function', _scored,
+         lambda df: grading_utils.assign_grades_by_percentiles(df, {'A': 0.0005, 'C': -0.0005}, skew=True)),
+    Case('assign_grades_by_thresholds', 'function', _scored_thresholds,
+         lambda s: grading_utils.assign_grades_by_thresholds(*s)),
+    Case('optimize_grading', 'function', _scored, grading_utils.optimize_grading,
+         max_rows=SLOW_MAX_ROWS, repeat=1),
+    Case('optimize_grading (warm start)', 'function', _scored_previous_shifts,
+         lambda s: grading_utils.optimize_grading(s[0], warm_start=s[1]),
+         max_rows=SLOW_MAX_ROWS, repeat=1),
+    Case('ScoringState.upsert (1% rows)', 'function', _scoring_delta,
+         lambda s: s[1].upsert(s[0], s[2])),
+    Case('GradeDiff', 'function', _two_snapshots,
+         lambda s: result_diff.GradeDiff(s[0], s[1], 'base:other').changes()),
+    Case('generate_summary', 'function', _graded, grading_utils.generate_summary),
+    Case('generate_district_summary', 'function', _graded, grading_utils.generate_district_summary),
+    Case('generate_district_grade_detail', 'function', _graded, grading_utils.generate_district_grade_detail),
+    Case('generate_export_data', 'function', _graded,
+         lambda df: grading_utils.generate_export_data(df.copy())),
+]
+
+
+# --- endpoints ---
+# Run in order against one app instance: each step leaves the state the
+# next one needs (uploaded data -> result -> ...).
+
+def _post_ok(client, url, **kwargs):
+    r = client.post(url, **kwargs)
+    if r.status_code != 200:
+        raise RuntimeError(f"POST {url} -> {r.status_code}: {r.text[:200]}")
+    return r
+
+def _get_ok(client, url, **kwargs):
+    r = client.get(url, **kwargs)
+    if r.status_code != 200:
+        raise RuntimeError(f"GET {url} -> {r.status_code}: {r.text[:200]}")
+    return r
+
+def _upload_state(n, ctx):
+    return ctx.client(n), ctx.xlsx(n)
+
+def _data_state(n, ctx):
+    return ctx.client(n)
+
+def _result_state(n, ctx):
+    return ctx.client(n, with_result=True)
+
+def _thresholds_state(n, ctx):
+    return ctx.client(n, with_result=True), synthetic.default_thresholds(ctx.graded(n))
+
+def _delta_state(n, ctx):
+    buf = io.BytesIO()
+    _delta(n, ctx).to_excel(buf, index=False)
+    return ctx.client(n), buf.getvalue()
+
+def _fresh_thresholds_state(n, ctx):
+    # A slightly different threshold set on every call, so the memo cache never answers
+    client, base = _thresholds_state(n, ctx)
+    counter = itertools.count(1)
+    return client, lambda: {g: v + 1e-9 * next(counter) for g, v in base.items()}
+
+
+ENDPOINT_CASES = [
+    Case('POST /api/upload', 'endpoint', _upload_state,
+         lambda s: _post_ok(s[0], '/api/upload', files={'file': ('data.xlsx', s[1])}),
+         max_rows=XLSX_MAX_ROWS),
+    Case('POST /api/auto-grade', 'endpoint', _data_state,
+         lambda c: _post_ok(c, '/api/auto-grade'),
+         max_rows=SLOW_MAX_ROWS, repeat=1),
+    Case('POST /api/preview-manual-grade (cold)', 'endpoint', _fresh_thresholds_state,
+         lambda s: _post_ok(s[0], '/api/preview-manual-grade', json={'thresholds': s[1]()}),
+         max_rows=XLSX_MAX_ROWS),
+    Case('POST /api/preview-manual-grade (memo)', 'endpoint', _thresholds_state,
+         lambda s: _post_ok(s[0], '/api/preview-manual-grade', json={'thresholds': s[1]}),
+         max_rows=XLSX_MAX_ROWS),
+    Case('POST /api/manual-grade', 'endpoint', _thresholds_state,
+         lambda s: _post_ok(s[0], '/api/manual-grade', json={'thresholds': s[1]}),
+         max_rows=XLSX_MAX_ROWS, repeat=1),
+    Case('GET /api/results', 'endpoint', _result_state,
+         lambda c: _get_ok(c, '/api/results', params={'sort': '总分', 'order': 'desc', 'limit': 100,
+                                                     'movement': 'up'}),
+         max_rows=XLSX_MAX_ROWS),
+    Case('GET /api/download', 'endpoint', _result_state,
+         lambda c: _get_ok(c, '/api/download'),
+         max_rows=XLSX_MAX_ROWS, repeat=1),
+    Case('GET /api/export/detail (csv)', 'endpoint', _result_state,
+         lambda c: _get_ok(c, '/api/export/detail'),
+         max_rows=XLSX_MAX_ROWS),
+    # Last: leaves the result stale
+    Case('POST /api/upload-delta', 'endpoint', _delta_state,
+         lambda s: _post_ok(s[0], '/api/upload-delta', files={'file': ('delta.xlsx', s[1])}),
+         max_rows=XLSX_MAX_ROWS, repeat=1),
+]
+
+ALL_CASES = FUNCTION_CASES + ENDPOINT_CASES
+
+
+class Context:
+    """Lazily built, shared inputs for one benchmark run."""
+
+    def __init__(self, seed):
+        self.seed = seed
+        self._cache = {}
+        self._client = None
+        self._rows = None
+
+    def _memo(self, key, build):
+        if key not in self._cache:
+            self._cache[key] = build()
+        return self._cache[key]
+
+    def raw(self, n):
+        return self._memo(('raw', n), lambda: synthetic.make_customers(n, self.seed))
+
+    def scored(self, n):
+        return self._memo(('scored', n), lambda: grading_utils.calculate_metrics(self.raw(n)))
+
+    def graded(self, n):
+        return self._memo(('graded', n),
+                          lambda: grading_utils.assign_grades_by_percentiles(self.scored(n), {}, skew=True))
+
+    def xlsx(self, n):
+        def build():
+            buf = io.BytesIO()
+            self.raw(n).to_excel(buf, index=False)
+            return buf.getvalue()
+        return self._memo(('xlsx', n), build)
+
+    def client(self, n, with_result=False):
+        """
+        TestClient whose app holds the dataset of size `n` (uploaded
+        untimed if needed) and, with `with_result`, a graded result.
+        """
+        if self._client is None:
+            # Keep the app's working files out of the source tree
+            self._tmp = tempfile.TemporaryDirectory(prefix='grading-bench-')
+            os.environ['GRADING_DATA_DIR'] = self._tmp.name
+            from fastapi.testclient import TestClient
+            from backend import main
+            self._main = main
+            self._client = TestClient(main.app)
+        if self._rows != n:
+            if os.path.exists(self._main.RESULT_FILE):
+                os.remove(self._main.RESULT_FILE)
+            _post_ok(self._client, '/api/upload', files={'file': ('data.xlsx', self.xlsx(n))})
+            self._rows = n
+        if with_result and not os.path.exists(self._main.RESULT_FILE):
+            thresholds = synthetic.default_thresholds(self.graded(n))
+            _post_ok(self._client, '/api/manual-grade', json={'thresholds': thresholds})
+        return self._client
+
+
+def _time_case(case, state, repeat):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        case.run(state)
+        times.append(time.perf_counter() - t0)
+    return times
+
+
+def _peak_memory(case, state):
+    """Peak traced allocation (MiB) of one extra run."""
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        case.run(state)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak / (1024 * 1024)
+
+
+def run_case(case, n, ctx, repeat, max_rows_slow, measure_memory, memory_all=False):
+    limit = case.max_rows
+    if limit is not None and max_rows_slow is not None:
+        limit = max(limit, max_rows_slow)
+    result = {'name': case.name, 'group': case.group, 'rows': n}
+    if limit is not None and n > limit:
+        result['skipped'] = f"rows > {limit}"
+        return result
+
+    state = case.setup(n, ctx)
+    repeat = case.repeat or repeat
+    times = _time_case(case, state, repeat)
+    result.update({
+        'repeat': repeat,
+        'min_s': min(times),
+        'median_s': statistics.median(times),
+        'mean_s': statistics.fmean(times),
+    })
+    if measure_memory and (memory_all or case.repeat is None or case.repeat > 1):
+        result['peak_mem_mib'] = _peak_memory(case, state)
+    return result
+
+
+def _git_commit():
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                             text=True, cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10)
+        return out.stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def _max_rss_mib():
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # KiB on Linux, bytes on macOS
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+
+
+def run(rows, repeat=3, seed=0, only=None, max_rows_slow=None, measure_memory=True,
+        memory_all=False, log=print):
+    cases = [c for c in ALL_CASES if not only or any(o in c.name for o in only)]
+    ctx = Context(seed)
+    results = []
+    for n in rows:
+        for case in cases:
+            r = run_case(case, n, ctx, repeat, max_rows_slow, measure_memory, memory_all)
+            results.append(r)
+            if log:
+                log(format_result(r))
+    return {
+        'meta': {
+            'commit': _git_commit(),
+            'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'seed': seed,
+            'max_rss_mib': _max_rss_mib(),
+        },
+        'results': results,
+    }
+
+
+def format_result(r):
+    head = f"{r['rows']:>9} rows  {r['name']:<42}"
+    if 'skipped' in r:
+        return f"{head} skipped ({r['skipped']})"
+    mem = f"  peak {r['peak_mem_mib']:8.1f} MiB" if 'peak_mem_mib' in r else ''
+    return f"{head} median {r['median_s'] * 1000:10.2f} ms  min {r['min_s'] * 1000:10.2f} ms  x{r['repeat']}{mem}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Grading benchmark suite")
+    parser.add_argument('--rows', type=int, nargs='+', default=[1_000, 10_000],
+                        help=f"dataset sizes (full set: {' '.join(map(str, synthetic.SIZES))})")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', nargs='+', help="run cases whose name contains any of these")
+    parser.add_argument('--max-rows-slow', type=int,
+                        help="raise the row limit of the slow cases (optimizer, xlsx)")
+    parser.add_argument('--no-memory', action='store_true', help="skip the tracemalloc pass")
+    parser.add_argument('--memory-all', action='store_true',
+                        help="also measure peak memory of single-run (slow) cases")
+    parser.add_argument('--out', help="write JSON results to this file")
+    args = parser.parse_args()
+
+    report = run(args.rows, repeat=args.repeat, seed=args.seed, only=args.only,
+                 max_rows_slow=args.max_rows_slow, measure_memory=not args.no_memory,
+                 memory_all=args.memory_all)
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Results written to {args.out}")
+
+
+if __name__ == '__main__':
+    main()
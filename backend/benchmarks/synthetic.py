@@ -0,0 +1,77 @@
+"""
+Synthetic customer data with the same shape as the uploaded workbooks.
+
+make_customers(n) returns the raw upload columns:
+  - 营销线路: "<district><nn>线", the first two characters being the
+    district (所属区县 is derived from them),
+  - 原档位: Chinese grade names, roughly normal around 15,
+  - 信用等级指标值: AAA/AA/A/B/C/D letters,
+  - 交易数据指标值: trade index mostly in 85-101 with a low tail,
+  - 卷烟购进金额指标值: log-normal purchase amounts.
+Everything is driven by one seed, so a given (n, seed) is reproducible.
+"""
+import numpy as np
+import pandas as pd
+
+from backend import grading_utils
+
+DISTRICTS = ['东湖', '西湖', '青云', '青山', '新建', '红谷', '南昌', '进贤', '安义', '湾里']
+# Share of customers per district (urban districts are larger)
+DISTRICT_WEIGHTS = [0.16, 0.14, 0.10, 0.12, 0.11, 0.09, 0.12, 0.07, 0.05, 0.04]
+ROUTES_PER_DISTRICT = 40
+
+CREDIT_GRADES = ['AAA', 'AA', 'A', 'B', 'C', 'D']
+CREDIT_WEIGHTS = [0.30, 0.25, 0.20, 0.15, 0.07, 0.03]
+
+SIZES = [1_000, 10_000, 100_000, 1_000_000]
+
+GRADE_NAMES = np.array([grading_utils.num_to_cn(g) for g in range(1, 31)], dtype=object)
+
+
+def make_customers(n, seed=0):
+    """Raw customer table as uploaded through /api/upload."""
+    rng = np.random.default_rng(seed)
+
+    district = rng.choice(len(DISTRICTS), size=n, p=DISTRICT_WEIGHTS)
+    route_no = rng.integers(1, ROUTES_PER_DISTRICT + 1, size=n)
+    districts = np.array(DISTRICTS, dtype=object)
+    routes = districts[district] + np.char.zfill(route_no.astype(str), 2).astype(object) + '线'
+
+    old_grade = np.clip(np.rint(rng.normal(15, 6, size=n)), 1, 30).astype(int)
+    # Purchase amount grows with the old grade, with plenty of overlap
+    amount = np.round(rng.lognormal(mean=9.0 + old_grade * 0.06, sigma=0.6, size=n), 2)
+
+    trade = np.where(rng.random(n) < 0.85,
+                     rng.uniform(85, 103, size=n),
+                     rng.uniform(30, 85, size=n)).round(2)
+
+    df = pd.DataFrame({
+        '许可证号': np.char.add('3601', np.char.zfill(np.arange(n).astype(str), 8)).astype(object),
+        '营销线路': routes,
+        '原档位': GRADE_NAMES[old_grade - 1],
+        '卷烟购进金额指标值': amount,
+        '信用等级指标值': rng.choice(CREDIT_GRADES, size=n, p=CREDIT_WEIGHTS).astype(object),
+        '专柜陈列得分': rng.choice([0, 1, 2], size=n, p=[0.1, 0.3, 0.6]),
+        '摆放规则得分': rng.choice([0, 1, 2], size=n, p=[0.1, 0.3, 0.6]),
+        '破损褪色得分': rng.choice([0, 1, 2], size=n, p=[0.05, 0.25, 0.7]),
+        '主题陈列得分': rng.choice([0, 1, 2], size=n, p=[0.2, 0.4, 0.4]),
+        '明码标价得分': rng.choice([0, 1, 2], size=n, p=[0.05, 0.15, 0.8]),
+        '交易数据指标值': trade,
+        '消费环境得分': rng.choice([0, 1, 2, 3], size=n, p=[0.1, 0.3, 0.4, 0.2]),
+    })
+    # A few blanks, as real workbooks have
+    blanks = rng.random(n) < 0.002
+    df.loc[blanks, '信用等级指标值'] = None
+    return df
+
+
+def make_graded(n, seed=0):
+    """Scored customers with a default percentile grading applied."""
+    df = grading_utils.calculate_metrics(make_customers(n, seed))
+    return grading_utils.assign_grades_by_percentiles(df, {}, skew=True)
+
+
+def default_thresholds(graded):
+    """Manual thresholds = lowest 总分 of every grade in `graded` (what the UI starts from)."""
+    mins = graded.groupby('新档位_Num')['总分'].min()
+    return {int(g): float(v) for g, v in mins.items() if g >= 2}
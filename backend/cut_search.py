@@ -0,0 +1,268 @@
+"""
+Cut-index search behind optimize_grading.
+
+A candidate (A/B/C/D shifts) only decides where the grade runs start and
+end in score order (grading_utils.grade_layout). Everything the optimizer
+scores follows from the run boundaries and the old grade at each position:
+  - customers per new grade = run lengths,
+  - upgrades in a run of grade g = old grades < g inside the run.
+So instead of regrading the frame per candidate, we collect the boundary
+positions of all candidates, take one sequential pass over the old grades
+in score order to get a cumulative old-grade histogram at each of those
+positions, and score every candidate from table lookups.
+
+The old grades can be any 1-D array, including an np.memmap (out_of_core):
+the pass reads them chunk by chunk.
+
+warm_search starts from last period's shifts and walks the grid outward
+ring by ring, stopping once a ring no longer improves a candidate that
+passes the mandatory rules.
+
+candidate_set keeps the top-K candidates plus the Pareto front over
+(corr, n_up - n_down, min_pct) as plain shifts + metrics, so any of them
+can be materialized later without searching again.
+"""
+import heapq
+import itertools
+import os
+from collections import namedtuple
+
+import numpy as np
+
+from . import rules
+from .grading_utils import grade_layout
+
+# Grid of boundary shifts tried for each of A/B/C/D
+SHIFT_OPTIONS = [-0.001, -0.0009, -0.0005, 0, 0.0005, 0.0009, 0.001]
+
+# Old grade histogram bins: 0..30 as is, 31 = anything above 30
+OLD_BINS = 32
+CHUNK_ROWS = 1_000_000
+
+# warm_search stops after a ring improves the best passing score by no more
+# than this (score units: 1.0 of correlation = 1,000,000, one customer = 1)
+WARM_TOLERANCE = float(os.environ.get('GRADING_WARM_TOLERANCE', 1000))
+# Candidates kept by candidate_set besides the Pareto front
+TOP_K = 10
+
+Candidate = namedtuple('Candidate', 'shifts score metrics layout')
+
+
+def shift_grid(options=SHIFT_OPTIONS):
+    """All candidate shifts, in the order the optimizer has always tried them."""
+    return [{'A': a, 'B': b, 'C': c, 'D': d}
+            for a, b, c, d in itertools.product(options, repeat=4)]
+
+
+def shift_rings(seed, options=SHIFT_OPTIONS):
+    """
+    The shift grid grouped by distance from `seed` (largest number of grid
+    steps over A/B/C/D), nearest ring first, grid order within a ring.
+    """
+    center = [int(np.argmin([abs(o - seed.get(k, 0)) for o in options])) for k in 'ABCD']
+    rings = {}
+    for idx in itertools.product(range(len(options)), repeat=4):
+        d = max(abs(i - c) for i, c in zip(idx, center))
+        rings.setdefault(d, []).append(dict(zip('ABCD', (options[i] for i in idx))))
+    return [rings[d] for d in sorted(rings)]
+
+
+def _old_bins(old):
+    return np.clip(np.asarray(old), 0, OLD_BINS - 1).astype(np.int64)
+
+
+def cumulative_histograms(old_sorted, positions, chunk_rows=CHUNK_ROWS):
+    """
+    hist[i, k] = number of j < positions[i] with old_sorted[j] <= k
+    (k = 31 also counts old grades above 30). `positions` must be sorted
+    and unique. One sequential pass over `old_sorted`.
+    """
+    positions = np.asarray(positions, dtype=np.int64)
+    n = len(old_sorted)
+    hist = np.zeros((len(positions), OLD_BINS), dtype=np.int64)
+    running = np.zeros(OLD_BINS, dtype=np.int64)
+
+    for c0 in range(0, n, chunk_rows):
+        c1 = min(n, c0 + chunk_rows)
+        chunk = _old_bins(old_sorted[c0:c1])
+        lo = np.searchsorted(positions, c0, side='right')
+        hi = np.searchsorted(positions, c1, side='right')
+        if hi > lo:
+            local = positions[lo:hi] - c0
+            # Segment k holds the chunk elements between local[k-1] and local[k]
+            seg = np.searchsorted(local, np.arange(c1 - c0), side='right')
+            counts = np.bincount(seg * OLD_BINS + chunk,
+                                 minlength=(len(local) + 1) * OLD_BINS).reshape(-1, OLD_BINS)
+            hist[lo:hi] = np.cumsum(counts, axis=0)[:-1] + running
+            running += counts.sum(axis=0)
+        else:
+            running += np.bincount(chunk, minlength=OLD_BINS)
+    return np.cumsum(hist, axis=1)
+
+
+def score_counts(counts, total, n_up, n_down):
+    """
+    Optimizer score and rule metrics (rules.count_rules) from the customers
+    per new grade (`counts[g]` for g = 1..30) and the city-wide up/down counts.
+    """
+    metrics = rules.count_rules(counts, total, n_up, n_down)
+
+    # Scoring
+    score = 0
+    # 1. Mandatory Rules (Must satisfy)
+    if metrics['rule_big']: score += 1000000000
+    if metrics['rule_b_pass']: score += 1000000000
+    if metrics['rule_a_hard']: score += 1000000000
+    # 2. Priority Rules (Try to satisfy)
+    if metrics['rule_a_pass']: score += 5000000
+    if metrics['rule_e_pass']: score += 5000000
+    # 3. Optimization Objectives: correlation, then upgrade margin
+    score += (metrics['corr'] * 1000000)
+    score += (n_up - n_down)
+
+    # Penalize if Mandatory Rules are not met
+    if not metrics['mandatory_pass']:
+        score -= 10000000000 # Make it impossible to pick
+    return score, metrics
+
+
+class CutEvaluator:
+    """Scores shift candidates against one dataset's old grades in score order."""
+
+    def __init__(self, old_sorted, skew=True, chunk_rows=CHUNK_ROWS):
+        self.old_sorted = old_sorted
+        self.total = len(old_sorted)
+        self.skew = skew
+        self.chunk_rows = chunk_rows
+        self._positions = np.zeros(0, dtype=np.int64)
+        self._hist = np.zeros((0, OLD_BINS), dtype=np.int64)
+
+    def layouts(self, candidates):
+        return [np.array(grade_layout(self.total, shifts, self.skew), dtype=np.int64).reshape(-1, 3)
+                for shifts in candidates]
+
+    def prepare(self, layouts):
+        """Compute the histograms at every boundary of `layouts` not seen yet."""
+        wanted = np.unique(np.concatenate([l[:, 1:].ravel() for l in layouts]))
+        new = np.setdiff1d(wanted, self._positions, assume_unique=True)
+        if len(new) == 0:
+            return
+        positions = np.concatenate([self._positions, new])
+        hist = np.concatenate([self._hist, cumulative_histograms(self.old_sorted, new, self.chunk_rows)])
+        order = np.argsort(positions)
+        self._positions = positions[order]
+        self._hist = hist[order]
+
+    def evaluate(self, shifts, layout):
+        g, start, end = layout[:, 0], layout[:, 1], layout[:, 2]
+        hs = self._hist[np.searchsorted(self._positions, start)]
+        he = self._hist[np.searchsorted(self._positions, end)]
+        rows = np.arange(len(g))
+        # old < g  <=>  old <= g - 1 ;  old > g  <=>  not old <= g
+        n_up = (he[rows, g - 1] - hs[rows, g - 1]).sum()
+        n_down = ((end - start) - (he[rows, g] - hs[rows, g])).sum()
+        counts = np.zeros(31, dtype=np.int64)
+        counts[g] = end - start
+        score, metrics = score_counts(counts, self.total, n_up, n_down)
+        return Candidate(shifts, score, metrics, layout)
+
+    def run(self, candidates):
+        """Evaluate `candidates` (list of shift dicts) in order."""
+        layouts = self.layouts(candidates)
+        self.prepare(layouts)
+        return [self.evaluate(shifts, layout) for shifts, layout in zip(candidates, layouts)]
+
+
+def search(old_sorted, candidates=None, skew=True, chunk_rows=CHUNK_ROWS):
+    """
+    Best candidate over the shift grid (first one wins ties, like the
+    original loop) and all evaluated candidates.
+    """
+    if candidates is None:
+        candidates = shift_grid()
+    evaluated = CutEvaluator(old_sorted, skew, chunk_rows).run(candidates)
+    return _best(evaluated), evaluated
+
+
+def warm_search(old_sorted, seed, tolerance=WARM_TOLERANCE, skew=True, chunk_rows=CHUNK_ROWS):
+    """
+    Search outward from `seed` (the previous run's shifts). Stops after the
+    first ring that improves a best candidate passing the mandatory rules
+    by no more than `tolerance`; otherwise ends up covering the whole grid.
+    Returns (best, evaluated) like search().
+    """
+    evaluator = CutEvaluator(old_sorted, skew, chunk_rows)
+    best = None
+    evaluated = []
+    for r, ring in enumerate(shift_rings(seed)):
+        results = evaluator.run(ring)
+        evaluated.extend(results)
+        previous = best.score if best is not None else -np.inf
+        best = _best(results, best)
+        if r > 0 and best.metrics['mandatory_pass'] and best.score - previous <= tolerance:
+            break
+    return best, evaluated
+
+
+def top_candidates(candidates, k=TOP_K):
+    """
+    The best candidates with `k` distinct layouts, best first (earlier wins
+    ties), via a bounded heap. Shifts giving the same layout give the same
+    candidate; only the first of them is kept.
+    """
+    distinct = {}
+    for i, c in enumerate(candidates):
+        distinct.setdefault(_layout_key(c), (c.score, -i, c))
+    return [c for _, _, c in heapq.nlargest(k, distinct.values())]
+
+
+def _layout_key(cand):
+    return np.asarray(cand.layout, dtype=np.int64).tobytes()
+
+
+def pareto_front(candidates):
+    """
+    Candidates passing the mandatory rules that no other passing candidate
+    beats on all of corr, n_up - n_down and min_pct. One candidate per
+    distinct objective vector, in input order.
+    """
+    front = {}
+    for c in candidates:
+        if c.metrics['mandatory_pass']:
+            front.setdefault(_objectives(c), c)
+    if not front:
+        return []
+    obj = np.array(list(front))
+    # dominates[j, i]: j is at least as good as i everywhere and better somewhere
+    dominates = ((obj[:, None, :] >= obj[None, :, :]).all(axis=2) &
+                 (obj[:, None, :] > obj[None, :, :]).any(axis=2))
+    dominated = dominates.any(axis=0)
+    return [c for c, d in zip(front.values(), dominated) if not d]
+
+
+def _objectives(cand):
+    m = cand.metrics
+    return (float(m['corr']), m['n_up'] - m['n_down'], float(m['min_pct']))
+
+
+def candidate_set(candidates, k=TOP_K):
+    """
+    Top-`k` candidates (best first) followed by the rest of the Pareto
+    front, as JSON-ready dicts: shifts, score, pareto flag and metrics.
+    Every layout appears once.
+    """
+    top = top_candidates(candidates, k)
+    front = pareto_front(candidates)
+    on_front = {_layout_key(c) for c in front}
+    taken = {_layout_key(c) for c in top}
+    chosen = top + [c for c in front if _layout_key(c) not in taken]
+    return [{'shifts': c.shifts, 'score': float(c.score), 'pareto': _layout_key(c) in on_front, **c.metrics}
+            for c in chosen]
+
+
+def _best(candidates, best=None):
+    """Highest score; earlier candidates win ties."""
+    for cand in candidates:
+        if best is None or cand.score > best.score:
+            best = cand
+    return best
@@ -1,8 +1,14 @@
 
 import pandas as pd
 import numpy as np
-import itertools
-from scipy.stats import norm
+from . import instrumentation
+
+# Normal weights for grades 1-30 (mean 15, std 7), bit-identical to
+# scipy.stats.norm.pdf(x, loc=15, scale=7). Computed once at import so
+# grading does not need scipy, nor recompute the table on every call.
+GRADE_RANGE = np.arange(1, 31)
+NORMAL_WEIGHTS = np.exp(-((GRADE_RANGE - 15) / 7) ** 2 / 2.0) / np.sqrt(2 * np.pi) / 7
+NORMAL_WEIGHTS.flags.writeable = False
 
 def parse_chinese_grade(grade_str):
     """Convert '二十四档' to 24."""
@@ -27,17 +33,23 @@ def num_to_cn(n):
     if n == 30: return '三十档'
     return str(n)
 
-def calculate_metrics(df):
-    """Calculate all required scoring columns."""
-    df = df.copy()
-    
-    # 1. Purchase Amount Rank (Higher value = Rank 1)
-    df['卷烟购进金额指标排名'] = df['卷烟购进金额指标值'].rank(ascending=False, method='min')
-    
-    # 2. Purchase Amount Score
-    total_customers = len(df)
-    df['卷烟购进金额得分'] = (2 - df['卷烟购进金额指标排名'] / total_customers) * 40
-    
+# Columns calculate_metrics adds, in the order they appear in the result
+NON_PURCHASE_COLS = [
+    '信用等级指标得分', '专柜陈列得分', '摆放规则得分', '破损褪色得分', 
+    '主题陈列得分', '明码标价得分', '交易数据指标得分', '消费环境得分'
+]
+METRIC_COLS = (
+    ['卷烟购进金额指标排名', '卷烟购进金额得分', '信用等级指标得分', '交易数据指标得分'] +
+    [c for c in NON_PURCHASE_COLS if c not in ('信用等级指标得分', '交易数据指标得分')] +
+    ['卷烟非购进金额得分', '总分', '总分排名', '所属区县', '原档位_Num']
+)
+
+def calculate_row_scores(df):
+    """
+    Add the scoring columns that only depend on the row itself (everything
+    except the purchase amount rank/score and the total score/rank).
+    Modifies `df` in place; out_of_core runs it chunk by chunk.
+    """
     # 3. Credit Score
     def get_credit_score(grade):
         if pd.isna(grade): return 0
@@ -63,18 +75,10 @@ def calculate_metrics(df):
     df['交易数据指标得分'] = df['交易数据指标值'].apply(get_trade_score)
     
     # 5. Non-Purchase Score
-    non_purchase_cols = [
-        '信用等级指标得分', '专柜陈列得分', '摆放规则得分', '破损褪色得分', 
-        '主题陈列得分', '明码标价得分', '交易数据指标得分', '消费环境得分'
-    ]
-    for col in non_purchase_cols:
+    for col in NON_PURCHASE_COLS:
         if col not in df.columns: df[col] = 0
         df[col] = df[col].fillna(0)
-    df['卷烟非购进金额得分'] = df[non_purchase_cols].sum(axis=1)
-    
-    # 6. Total Score & 7. Rank
-    df['总分'] = df['卷烟购进金额得分'] + df['卷烟非购进金额得分']
-    df['总分排名'] = df['总分'].rank(ascending=False, method='min')
+    df['卷烟非购进金额得分'] = df[NON_PURCHASE_COLS].sum(axis=1)
     
     # 8. District
     df['所属区县'] = df['营销线路'].astype(str).str[:2]
@@ -84,111 +88,121 @@ def calculate_metrics(df):
     
     return df
 
-def assign_grades_by_percentiles(df, shifts, skew=False):
-    """
-    Assign grades 1-30 based on Total Score and boundary shifts.
-    Uses Normal Distribution (centered at 15) to distribute counts within blocks if skew=True.
-    """
-    df = df.sort_values(by=['总分', '卷烟购进金额指标值'], ascending=[False, False]).copy()
-    total = len(df)
+def calculate_metrics(df):
+    """Calculate all required scoring columns."""
+    original_cols = list(df.columns)
+    df = calculate_row_scores(df.copy())
+    
+    # 1. Purchase Amount Rank (Higher value = Rank 1)
+    df['卷烟购进金额指标排名'] = df['卷烟购进金额指标值'].rank(ascending=False, method='min')
     
-    base_cuts = {'A': 0.09, 'B': 0.27, 'C': 0.50, 'D': 0.73}
+    # 2. Purchase Amount Score
+    total_customers = len(df)
+    df['卷烟购进金额得分'] = (2 - df['卷烟购进金额指标排名'] / total_customers) * 40
     
-    cut_A = base_cuts['A'] + shifts.get('A', 0)
-    cut_B = base_cuts['B'] + shifts.get('B', 0)
-    cut_C = base_cuts['C'] + shifts.get('C', 0)
-    cut_D = base_cuts['D'] + shifts.get('D', 0)
+    # 6. Total Score & 7. Rank
+    df['总分'] = df['卷烟购进金额得分'] + df['卷烟非购进金额得分']
+    df['总分排名'] = df['总分'].rank(ascending=False, method='min')
     
-    idx_A = int(round(total * cut_A))
-    idx_B = int(round(total * cut_B))
-    idx_C = int(round(total * cut_C))
-    idx_D = int(round(total * cut_D))
+    # Keep the usual column order: input columns, then the metrics
+    return df[original_cols + [c for c in METRIC_COLS if c not in original_cols]]
+
+# Base cut percentiles: share of customers above the A/B/C/D block boundaries
+BASE_CUTS = {'A': 0.09, 'B': 0.27, 'C': 0.50, 'D': 0.73}
+# (first grade, last grade) of the blocks between consecutive cuts
+GRADE_BLOCKS = [(30, 26), (25, 21), (20, 16), (15, 11), (10, 1)]
+
+def cut_indices(total, shifts):
+    """Positions (in score order) of the A/B/C/D block boundaries."""
+    idx_A = int(round(total * (BASE_CUTS['A'] + shifts.get('A', 0))))
+    idx_B = int(round(total * (BASE_CUTS['B'] + shifts.get('B', 0))))
+    idx_C = int(round(total * (BASE_CUTS['C'] + shifts.get('C', 0))))
+    idx_D = int(round(total * (BASE_CUTS['D'] + shifts.get('D', 0))))
     
     idx_B = max(idx_A, idx_B)
     idx_C = max(idx_B, idx_C)
     idx_D = max(idx_C, idx_D)
-    
-    grades = np.zeros(total, dtype=int)
-    
-    # Pre-calculate normal weights for grades 1-30
-    # Mean = 15.5, Std Dev approx 7 (covers range 1-30 nicely within +/- 2ish sigma)
-    # We want peak at 15.
-    x = np.arange(1, 31)
-    # Using mean=15 to satisfy "15档的人数最多"
-    pdf = norm.pdf(x, loc=15, scale=7)
-    pdf_weights = dict(zip(x, pdf))
+    return [idx_A, idx_B, idx_C, idx_D]
 
-    def distribute_grades(start_idx, end_idx, start_grade, end_grade):
+def block_grade_counts(count, start_grade, end_grade, skew=False):
+    """
+    Number of customers per grade inside one block, in block order
+    (start_grade first, e.g. [30, 29, 28, 27, 26]).
+    Uses Normal Distribution (centered at 15) if skew=True.
+    """
+    num_grades = start_grade - end_grade + 1
+    
+    if not skew:
+        # Uniform distribution
+        base = count // num_grades
+        remainder = count % num_grades
+        return [base + (1 if i < remainder else 0) for i in range(num_grades)]
+    
+    # Normal Distribution Weighted
+    # Get weights for grades in this block
+    # (NORMAL_WEIGHTS: Std Dev 7 covers range 1-30 nicely within +/- 2ish sigma,
+    # mean=15 to satisfy "15档的人数最多")
+    block_grades = np.arange(start_grade, end_grade - 1, -1)
+    weights = NORMAL_WEIGHTS[block_grades - 1]
+    weights = weights / weights.sum() # Normalize
+    
+    # Calculate counts
+    counts = np.floor(weights * count).astype(int)
+    
+    # Distribute remainder
+    current_sum = counts.sum()
+    remainder = count - current_sum
+    
+    # Add remainder to grades with highest decimal part (largest error)
+    if remainder > 0:
+        exact_counts = weights * count
+        diffs = exact_counts - counts
+        indices = np.argsort(diffs)[::-1]
+        for i in range(remainder):
+            counts[indices[i]] += 1
+    return counts.tolist()
+
+def grade_layout(total, shifts, skew=False):
+    """
+    New grades of `total` customers in score order (best first), as
+    contiguous runs: [(grade, start, end), ...].
+    """
+    bounds = [0] + cut_indices(total, shifts) + [total]
+    layout = []
+    for (start_grade, end_grade), start_idx, end_idx in zip(GRADE_BLOCKS, bounds, bounds[1:]):
         count = end_idx - start_idx
-        if count <= 0: return
-        num_grades = start_grade - end_grade + 1
-        
-        # Determine grades in this block
-        block_grades = list(range(end_grade, start_grade + 1))[::-1] # e.g. [30, 29, 28, 27, 26]
-        
-        if not skew:
-            # Uniform distribution
-            base = count // num_grades
-            remainder = count % num_grades
-            current_idx = start_idx
-            for i, g in enumerate(block_grades):
-                n = base + (1 if i < remainder else 0)
-                grades[current_idx : current_idx + n] = g
+        if count <= 0: continue
+        current_idx = start_idx
+        counts = block_grade_counts(count, start_grade, end_grade, skew)
+        for g, n in zip(range(start_grade, end_grade - 1, -1), counts):
+            if n > 0:
+                layout.append((g, current_idx, current_idx + n))
                 current_idx += n
-        else:
-            # Normal Distribution Weighted
-            # Get weights for grades in this block
-            weights = np.array([pdf_weights[g] for g in block_grades])
-            weights = weights / weights.sum() # Normalize
-            
-            # Calculate counts
-            counts = np.floor(weights * count).astype(int)
-            
-            # Ensure every grade gets at least 1 if possible
-            if count >= num_grades:
-                # Find indices where count is 0
-                zero_indices = np.where(counts == 0)[0]
-                # We need to take from somewhere to give to these
-                # Actually, simpler: just use remainder distribution logic to fill holes first?
-                # No, floor might be 0 if weight is small.
-                pass 
-                # Let's trust the remainder logic below to fill up holes if remainder is large enough
-                # Or force it:
-                # If we have enough count, ensure min=1
-            
-            # Distribute remainder
-            current_sum = counts.sum()
-            remainder = count - current_sum
-            
-            # Add remainder to grades with highest decimal part (largest error)
-            # Or just add to the highest weights
-            # Simple approach: add 1 to the first 'remainder' grades sorted by weight desc
-            if remainder > 0:
-                # Add to the ones with highest original weight to maintain shape
-                # indices = np.argsort(weights)[::-1]
-                # Better: Add to the middle of the block?
-                # Let's add to the indices that have the highest fractional part if we calculated floats
-                exact_counts = weights * count
-                diffs = exact_counts - counts
-                indices = np.argsort(diffs)[::-1]
-                for i in range(remainder):
-                    counts[indices[i]] += 1
-            
-            # Assign
-            current_idx = start_idx
-            for i, g in enumerate(block_grades):
-                n = counts[i]
-                if n > 0:
-                    grades[current_idx : current_idx + n] = g
-                    current_idx += n
-            
-    distribute_grades(0, idx_A, 30, 26)
-    distribute_grades(idx_A, idx_B, 25, 21)
-    distribute_grades(idx_B, idx_C, 20, 16)
-    distribute_grades(idx_C, idx_D, 15, 11)
-    distribute_grades(idx_D, total, 10, 1)
+    return layout
+
+def layout_grades(layout, total):
+    """Expand a grade_layout into one grade per position."""
+    grades = np.zeros(total, dtype=int)
+    for g, start, end in layout:
+        grades[start:end] = g
+    return grades
+
+def sort_for_grading(df):
+    """Best customers first: the order percentile grading hands out grades in."""
+    return df.sort_values(by=['总分', '卷烟购进金额指标值'], ascending=[False, False])
+
+def assign_grades_by_percentiles(df, shifts, skew=False, presorted=False):
+    """
+    Assign grades 1-30 based on Total Score and boundary shifts.
+    Uses Normal Distribution (centered at 15) to distribute counts within blocks if skew=True.
+    presorted: `df` already comes from sort_for_grading.
+    """
+    if not presorted:
+        df = sort_for_grading(df)
+    df = df.copy()
+    total = len(df)
     
-    df['新档位_Num'] = grades
+    df['新档位_Num'] = layout_grades(grade_layout(total, shifts, skew), total)
     
     # Add Chinese Grade Name
     df['新档位'] = df['新档位_Num'].apply(num_to_cn)
@@ -220,369 +234,153 @@ def assign_grades_by_thresholds(df, thresholds):
     df['新档位'] = df['新档位_Num'].apply(num_to_cn)
     return df
 
-def optimize_grading(df):
-    """Run optimization to find best shifts."""
-    # Expanded grid search to ensure we find a solution
-    options = [-0.001, -0.0009, -0.0005, 0, 0.0005, 0.0009, 0.001]
-    
-    best_score = -float('inf')
-    best_df = None
-    best_metrics = {}
-    
-    for shifts_tuple in itertools.product(options, repeat=4):
-        shifts = {'A': shifts_tuple[0], 'B': shifts_tuple[1], 'C': shifts_tuple[2], 'D': shifts_tuple[3]}
-        temp_df = assign_grades_by_percentiles(df, shifts, skew=True)
-        
-        # Fast metric calc
-        grade_counts = temp_df['新档位_Num'].value_counts(normalize=True)
-        min_pct = grade_counts.min() if not grade_counts.empty else 0
-        
-        upgrades = temp_df['新档位_Num'] > temp_df['原档位_Num']
-        downgrades = temp_df['新档位_Num'] < temp_df['原档位_Num']
-        n_up = upgrades.sum()
-        n_down = downgrades.sum()
-        
-        # Check Big Rules
-        total_cust = len(temp_df)
-        def check_pct(start, end, target):
-            c = ((temp_df['新档位_Num'] >= start) & (temp_df['新档位_Num'] <= end)).sum()
-            p = c / total_cust
-            return (target - 0.001) <= p <= (target + 0.001)
-            
-        rule_big = (check_pct(26,30,0.09) and check_pct(21,25,0.18) and 
-                    check_pct(16,20,0.23) and check_pct(11,15,0.23) and 
-                    check_pct(1,10,0.27))
-                    
-        rule_a_pass = min_pct >= 0.01
-        rule_a_hard = grade_counts.min() > 0 if not grade_counts.empty else False
-        
-        # Small Rule B: Upgrade >= Downgrade (CITY WIDE)
-        # Requirement: "升档人数大于等于降档人数必须满足"
-        rule_b_pass = n_up >= n_down
-        
-        # Small Rule C: Variance Minimization (Check & Optimization Goal)
-        # User said: "C and D can be ignored". We will keep variance as a very weak tie-breaker.
-        total_variance = 0
-        for g in range(1, 31):
-            g_subset = temp_df[temp_df['新档位_Num'] == g]
-            if len(g_subset) > 1:
-                var = g_subset['卷烟购进金额指标值'].var()
-                total_variance += var
-        
-        # Small Rule D: Weighted Purchase Index Change
-        # User said: "C and D can be ignored".
-        weighted_sum_old = (temp_df['原档位_Num'] * temp_df['卷烟购进金额指标值']).sum()
-        weighted_sum_new = (temp_df['新档位_Num'] * temp_df['卷烟购进金额指标值']).sum()
-        
-        if weighted_sum_old != 0:
-            change_rate = (weighted_sum_new - weighted_sum_old) / weighted_sum_old
-        else:
-            change_rate = 0
-            
-        rule_d_pass = -0.05 <= change_rate <= 0.05
-        
-        # Small Rule E: Normal Distribution Check (Peak at 15, smooth tails)
-        # We can calculate the correlation between actual counts and ideal PDF counts
-        actual_counts = temp_df['新档位_Num'].value_counts().sort_index()
-        # Ensure all grades 1-30 are present
-        actual_vector = np.array([actual_counts.get(i, 0) for i in range(1, 31)])
-        
-        # Ideal vector (already computed weights)
-        x_range = np.arange(1, 31)
-        pdf_ideal = norm.pdf(x_range, loc=15, scale=7)
-        # Correlation
-        if np.std(actual_vector) > 0 and np.std(pdf_ideal) > 0:
-            corr = np.corrcoef(actual_vector, pdf_ideal)[0, 1]
-        else:
-            corr = 0
-            
-        rule_e_pass = corr > 0.8 # Threshold for "Good" distribution
-        
-        # Scoring
-        score = 0
-        
-        # 1. Mandatory Rules (Must satisfy)
-        # Big Rules (Percentages)
-        if rule_big: score += 1000000000
-        # Rule B: Up >= Down
-        if rule_b_pass: score += 1000000000
-        # Rule A Hard: Min count > 0
-        if rule_a_hard: score += 1000000000
-        
-        # 2. Priority Rules (Try to satisfy)
-        # Rule A Soft: Min count >= 1%
-        if rule_a_pass: score += 5000000
-        # Rule E: Normal Distribution
-        if rule_e_pass: score += 5000000
-        
-        # 3. Optimization Objectives
-        # Maximize correlation (Rule E fine-tuning)
-        score += (corr * 1000000)
-        
-        # Maximize Upgrade margin (Rule B fine-tuning)
-        score += (n_up - n_down)
-        
-        # Variance: Tie-breaker only (very small weight), or ignored.
-        # score -= (total_variance / 1000) 
-        
-        # Penalize if Mandatory Rules are not met
-        if not (rule_big and rule_b_pass and rule_a_hard):
-             score -= 10000000000 # Make it impossible to pick
-             
-        if score > best_score:
-            best_score = score
-            best_df = temp_df
-            best_metrics = {
-                'min_pct': min_pct, 'n_up': int(n_up), 'n_down': int(n_down),
-                'rule_b_pass': bool(rule_b_pass), 'rule_big': bool(rule_big),
-                'rule_d_pass': bool(rule_d_pass),
-                'change_rate': change_rate,
-                'total_variance': total_variance,
-                'corr': corr
-            }
+def optimize_grading(df, warm_start=None, tolerance=None, presorted=False):
+    """
+    Run optimization to find best shifts.
+    The grid of A/B/C/D shifts is scored by cut_search from the old grades
+    in score order; only the winning candidate is materialized. The
+    top candidates and the Pareto front come back in metrics['candidates']
+    (materialize one with assign_grades_by_percentiles + result_metrics).
+    warm_start: shifts of a previous run to search outward from (stops
+    early, see cut_search.warm_search); None searches the whole grid.
+    presorted: `df` already comes from sort_for_grading.
+    """
+    from . import cut_search
+    
+    ordered = df if presorted else sort_for_grading(df)
+    old_sorted = ordered['原档位_Num'].to_numpy()
+    grid_size = len(cut_search.shift_grid())
+    if warm_start:
+        if tolerance is None: tolerance = cut_search.WARM_TOLERANCE
+        best, evaluated = cut_search.warm_search(old_sorted, warm_start, tolerance=tolerance, skew=True)
+    else:
+        best, evaluated = cut_search.search(old_sorted, skew=True)
+    best_df = assign_grades_by_percentiles(ordered, best.shifts, skew=True, presorted=True)
+    
+    best_metrics = result_metrics(best_df, best.shifts)
+    best_metrics['search'] = {
+        'mode': 'warm' if warm_start else 'cold',
+        'seed': warm_start or None,
+        'evaluated': len(evaluated),
+        'cold_evaluations': grid_size,
+        'saved': grid_size - len(evaluated),
+    }
+    best_metrics['candidates'] = cut_search.candidate_set(evaluated)
+    
+    instrumentation.inc('grading_optimizer_runs_total', mode=best_metrics['search']['mode'])
+    instrumentation.inc('grading_optimizer_candidates_total', len(evaluated))
+    instrumentation.inc('grading_optimizer_evaluations_saved_total', grid_size - len(evaluated))
+    instrumentation.inc('grading_optimizer_candidates_passing_total',
+                        sum(c.metrics['mandatory_pass'] for c in evaluated))
             
     return best_df, best_metrics
 
-def generate_export_data(df, metrics=None):
+def result_metrics(graded, shifts):
+    """
+    Metrics reported for a percentile grading (stats_metrics) plus its
+    shifts. 'rule_stats' holds the per-grade arrays they come from, for the
+    summaries and the export to reuse.
+    """
+    from . import rules
+    
+    stats = rules.grade_stats(graded)
+    return {**stats_metrics(stats, shifts), 'rule_stats': stats}
+
+def stats_metrics(stats, shifts):
+    """Optimizer metrics from per-grade stats (rules.evaluate); out_of_core collects its own."""
+    from . import rules
+    
+    metrics = rules.evaluate(stats)
+    return {
+        'min_pct': metrics['min_pct'],
+        'n_up': metrics['n_up'], 'n_down': metrics['n_down'],
+        'rule_b_pass': metrics['rule_b_pass'], 'rule_big': metrics['rule_big'],
+        # Small Rules C/D are reported only (user: "C and D can be ignored")
+        'rule_d_pass': metrics['rule_d_pass'],
+        'change_rate': metrics['change_rate'],
+        'total_variance': metrics['total_variance'],
+        'corr': metrics['corr'],
+        'shifts': shifts,
+    }
+
+# Columns of the 明细表 export, in order
+DETAIL_COLUMNS = [
+    '许可证号', '原档位', '新档位', '档位编码', 
+    '卷烟购进金额指标值', '卷烟购进金额指标排名', 
+    '信用等级指标值', '信用等级指标得分', 
+    '专柜陈列得分', '摆放规则得分', '破损褪色得分', 
+    '主题陈列得分', '明码标价得分', 
+    '交易数据指标值', '交易数据指标得分', 
+    '消费环境得分', '营销线路', '所属区县', 
+    '卷烟购进金额得分', '卷烟非购进金额得分', 
+    '总分', '总分排名'
+]
+
+def detail_default(col):
+    """Value of a 明细表 column missing from the result: 0 for numbers, empty otherwise."""
+    return 0 if '得分' in col or '值' in col or '排名' in col else ''
+
+def generate_export_data(df, stats=None):
     """
     Generate the 3 DataFrames for the requested Excel format:
     1. 明细表
     2. 汇总表
     3. 规则校验
+    stats: rules.grade_stats of `df` saved with the result (computed if None).
     """
+    from . import rules
+    
     # --- 1. 明细表 ---
     # Required columns mapping/creation
     # '档位编码' -> assume it is the numeric grade
     df['档位编码'] = df['新档位_Num']
     
     # Ensure all required columns exist, fill with 0/empty if not
-    required_cols = [
-        '许可证号', '原档位', '新档位', '档位编码', 
-        '卷烟购进金额指标值', '卷烟购进金额指标排名', 
-        '信用等级指标值', '信用等级指标得分', 
-        '专柜陈列得分', '摆放规则得分', '破损褪色得分', 
-        '主题陈列得分', '明码标价得分', 
-        '交易数据指标值', '交易数据指标得分', 
-        '消费环境得分', '营销线路', '所属区县', 
-        '卷烟购进金额得分', '卷烟非购进金额得分', 
-        '总分', '总分排名'
-    ]
-    
-    for col in required_cols:
+    for col in DETAIL_COLUMNS:
         if col not in df.columns:
-            df[col] = 0 if '得分' in col or '值' in col or '排名' in col else ''
+            df[col] = detail_default(col)
             
-    detail_df = df[required_cols].copy()
-    
-    # --- 2. 汇总表 ---
-    summary_rows = []
-    total_cust = len(df)
-    
-    # Pre-calculate stats for "Old" grades (原档位)
-    # Note: '原档位_Num' should be available
-    old_stats = {}
-    if '原档位_Num' in df.columns:
-        for g in range(1, 31):
-            subset = df[df['原档位_Num'] == g]
-            if not subset.empty:
-                old_stats[g] = {
-                    'min': subset['总分'].min(),
-                    'max': subset['总分'].max(),
-                    'count': len(subset),
-                    'pct': len(subset) / total_cust
-                }
-            else:
-                old_stats[g] = {'min': 0, 'max': 0, 'count': 0, 'pct': 0}
-    
-    # Iterate for New Grades (30 down to 1)
-    for g in range(30, 0, -1):
-        g_cn = num_to_cn(g)
-        subset = df[df['新档位_Num'] == g]
-        
-        count = len(subset)
-        pct = count / total_cust if total_cust > 0 else 0
-        min_score = subset['总分'].min() if count > 0 else 0
-        max_score = subset['总分'].max() if count > 0 else 0
-        
-        # Upgrade/Downgrade logic
-        # Upgrade: New > Old. Since we are looking at specific New Grade g,
-        # we want to know how many people in this New Grade g came from a Lower Old Grade.
-        # Wait, the requirement asks for "升档人数" (Upgrade Count) per "客户类别" (Grade).
-        # This usually means: For customers currently in Grade X (New), how many were upgraded to get here?
-        # OR it could mean: For customers who were in Grade X (Old), how many upgraded?
-        # Given the table structure "分档后_..." comes before "升档...", it implies the row context is the "New Grade".
-        # Let's assume: Rows represent the New Grade buckets.
-        
-        # Customers in this new grade g
-        # Upgraded to here: Old < g
-        up_here = subset[subset['原档位_Num'] < g]
-        n_up = len(up_here)
-        p_up = n_up / count if count > 0 else 0
-        
-        # Downgraded to here: Old > g
-        down_here = subset[subset['原档位_Num'] > g]
-        n_down = len(down_here)
-        p_down = n_down / count if count > 0 else 0
-        
-        # Pre-tiering stats for the SAME grade number
-        # i.e. Statistics for Old Grade = g
-        pre_s = old_stats.get(g, {'min': 0, 'max': 0, 'count': 0, 'pct': 0})
-        
-        summary_rows.append({
-            '客户类别': g_cn,
-            '分档线': min_score,
-            '分档前_结果最小值': pre_s['min'],
-            '分档前_结果最大值': pre_s['max'],
-            '分档前_客户数': pre_s['count'],
-            '分档前_实际占比': pre_s['pct'],
-            '分档后_结果最小值': min_score,
-            '分档后_结果最大值': max_score,
-            '分档后_客户数': count,
-            '分档后_实际占比': pct,
-            '升档人数': n_up,
-            '升档比例': p_up,
-            '降档人数': n_down,
-            '降档比例': p_down
-        })
-        
-    summary_df = pd.DataFrame(summary_rows)
-    
-    # Format percentages
-    pct_cols = ['分档前_实际占比', '分档后_实际占比', '升档比例', '降档比例']
-    # We will keep them as floats for Excel to format, or string? 
-    # Let's keep as float, user can format in Excel, or we can format as string.
-    # The requirement example shows "9.10%", so string might be safer if we can't control Excel styles easily.
-    for col in pct_cols:
-        summary_df[col] = summary_df[col].apply(lambda x: f"{x:.2%}")
-        
-    # --- 3. 规则校验 ---
-    # Use metrics if provided, otherwise re-calculate simple ones
-    # If metrics is None, we should try to calculate them or set defaults
-    if metrics is None:
-        metrics = {}
-        # Try to calc simple ones if possible, or just default to 0/False
-        # For variance and change rate, we can calc them here if we want
-        
-        # Recalculate variance for reporting if missing
-        total_variance = 0
-        for g in range(1, 31):
-            g_subset = df[df['新档位_Num'] == g]
-            if len(g_subset) > 1:
-                var = g_subset['卷烟购进金额指标值'].var()
-                total_variance += var
-        metrics['total_variance'] = total_variance
-        
-        # Recalculate change rate
-        weighted_sum_old = (df['原档位_Num'] * df['卷烟购进金额指标值']).sum()
-        weighted_sum_new = (df['新档位_Num'] * df['卷烟购进金额指标值']).sum()
-        if weighted_sum_old != 0:
-            change_rate = (weighted_sum_new - weighted_sum_old) / weighted_sum_old
-        else:
-            change_rate = 0
-        metrics['change_rate'] = change_rate
-        metrics['rule_d_pass'] = -0.05 <= change_rate <= 0.05
-        
-        # Calculate correlation for Rule E
-        actual_counts = df['新档位_Num'].value_counts().sort_index()
-        actual_vector = np.array([actual_counts.get(i, 0) for i in range(1, 31)])
-        x_range = np.arange(1, 31)
-        pdf_ideal = norm.pdf(x_range, loc=15, scale=7)
-        if np.std(actual_vector) > 0 and np.std(pdf_ideal) > 0:
-            corr = np.corrcoef(actual_vector, pdf_ideal)[0, 1]
-        else:
-            corr = 0
-        metrics['corr'] = corr
-
-    rules_data = []
-    
-    # We can reconstruct the rule checks from the df if metrics not fully provided or to be safe
-    # But relying on metrics passed from optimize is better if available.
+    detail_df = df[DETAIL_COLUMNS].copy()
     
-    # Re-evaluating rules to ensure accuracy for the report
-    grade_counts = df['新档位_Num'].value_counts(normalize=True)
-    min_pct = grade_counts.min() if not grade_counts.empty else 0
-    
-    upgrades = df[df['新档位_Num'] > df['原档位_Num']]
-    downgrades = df[df['新档位_Num'] < df['原档位_Num']]
-    n_up = len(upgrades)
-    n_down = len(downgrades)
-    
-    def get_pct(start, end):
-        c = ((df['新档位_Num'] >= start) & (df['新档位_Num'] <= end)).sum()
-        return c / total_cust
-        
-    p26_30 = get_pct(26, 30)
-    p21_25 = get_pct(21, 25)
-    p16_20 = get_pct(16, 20)
-    p11_15 = get_pct(11, 15)
-    p1_10 = get_pct(1, 10)
-    
-    # Define Rules
-    rule_defs = [
-        ('大规则A(26-30档)', f'占比 {p26_30:.2%} (目标9%±0.1%)', 0.089 <= p26_30 <= 0.091),
-        ('大规则B(21-25档)', f'占比 {p21_25:.2%} (目标18%±0.1%)', 0.179 <= p21_25 <= 0.181),
-        ('大规则C(16-20档)', f'占比 {p16_20:.2%} (目标23%±0.1%)', 0.229 <= p16_20 <= 0.231),
-        ('大规则D(11-15档)', f'占比 {p11_15:.2%} (目标23%±0.1%)', 0.229 <= p11_15 <= 0.231),
-        ('大规则E(1-10档)', f'占比 {p1_10:.2%} (目标27%±0.1%)', 0.269 <= p1_10 <= 0.271),
-        ('小规则A(强制)', f'最小档位人数 {df["新档位_Num"].value_counts().min()} (必须>0)', min_pct > 0),
-        ('小规则A(优先)', f'最小档位占比 {min_pct:.2%} (建议>=1%)', min_pct >= 0.01),
-        ('小规则B(强制)', f'升档{n_up} vs 降档{n_down} (必须 升>=降)', n_up >= n_down),
-        ('小规则E(优先)', f'正态分布相关性 {metrics.get("corr", 0):.4f} (目标>0.8, 全局或区间正态)', metrics.get("corr", 0) > 0.8),
-        ('小规则C(参考)', f'总方差 {metrics.get("total_variance", 0):.2f} (忽略)', True),
-        ('小规则D(参考)', f'指标变化率 {metrics.get("change_rate", 0):.2%} (忽略)', True),
-    ]
-    
-    for name, content, passed in rule_defs:
-        rules_data.append({
-            '规则': name,
-            '内容': content,
-            '是否满足': '是' if passed else '否'
-        })
-        
-    rules_df = pd.DataFrame(rules_data)
+    # --- 2. 汇总表 / 3. 规则校验 ---
+    # Rows represent the New Grade buckets; 升档/降档 = customers in new grade g
+    # who came from a lower / higher old grade. 分档前 = old grade g.
+    if stats is None:
+        stats = rules.grade_stats(df)
+    summary_df = rules.summary_table(stats)
+    rules_df = rules.rules_table(rules.evaluate(stats))
     
     return detail_df, summary_df, rules_df
 
-def generate_summary(df):
-    """Generate summary dataframe for visualization (Keep existing for UI charts)."""
-    total_cust = len(df)
-    summary_rows = []
-    
-    for g in range(30, 0, -1):
-        g_cn = num_to_cn(g)
-        subset = df[df['新档位_Num'] == g]
-        count = len(subset)
-        pct = count / total_cust if total_cust > 0 else 0
-        
-        up = (subset['原档位_Num'] < g).sum()
-        down = (subset['原档位_Num'] > g).sum()
-        
-        min_score = subset['总分'].min() if count > 0 else 0
-        max_score = subset['总分'].max() if count > 0 else 0
-        
-        # Calculate Old Counts for this grade number
-        pre_count = len(df[df['原档位_Num'] == g])
-        
-        # Calculate Rates (as percentage of the new grade count)
-        # Avoid division by zero
-        up_rate = up / count if count > 0 else 0
-        down_rate = down / count if count > 0 else 0
-        
-        summary_rows.append({
-            'Grade': g,
-            'GradeName': g_cn,
-            'Count': int(count),
-            'PreCount': int(pre_count),
-            'Percentage': pct,
-            'Upgrades': int(up),
-            'Downgrades': int(down),
-            'UpgradeRate': float(up_rate),
-            'DowngradeRate': float(down_rate),
-            'MinScore': float(min_score),
-            'MaxScore': float(max_score)
-        })
-        
-    return pd.DataFrame(summary_rows)
+def generate_summary(df, stats=None):
+    """
+    Generate summary dataframe for visualization (Keep existing for UI charts).
+    stats: rules.grade_stats of `df` saved with the result (computed if None).
+    """
+    from . import rules
+    
+    if stats is None:
+        stats = rules.grade_stats(df)
+    r = rules.grade_rows(stats)
+    total_cust = stats['total']
+    count = r['count']
+    # Rates are a percentage of the new grade count (0 for empty grades)
+    safe_count = np.maximum(count, 1)
+    pct = count / total_cust if total_cust > 0 else np.zeros(len(count))
+    
+    return pd.DataFrame({
+        'Grade': r['grade'],
+        'GradeName': [num_to_cn(x) for x in r['grade']],
+        'Count': count,
+        'PreCount': r['old_count'],
+        'Percentage': pct,
+        'Upgrades': r['up'],
+        'Downgrades': r['down'],
+        'UpgradeRate': r['up'] / safe_count,
+        'DowngradeRate': r['down'] / safe_count,
+        'MinScore': r['new_min'],
+        'MaxScore': r['new_max']
+    })
 
 def generate_district_summary(df):
     """
@@ -592,26 +390,26 @@ def generate_district_summary(df):
     if '所属区县' not in df.columns:
         return []
         
-    districts = df['所属区县'].unique()
-    stats = []
+    codes, districts = pd.factorize(df['所属区县'])
+    n = len(districts)
+    new = df['新档位_Num'].to_numpy()
+    old = df['原档位_Num'].to_numpy()
     
-    for district in districts:
-        subset = df[df['所属区县'] == district]
-        total = len(subset)
-        if total == 0: continue
-        
-        # Upgrades: New > Old
-        up = (subset['新档位_Num'] > subset['原档位_Num']).sum()
-        # Downgrades: New < Old
-        down = (subset['新档位_Num'] < subset['原档位_Num']).sum()
-        
+    total = np.bincount(codes[codes >= 0], minlength=n)
+    # Upgrades: New > Old, Downgrades: New < Old
+    up = np.bincount(codes[(codes >= 0) & (new > old)], minlength=n)
+    down = np.bincount(codes[(codes >= 0) & (new < old)], minlength=n)
+    
+    stats = []
+    for district, t, u, d in zip(districts, total.tolist(), up.tolist(), down.tolist()):
+        if t == 0: continue
         stats.append({
             'District': str(district),
-            'Total': int(total),
-            'Upgrades': int(up),
-            'Downgrades': int(down),
-            'UpgradeRate': float(up / total),
-            'DowngradeRate': float(down / total)
+            'Total': t,
+            'Upgrades': u,
+            'Downgrades': d,
+            'UpgradeRate': u / t,
+            'DowngradeRate': d / t
         })
     
     # Sort by District name
@@ -625,30 +423,26 @@ def generate_district_grade_detail(df):
     if '所属区县' not in df.columns:
         return {}
         
-    districts = df['所属区县'].unique()
+    codes, districts = pd.factorize(df['所属区县'])
+    n = len(districts)
+    new = df['新档位_Num'].to_numpy(dtype=np.int64)
+    old = df['原档位_Num'].to_numpy()
+    
+    # One flat (district, grade) cell id per customer -> one bincount per measure
+    valid = (codes >= 0) & (new >= 1) & (new <= 30)
+    cell = codes * 31 + new
+    def cell_counts(mask):
+        return np.bincount(cell[valid & mask], minlength=n * 31).reshape(n, 31)[:, 1:]
+    count = cell_counts(True)
+    up = cell_counts(old < new)
+    down = cell_counts(old > new)
+    
+    grades = list(range(1, 31))
     detail = {}
-    
-    for district in districts:
-        district_data = []
-        d_subset = df[df['所属区县'] == district]
-        
-        # Iterate grades 1-30
-        for g in range(1, 31):
-            g_subset = d_subset[d_subset['新档位_Num'] == g]
-            count = len(g_subset)
-            
-            up = (g_subset['原档位_Num'] < g).sum()
-            down = (g_subset['原档位_Num'] > g).sum()
-            
-            district_data.append({
-                'Grade': g,
-                'Count': int(count),
-                'Upgrades': int(up),
-                'Downgrades': int(down)
-            })
-            
-        # Sort by Grade
-        district_data.sort(key=lambda x: x['Grade'])
-        detail[str(district)] = district_data
+    for i, district in enumerate(districts):
+        detail[str(district)] = [
+            {'Grade': g, 'Count': c, 'Upgrades': u, 'Downgrades': d}
+            for g, c, u, d in zip(grades, count[i].tolist(), up[i].tolist(), down[i].tolist())
+        ]
         
-    return detail
+    return detail
\ No newline at end of file
@@ -0,0 +1,191 @@
+"""
+Request and stage timing.
+
+    with instrumentation.span('calculate_metrics'):
+        ...
+    instrumentation.inc('grading_optimizer_candidates_total', 2401)
+
+Spans feed a per-stage histogram and the Server-Timing header of the
+current request; counters and histograms are exposed in Prometheus text
+format by /metrics. Metrics are per worker process (each uvicorn worker
+keeps its own registry).
+
+Set GRADING_METRICS=0 to disable: span() then returns a shared no-op
+context manager and the timing middleware is not installed.
+"""
+import contextlib
+import contextvars
+import os
+import threading
+import time
+
+ENABLED = os.environ.get("GRADING_METRICS", "1") != "0"
+
+# Seconds; chosen to cover cached previews (ms) up to full optimizer runs (minutes)
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+_NULL_SPAN = contextlib.nullcontext()
+# (name, seconds) spans of the request being served
+_request_spans = contextvars.ContextVar("request_spans", default=None)
+
+_HELP = {
+    "http_requests_total": ("counter", "HTTP requests served"),
+    "http_request_duration_seconds": ("histogram", "HTTP request latency"),
+    "grading_stage_duration_seconds": ("histogram", "Time spent in a grading pipeline stage"),
+    "grading_optimizer_runs_total": ("counter", "optimize_grading runs"),
+    "grading_optimizer_candidates_total": ("counter", "Shift candidates evaluated by the optimizer"),
+    "grading_optimizer_candidates_passing_total": ("counter", "Candidates passing all mandatory rules"),
+    "grading_optimizer_evaluations_saved_total": ("counter", "Candidates a warm-started search skipped compared with the full grid"),
+}
+
+
+class _Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}     # (name, labels) -> float
+        self._histograms = {}   # (name, labels) -> _Histogram
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            h = self._histograms.get(key)
+            if h is None:
+                h = self._histograms[key] = _Histogram()
+            h.observe(value)
+
+    def render(self):
+        """Prometheus text exposition format (0.0.4)."""
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items(), key=lambda kv: kv[0])
+            histograms = [(k, list(h.counts), h.sum, h.count) for k, h in histograms]
+
+        lines = []
+        seen = set()
+
+        def header(name):
+            if name not in seen:
+                seen.add(name)
+                kind, text = _HELP.get(name, ("untyped", name))
+                lines.append(f"# HELP {name} {text}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in counters:
+            header(name)
+            lines.append(f"{name}{_labels(labels)} {_num(value)}")
+        for (name, labels), counts, total, count in histograms:
+            header(name)
+            cumulative = 0
+            for bound, c in zip(BUCKETS, counts):
+                cumulative += c
+                lines.append(f"{name}_bucket{_labels(labels + (('le', _num(bound)),))} {cumulative}")
+            lines.append(f"{name}_bucket{_labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{_labels(labels)} {_num(total)}")
+            lines.append(f"{name}_count{_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+def _num(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    parts = []
+    for k, v in labels:
+        v = str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        parts.append(f'{k}="{v}"')
+    return "{" + ",".join(parts) + "}"
+
+
+registry = Registry()
+
+
+class _Span:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        registry.observe("grading_stage_duration_seconds", elapsed, stage=self.name)
+        spans = _request_spans.get()
+        if spans is not None:
+            spans.append((self.name, elapsed))
+        return False
+
+
+def span(name):
+    """Time a pipeline stage (no-op when metrics are disabled)."""
+    if not ENABLED:
+        return _NULL_SPAN
+    return _Span(name)
+
+
+def inc(name, value=1, **labels):
+    if ENABLED:
+        registry.inc(name, value, **labels)
+
+
+def server_timing(spans, total):
+    """Server-Timing header value; repeated stage names are summed."""
+    durations = {}
+    for name, seconds in spans:
+        durations[name] = durations.get(name, 0.0) + seconds
+    parts = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in durations.items()]
+    parts.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(parts)
+
+
+def install(app):
+    """Add the timing middleware to a FastAPI app (only when enabled)."""
+    if not ENABLED:
+        return
+
+    @app.middleware("http")
+    async def timing_middleware(request, call_next):
+        spans = []
+        token = _request_spans.set(spans)
+        start = time.perf_counter()
+        status = 500
+        try:
+            response = await call_next(request)
+            status = response.status_code
+        finally:
+            elapsed = time.perf_counter() - start
+            _request_spans.reset(token)
+            # Route template keeps label cardinality bounded
+            route = request.scope.get("route")
+            path = getattr(route, "path", None) or "unmatched"
+            registry.inc("http_requests_total", method=request.method, path=path, status=status)
+            registry.observe("http_request_duration_seconds", elapsed, method=request.method, path=path)
+        response.headers["Server-Timing"] = server_timing(spans, elapsed)
+        return response
@@ -1,14 +1,30 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException, Form
+from fastapi import FastAPI, UploadFile, File, HTTPException, Form, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, PlainTextResponse, Response, StreamingResponse
 from pydantic import BaseModel
 import pandas as pd
+import contextlib
 import io
+import logging
 import os
-from . import grading_utils
-from typing import Dict, List
+from . import delta_ingest, export_stream, grading_utils, instrumentation, memo, profiling, result_diff, result_query, result_store, rules
+from .instrumentation import span
+from .fast_json import FastJSONResponse, json_response, records
+from typing import Dict, List, Optional
 
-app = FastAPI()
+logger = logging.getLogger(__name__)
+
+# Startup warm-up preloads the data / result workbooks only up to this size
+# (MiB) each, so big provinces don't hold back worker readiness; 0 skips them
+WARMUP_MAX_BYTES = int(float(os.environ.get("GRADING_WARMUP_MAX_MB", 20)) * 1024 * 1024)
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    if os.environ.get("GRADING_WARMUP", "1") != "0":
+        warm_up()
+    yield
+
+app = FastAPI(default_response_class=FastJSONResponse, lifespan=lifespan)
 
 # Allow CORS for frontend
 app.add_middleware(
@@ -17,53 +33,275 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Let the browser devtools show the per-stage timings / profile ids
+    expose_headers=["Server-Timing", "X-Profile-Id"],
 )
 
+# Request timing middleware + Server-Timing header (GRADING_METRICS=0 disables)
+instrumentation.install(app)
+
 # In-memory storage (replace with DB or file storage for production)
 # For simplicity, we save current dataframe to disk
 # Use absolute paths relative to this script to avoid CWD issues
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DATA_FILE = os.path.join(BASE_DIR, "current_data.xlsx")
-RESULT_FILE = os.path.join(BASE_DIR, "result_data.xlsx")
-COCKPIT_FILE = os.path.join(BASE_DIR, "cockpit_data.xlsx")
+# GRADING_DATA_DIR moves the working files elsewhere (benchmarks, load tests)
+DATA_DIR = os.environ.get("GRADING_DATA_DIR", BASE_DIR)
+DATA_FILE = os.path.join(DATA_DIR, "current_data.xlsx")
+RESULT_FILE = os.path.join(DATA_DIR, "result_data.xlsx")
+COCKPIT_FILE = os.path.join(DATA_DIR, "cockpit_data.xlsx")
+# Shifts + metrics chosen by the last auto-grading, with the result version they produced
+OPTIMIZER_FILE = os.path.join(DATA_DIR, "optimizer_state.json")
+# About the current result: data version it was graded from (stale once the
+# data changes) and its rules.grade_stats (summaries / rule checks / export)
+RESULT_META_FILE = os.path.join(DATA_DIR, "result_meta.json")
+# Snapshots of the last saved results (GRADING_RESULT_HISTORY, default 20) for /api/result-diff
+HISTORY_DIR = os.path.join(DATA_DIR, "result_history")
+# Request profiles taken on demand (X-Profile header / POST /api/profiling)
+PROFILE_DIR = os.path.join(DATA_DIR, "profiles")
+
+profiling.install(app, PROFILE_DIR)
+
+# Per-worker caches of the files above, reloaded when the file changes on disk
+data_cache = result_store.FrameCache(DATA_FILE, name="data")
+result_cache = result_store.FrameCache(RESULT_FILE, name="result")
+
+# Summaries of threshold gradings, keyed by (source version, thresholds)
+grading_memo = memo.MemoCache()
+data_cache.on_change(lambda version: grading_memo.invalidate("data", version))
+result_cache.on_change(lambda version: grading_memo.invalidate("result", version))
+
+result_history = result_store.ResultHistory(HISTORY_DIR)
+result_diffs = result_diff.DiffCache()
+
+# Cockpit database engine, created once per worker so its connection pool is reused
+_cockpit_engine = None
+
+def get_cockpit_engine():
+    """
+    SQLAlchemy engine for the cockpit MySQL database (created on first use).
+    GRADING_COCKPIT_DB_URL points it at another database instead, e.g.
+    sqlite:////tmp/cockpit.db for load tests (tables grading_data / grading_line).
+    """
+    global _cockpit_engine
+    if _cockpit_engine is not None:
+        return _cockpit_engine
+    
+    from sqlalchemy import create_engine
+    import urllib.parse
+    
+    db_url = os.environ.get("GRADING_COCKPIT_DB_URL")
+    if db_url:
+        _cockpit_engine = create_engine(db_url, pool_pre_ping=True)
+        return _cockpit_engine
+    
+    # DB Config
+    DB_USER = "ycdb"
+    DB_PASSWORD = "Jxyc1234!"
+    DB_HOST = "192.168.113.14"
+    DB_PORT = "3307"
+    DB_NAME = "selfdata"
+    
+    # URL Encode password to handle special characters safely
+    encoded_password = urllib.parse.quote_plus(DB_PASSWORD)
+    
+    # SQLAlchemy connection string
+    # Added charset to match JDBC params like allowPublicKeyRetrieval
+    db_url = f"mysql+pymysql://{DB_USER}:{encoded_password}@{DB_HOST}:{DB_PORT}/{DB_NAME}?charset=utf8mb4"
+    
+    # Remove connect_args for now as it might cause issues with some drivers/versions
+    # or pymysql might not support it directly in create_engine this way.
+    # But 'allow_public_key_retrieval' is a valid connection arg for pymysql.
+    # The error "Connection.__init__() got an unexpected keyword argument 'allow_public_key_retrieval'"
+    # suggests that the installed pymysql version or the way sqlalchemy passes it is not compatible.
+    # 
+    # Fix: Pass it via the query string in the URL or check pymysql version.
+    # Or simply remove it if not strictly needed (usually needed for caching_sha2_password with RSA).
+    # Alternatively, try passing it in the query string of the URL if supported by pymysql.
+    # db_url = f"...?charset=utf8mb4&allow_public_key_retrieval=true"
+    
+    # Let's try adding it to the URL query parameters instead of connect_args
+    # Pymysql might not accept it as a kwarg in __init__ but maybe as part of the connection dict?
+    # Actually, for pymysql, it is often not needed if we are not using SSL or specific auth plugins?
+    # But DBeaver used it.
+    # Let's try to remove it first. If it fails with "Public Key Retrieval is not allowed", then we add it back differently.
+    
+    _cockpit_engine = create_engine(db_url, pool_pre_ping=True)
+    return _cockpit_engine
+
+def _small_enough(path):
+    return os.path.exists(path) and os.path.getsize(path) <= WARMUP_MAX_BYTES
+
+def warm_up():
+    """
+    Build what the first requests of a fresh worker would otherwise pay for:
+    the cockpit DB engine object (imports SQLAlchemy + the driver; no
+    connection is opened until the first upload), the openpyxl reader and,
+    for workbooks up to GRADING_WARMUP_MAX_MB, the cached data/result frames
+    and the result index. Runs at startup unless GRADING_WARMUP=0.
+    """
+    with span("warm_up"):
+        import openpyxl  # noqa: F401  (pandas imports it lazily on first read_excel)
+        try:
+            get_cockpit_engine()
+        except Exception as e:
+            # DB driver missing: cockpit upload will report it, grading still works
+            logger.warning("warm-up: cockpit engine not created: %s", e)
+        if _small_enough(DATA_FILE):
+            data_cache.get()
+        if _small_enough(RESULT_FILE):
+            result_cache.derived('query_index', result_query.ResultIndex)
+
+def scoring_state(df, version):
+    """calculate_metrics(data) + rank structures; cached per data version (data_cache.derived)."""
+    with span("calculate_metrics"):
+        return delta_ingest.ScoringState(grading_utils.calculate_metrics(df))
+
+def scored_data():
+    """(data version, calculate_metrics of the uploaded data)."""
+    version, _ = data_cache.get()
+    return version, data_cache.derived('scoring', scoring_state).scored
+
+def grading_order(df, version):
+    """Scored data in grading order; cached per data version."""
+    return grading_utils.sort_for_grading(data_cache.derived('scoring', scoring_state).scored)
+
+def save_result(df, stats, source):
+    """
+    Save a graded frame as the current result, with the data version it
+    came from and its rule stats, and keep its snapshot in the history.
+    source: 'auto', 'manual' or 'candidate'.
+    """
+    snapshot = result_diff.snapshot(df)
+    version = result_cache.save(df, derived={"diff_snapshot": snapshot})
+    data_version = result_store.file_version(DATA_FILE) if data_cache.exists() else None
+    result_store.write_json(RESULT_META_FILE, {
+        "result_version": version, "data_version": data_version, "rule_stats": stats
+    })
+    result_history.record(version, snapshot, source=source, data_version=data_version)
+    return version
+
+def result_snapshot(version):
+    """Diff snapshot of result `version` (KeyError if it is neither current nor kept)."""
+    if result_cache.exists():
+        current, _ = result_cache.get()
+        if version == current:
+            return result_cache.derived("diff_snapshot", lambda df, v: result_diff.snapshot(df))
+    return result_history.load(version)
+
+def result_rule_stats(version):
+    """rules.grade_stats saved with result `version`, or None."""
+    meta = result_store.read_json(RESULT_META_FILE)
+    if meta and meta.get("result_version") == version:
+        return meta.get("rule_stats")
+    return None
+
+def result_stale():
+    """True if the data was uploaded / patched after the current result was graded."""
+    source = result_store.read_json(RESULT_META_FILE)
+    if not source or not data_cache.exists():
+        # Results saved before sources were recorded: nothing to compare with
+        return False
+    return source["data_version"] != result_store.file_version(DATA_FILE)
+
+def current_result():
+    """True if there is a result that still matches the data."""
+    return result_cache.exists() and not result_stale()
+
+def summary_payload(df, stats=None):
+    """
+    Summary, district stats, district detail and rule checks of a graded
+    frame. `stats`: its rules.grade_stats if already known; the rules and
+    the grade summary come from it, and it is returned as rule_stats
+    (per-grade counts, up/down, score ranges) for saving.
+    """
+    with span("summaries"):
+        if stats is None:
+            stats = rules.grade_stats(df)
+        return {
+            "rules": records(rules.rules_table(rules.evaluate(stats))),
+            "rule_stats": stats,
+            "summary": records(grading_utils.generate_summary(df, stats)),
+            "district_stats": grading_utils.generate_district_summary(df),
+            "district_detail": grading_utils.generate_district_grade_detail(df)
+        }
 
 @app.post("/api/upload")
 async def upload_file(file: UploadFile = File(...)):
     try:
         content = await file.read()
         # Validate Excel
-        df = pd.read_excel(io.BytesIO(content))
+        with span("read_excel"):
+            df = pd.read_excel(io.BytesIO(content))
         # Save locally
-        df.to_excel(DATA_FILE, index=False)
+        data_cache.save(df)
         return {"message": "Upload successful", "rows": len(df), "columns": df.columns.tolist()}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
+@app.post("/api/upload-delta")
+async def upload_delta(file: UploadFile = File(...)):
+    """
+    Apply corrected / new customer rows (keyed by 许可证号) to the uploaded
+    data. Only those rows are scored again and the ranks are updated
+    incrementally; results graded before become stale.
+    """
+    if not data_cache.exists():
+        raise HTTPException(status_code=400, detail="No data uploaded")
+    try:
+        content = await file.read()
+        with span("read_excel"):
+            delta = pd.read_excel(io.BytesIO(content))
+        _, df = data_cache.get()
+        state = data_cache.derived('scoring', scoring_state)
+        with span("delta_upsert"):
+            new_df, new_state, stats = state.upsert(df, delta)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    # The scored frame of the new version is already known: no calculate_metrics on next use
+    data_cache.save(new_df, derived={'scoring': new_state})
+    return {"message": "Delta applied", **stats, "stale_results": result_cache.exists()}
+
+class AutoGradeRequest(BaseModel):
+    # Search outward from the shifts of the last auto-grading instead of the full grid
+    warm_start: bool = False
+    # Warm start: stop once a ring of candidates improves the score by no more than this
+    tolerance: Optional[float] = None
+
 @app.post("/api/auto-grade")
-async def auto_grade():
-    if not os.path.exists(DATA_FILE):
+async def auto_grade(http_request: Request, request: Optional[AutoGradeRequest] = None):
+    if not data_cache.exists():
         raise HTTPException(status_code=400, detail="No data uploaded")
+    options = request or AutoGradeRequest()
     
     try:
-        df = pd.read_excel(DATA_FILE)
-        df_calc = grading_utils.calculate_metrics(df)
-        best_df, metrics = grading_utils.optimize_grading(df_calc)
+        seed = None
+        if options.warm_start:
+            # Nothing saved yet: full search
+            state = result_store.read_json(OPTIMIZER_FILE)
+            seed = state["shifts"] if state else None
         
-        # Save result
-        best_df.to_excel(RESULT_FILE, index=False)
+        data_version, _ = data_cache.get()
+        ordered = data_cache.derived('grading_order', grading_order)
+        with span("optimize_grading"):
+            best_df, metrics = grading_utils.optimize_grading(
+                ordered, warm_start=seed, tolerance=options.tolerance, presorted=True)
         
-        # Generate summary
-        summary_df = grading_utils.generate_summary(best_df)
-        district_stats = grading_utils.generate_district_summary(best_df)
-        district_detail = grading_utils.generate_district_grade_detail(best_df)
+        # Save result, and the solution next period's warm start begins from
+        stats = metrics.pop("rule_stats")
+        version = save_result(best_df, stats, "auto")
+        result_store.write_json(OPTIMIZER_FILE, {
+            "data_version": data_version, "result_version": version,
+            "shifts": metrics["shifts"], "metrics": metrics,
+            "candidates": metrics["candidates"], "selected": 0
+        })
         
-        return {
+        # Generate summary
+        return json_response(http_request, {
             "metrics": metrics,
-            "summary": summary_df.to_dict(orient="records"),
-            "district_stats": district_stats,
-            "district_detail": district_detail,
-            "top50": best_df.head(50).fillna("").to_dict(orient="records")
-        }
+            **summary_payload(best_df, stats),
+            "top50": records(best_df.head(50), fill="")
+        })
     except Exception as e:
         import traceback
         traceback.print_exc()
@@ -73,78 +311,324 @@ class ManualGradeRequest(BaseModel):
     thresholds: Dict[int, float]
 
 @app.post("/api/manual-grade")
-async def manual_grade(request: ManualGradeRequest):
-    if not os.path.exists(RESULT_FILE):
-        # Fallback to DATA_FILE if exists and run calc
-        if os.path.exists(DATA_FILE):
-            df = pd.read_excel(DATA_FILE)
-            df = grading_utils.calculate_metrics(df)
+async def manual_grade(request: ManualGradeRequest, http_request: Request):
+    if not current_result():
+        # Fallback to DATA_FILE if exists (no result, or the data changed since)
+        if data_cache.exists():
+            scope = "data"
+            version, df = scored_data()
         else:
             raise HTTPException(status_code=400, detail="No data available")
     else:
         # Load existing result to keep other columns
-        df = pd.read_excel(RESULT_FILE)
+        scope = "result"
+        version, df = result_cache.get()
     
     try:
         # Re-assign based on thresholds
         # Note: We need '总分' which should be in df if loaded from RESULT_FILE or calculated
         if '总分' not in df.columns:
-             df = grading_utils.calculate_metrics(df)
+            with span("calculate_metrics"):
+                df = grading_utils.calculate_metrics(df)
              
-        new_df = grading_utils.assign_grades_by_thresholds(df, request.thresholds)
+        with span("assign_grades"):
+            new_df = grading_utils.assign_grades_by_thresholds(df, request.thresholds)
         
-        # Save new result
-        new_df.to_excel(RESULT_FILE, index=False)
+        # Reuse the summaries if these thresholds were just previewed
+        key = memo.threshold_key(request.thresholds)
+        payload = grading_memo.get(scope, version, key)
+        if payload is None:
+            payload = summary_payload(new_df)
         
-        summary_df = grading_utils.generate_summary(new_df)
-        district_stats = grading_utils.generate_district_summary(new_df)
-        district_detail = grading_utils.generate_district_grade_detail(new_df)
+        # Save new result
+        save_result(new_df, payload["rule_stats"], "manual")
         
-        return {
-            "summary": summary_df.to_dict(orient="records"),
-            "district_stats": district_stats,
-            "district_detail": district_detail,
-            "top50": new_df.head(50).fillna("").to_dict(orient="records")
-        }
+        return json_response(http_request, {
+            **payload,
+            "top50": records(new_df.head(50), fill="")
+        })
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/api/preview-manual-grade")
-async def preview_manual_grade(request: ManualGradeRequest):
+async def preview_manual_grade(request: ManualGradeRequest, http_request: Request):
     """
     Preview grading results without saving to file.
     Used for real-time updates in frontend.
     """
-    if not os.path.exists(RESULT_FILE) and not os.path.exists(DATA_FILE):
+    if not result_cache.exists() and not data_cache.exists():
         raise HTTPException(status_code=400, detail="No data available")
         
     try:
-        if os.path.exists(RESULT_FILE):
-            df = pd.read_excel(RESULT_FILE)
+        if current_result():
+            scope = "result"
+            version, df = result_cache.get()
         else:
-            df = pd.read_excel(DATA_FILE)
-            
-        if '总分' not in df.columns:
-             df = grading_utils.calculate_metrics(df)
-             
-        new_df = grading_utils.assign_grades_by_thresholds(df, request.thresholds)
-        summary_df = grading_utils.generate_summary(new_df)
-        district_stats = grading_utils.generate_district_summary(new_df)
-        district_detail = grading_utils.generate_district_grade_detail(new_df)
+            scope = "data"
+            version, df = scored_data()
         
-        return {
-            "summary": summary_df.to_dict(orient="records"),
-            "district_stats": district_stats,
-            "district_detail": district_detail
-        }
+        key = memo.threshold_key(request.thresholds)
+        body = grading_memo.get(scope, version, key, encoded=True)
+        if body is None:
+            if '总分' not in df.columns:
+                with span("calculate_metrics"):
+                    df = grading_utils.calculate_metrics(df)
+                 
+            with span("assign_grades"):
+                new_df = grading_utils.assign_grades_by_thresholds(df, request.thresholds)
+            with span("json_encode"):
+                body = grading_memo.put(scope, version, key, summary_payload(new_df))
+        
+        return json_response(http_request, body=body)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+def candidate_state():
+    """Saved optimizer state, if its candidates belong to the current data."""
+    state = result_store.read_json(OPTIMIZER_FILE)
+    if not state or "candidates" not in state:
+        raise HTTPException(status_code=400, detail="No candidates. Please run auto-grading first.")
+    if not data_cache.exists() or state.get("data_version") != data_cache.get()[0]:
+        raise HTTPException(status_code=409, detail="Data changed since auto-grading. Please run it again.")
+    return state
+
+@app.get("/api/candidates")
+async def list_candidates():
+    """
+    Candidates of the last auto-grading: the top ones by optimizer score
+    (index 0 = the chosen solution) followed by the rest of the Pareto
+    front over (corr, n_up - n_down, min_pct).
+    """
+    state = candidate_state()
+    return {"candidates": state["candidates"], "selected": state.get("selected", 0)}
+
+@app.post("/api/candidates/{index}")
+async def select_candidate(index: int, http_request: Request, save: bool = False):
+    """
+    Grade the data with candidate `index` of /api/candidates.
+    Returns the same payload as auto-grade; save=true also makes it the
+    current result (download, browsing, cockpit upload).
+    """
+    state = candidate_state()
+    if not 0 <= index < len(state["candidates"]):
+        raise HTTPException(status_code=404, detail=f"No candidate {index}")
+    candidate = state["candidates"][index]
+    
+    try:
+        version, _ = data_cache.get()
+        key = ("candidate",) + tuple(sorted(candidate["shifts"].items()))
+        payload = grading_memo.get("data", version, key)
+        body = None
+        if payload is None or save:
+            ordered = data_cache.derived('grading_order', grading_order)
+            with span("assign_grades"):
+                new_df = grading_utils.assign_grades_by_percentiles(
+                    ordered, candidate["shifts"], skew=True, presorted=True)
+        if payload is None:
+            metrics = grading_utils.result_metrics(new_df, candidate["shifts"])
+            payload = {
+                "metrics": metrics,
+                **summary_payload(new_df, metrics.pop("rule_stats")),
+                "top50": records(new_df.head(50), fill="")
+            }
+            body = grading_memo.put("data", version, key, payload)
+        
+        if save:
+            state["result_version"] = save_result(new_df, payload["rule_stats"], "candidate")
+            state["shifts"] = candidate["shifts"]
+            state["metrics"] = {**state["metrics"], **payload["metrics"]}
+            state["selected"] = index
+            result_store.write_json(OPTIMIZER_FILE, state)
+        
+        return json_response(http_request, payload, body=body)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/rules")
+async def result_rules():
+    """大规则/小规则 checks of the current result, from the stats saved with it."""
+    if not result_cache.exists():
+        raise HTTPException(status_code=400, detail="No result generated. Please run auto-grading first.")
+    version, df = result_cache.get()
+    stats = result_rule_stats(version)
+    if stats is None:
+        stats = rules.grade_stats(df)
+    metrics = rules.evaluate(stats)
+    return {"rules": records(rules.rules_table(metrics)), "metrics": metrics, "stale": result_stale()}
+
+class ProfilingRequest(BaseModel):
+    requests: int = 1
+    mode: str = "sample"
+    # Only profile requests under this path, e.g. /api/auto-grade
+    path: Optional[str] = None
+
+def check_profile_token(http_request):
+    if not profiling.enabled():
+        raise HTTPException(status_code=403, detail="Profiling is disabled: set GRADING_PROFILE_TOKEN")
+    if not profiling.authorized(http_request.headers.get("x-profile-token")):
+        raise HTTPException(status_code=403, detail="Invalid or missing X-Profile-Token")
+
+@app.get("/api/profiling")
+async def profiling_state(http_request: Request):
+    """Armed profiling of this worker and the stored profiles."""
+    check_profile_token(http_request)
+    return {"armed": profiling.profiler.armed(), "profiles": profiling.profiler.profiles()}
+
+@app.post("/api/profiling")
+async def arm_profiling(request: ProfilingRequest, http_request: Request):
+    """
+    Profile the next `requests` requests served by this worker (mode:
+    sample | cprofile). Each uvicorn worker is armed separately; to profile
+    one specific request send it with an `X-Profile: sample` header instead.
+    """
+    check_profile_token(http_request)
+    try:
+        profiling.profiler.arm(request.requests, request.mode, request.path)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"armed": profiling.profiler.armed()}
+
+@app.delete("/api/profiling")
+async def disarm_profiling(http_request: Request):
+    check_profile_token(http_request)
+    profiling.profiler.disarm()
+    return {"armed": None}
+
+@app.get("/api/profiling/{profile_id}")
+async def profile_summary(profile_id: str, http_request: Request):
+    """Per-function totals of a profile (grading_utils / cut_search / rules under "grading")."""
+    check_profile_token(http_request)
+    try:
+        return profiling.profiler.summary(profile_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Unknown profile: {profile_id}")
+
+@app.get("/api/profiling/{profile_id}/download")
+async def download_profile(profile_id: str, http_request: Request):
+    """Folded stacks (sample: flamegraph.pl / speedscope) or pstats file (cprofile: snakeviz)."""
+    check_profile_token(http_request)
+    try:
+        path, media_type, filename = profiling.profiler.profile_file(profile_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Unknown profile: {profile_id}")
+    return FileResponse(path, filename=filename, media_type=media_type)
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Prometheus metrics of this worker process."""
+    if not instrumentation.ENABLED:
+        return PlainTextResponse("# metrics disabled (GRADING_METRICS=0)\n")
+    return PlainTextResponse(instrumentation.registry.render(),
+                             media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/api/cache-stats")
+async def cache_stats():
+    """Hit rate and size of the threshold grading memo cache."""
+    return {"grading_memo": grading_memo.stats()}
+
+@app.get("/api/results")
+async def browse_results(
+    http_request: Request,
+    sort: Optional[str] = None,
+    order: str = "asc",
+    cursor: Optional[str] = None,
+    limit: int = result_query.DEFAULT_LIMIT,
+    columns: Optional[List[str]] = Query(None),
+    district: Optional[List[str]] = Query(None),
+    route: Optional[List[str]] = Query(None),
+    grade: Optional[List[int]] = Query(None),
+    movement: Optional[List[str]] = Query(None),
+):
+    """
+    Page through the current graded result.
+    Sort on any column, filter by district / route / new grade / movement
+    (up, down, same). Rows come back column-wise: data[i] holds the values
+    of columns[i]. Pass next_cursor back as `cursor` to get the next page.
+    """
+    if not result_cache.exists():
+        raise HTTPException(status_code=400, detail="No result generated. Please run auto-grading first.")
+
+    try:
+        filters = result_query.normalize_filters(district, route, grade, movement)
+        index = result_cache.derived('query_index', result_query.ResultIndex)
+        page = result_query.query(index, sort=sort, order=order, cursor=cursor,
+                                  limit=limit, columns=columns, filters=filters)
+    except result_query.CursorExpired as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    # Data changed (upload / delta) after this result was graded
+    page["stale"] = result_stale()
+    return json_response(http_request, page)
+
+@app.get("/api/result-versions")
+async def result_versions():
+    """Result versions kept for /api/result-diff, newest first."""
+    current = result_store.file_version(RESULT_FILE) if result_cache.exists() else None
+    return {"current": current, "versions": result_history.versions()}
+
+def previous_version(other, source=None):
+    """Newest kept version saved before `other` (optionally only from `source`), or None."""
+    other_meta = result_history.meta(other)
+    for meta in result_history.versions():
+        if meta["version"] == other or (source and meta.get("source") != source):
+            continue
+        if other_meta is None or meta["saved_at"] < other_meta["saved_at"]:
+            return meta["version"]
+    return None
+
+@app.get("/api/result-diff")
+async def diff_results(
+    http_request: Request,
+    base: Optional[str] = None,
+    other: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = result_query.DEFAULT_LIMIT,
+    district: Optional[List[str]] = Query(None),
+    movement: Optional[List[str]] = Query(None),
+):
+    """
+    Compare two result versions, matched on 许可证号.
+    other: defaults to the current result; base: a version, 'auto' (the last
+    auto-grading before `other`) or, by default, the result saved before it.
+    Returns the 30x30 grade transition matrix (transition[i][j]: customers
+    moved from grade i+1 to j+1), movement counts per district and a page of
+    the changed customers (filter by district / movement: up, down, added,
+    removed; pass next_cursor back as `cursor`).
+    """
+    if other is None:
+        if not result_cache.exists():
+            raise HTTPException(status_code=400, detail="No result generated. Please run auto-grading first.")
+        other = result_store.file_version(RESULT_FILE)
+    if base is None or base == "auto":
+        base = previous_version(other, source=base)
+        if base is None:
+            raise HTTPException(status_code=400, detail="No earlier result to compare with.")
+
+    try:
+        with span("result_diff"):
+            diff = result_diffs.get(base, other, result_snapshot)
+            changes = diff.changes(cursor=cursor, limit=limit, district=district, movement=movement)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=f"Unknown result version: {e.args[0]}")
+    except result_query.CursorExpired as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return json_response(http_request, {
+        "base": base,
+        "other": other,
+        "counts": diff.counts,
+        "transition": diff.transition.tolist(),
+        "districts": diff.districts(),
+        "changes": changes,
+    })
+
 @app.get("/api/download")
 async def download_result():
-    if not os.path.exists(RESULT_FILE):
+    if not result_cache.exists():
         # If no result file, check if we have data to generate it on the fly
-        if os.path.exists(DATA_FILE):
+        if data_cache.exists():
             # Try to run a quick calc to generate it? 
             # Or just return error. Better to return error if user hasn't run grading.
             pass
@@ -152,44 +636,77 @@ async def download_result():
     
     try:
         # Create a clean excel with Summary and Detail
-        df = pd.read_excel(RESULT_FILE)
-        
-        # Use the new export function
-        # Calculate metrics for rule validation display
-        # We need to re-run metrics calculation or save metrics during auto-grade
-        # For now, let's re-run optimization *just* to get metrics if possible, or 
-        # better yet, modify generate_export_data to calc metrics internally if not provided.
-        # It already does some calc internally.
+        # (copy: generate_export_data adds columns to the frame it is given)
+        version, df = result_cache.get()
+        df = df.copy()
         
-        # We need to pass metrics if we want strict rule reporting (like failed districts list)
-        # But we didn't save metrics to a file. 
-        # Let's rely on internal recalculation in generate_export_data for now.
-        # It handles missing metrics gracefully.
+        # Summary and rule checks come from the stats saved with the result
+        # (recomputed only for results saved before they were recorded)
+        stats = result_rule_stats(version)
         
-        detail_df, summary_df, rules_df = grading_utils.generate_export_data(df)
+        with span("generate_export_data"):
+            detail_df, summary_df, rules_df = grading_utils.generate_export_data(df, stats)
         
         output = io.BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
+        with span("write_xlsx"), pd.ExcelWriter(output, engine='openpyxl') as writer:
             detail_df.to_excel(writer, sheet_name='明细表', index=False)
             summary_df.to_excel(writer, sheet_name='汇总表', index=False)
             rules_df.to_excel(writer, sheet_name='规则校验', index=False)
         
-        output.seek(0)
-        
-        # Save to a temp file to serve
-        # Use absolute path for download_path
-        download_path = os.path.join(BASE_DIR, "download_result.xlsx")
-        
-        # Write bytes
-        with open(download_path, "wb") as f:
-            f.write(output.getvalue())
-            
-        return FileResponse(download_path, filename="grading_result.xlsx", media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+        # Served from memory: a shared file on disk would be overwritten by
+        # concurrent downloads while being sent
+        return Response(output.getvalue(), media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                        headers={"Content-Disposition": 'attachment; filename="grading_result.xlsx"'})
     except Exception as e:
         import traceback
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Download failed: {str(e)}")
 
+@app.get("/api/export/detail")
+async def export_detail(
+    fmt: str = Query("csv", alias="format"),
+    columns: Optional[List[str]] = Query(None),
+    district: Optional[List[str]] = Query(None),
+    gzip: bool = False,
+):
+    """
+    Stream the 明细表 of the current result as CSV or NDJSON (format=csv|ndjson),
+    optionally only some columns / districts, gzip-compressed with gzip=true.
+    """
+    if not result_cache.exists():
+        raise HTTPException(status_code=400, detail="No result generated. Please run auto-grading first.")
+    if fmt not in export_stream.FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {list(export_stream.FORMATS)}")
+
+    try:
+        columns = export_stream.select_columns(columns)
+        filters = result_query.normalize_filters(district=district)
+        table = result_cache.derived('export_columns', export_stream.DetailColumns)
+        rows = None
+        if filters:
+            index = result_cache.derived('query_index', result_query.ResultIndex)
+            if index.version != table.version:
+                raise HTTPException(status_code=409, detail="The result changed during the request, please retry.")
+            rows = index.view(filters=filters)
+    except KeyError as e:
+        raise HTTPException(status_code=400, detail=f"Result has no column for filter {e}")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    media_type, ext = export_stream.FORMATS[fmt]
+    filename = f"grading_detail.{ext}"
+    if gzip:
+        media_type, filename = "application/gzip", filename + ".gz"
+    return StreamingResponse(
+        export_stream.stream(table, fmt, columns, rows, compress=gzip),
+        media_type=media_type,
+        headers={
+            "Content-Disposition": f'attachment; filename="{filename}"',
+            "X-Result-Version": table.version,
+            "X-Result-Stale": "true" if result_stale() else "false",
+        },
+    )
+
 @app.post("/api/cockpit-upload")
 async def cockpit_upload(file: UploadFile = File(...), date: str = Form(...)):
     try:
@@ -198,48 +715,15 @@ async def cockpit_upload(file: UploadFile = File(...), date: str = Form(...)):
         # 1. Save to local file (optional backup)
         excel_data = io.BytesIO(content)
         # Use pandas to verify it's a valid excel and get sheets
-        xl = pd.ExcelFile(excel_data)
+        with span("cockpit_open_workbook"):
+            xl = pd.ExcelFile(excel_data)
         
         # 2. Insert into MySQL
-        from sqlalchemy import create_engine
-        import urllib.parse
-        
-        # DB Config
-        DB_USER = "ycdb"
-        DB_PASSWORD = "Jxyc1234!"
-        DB_HOST = "192.168.113.14"
-        DB_PORT = "3307"
-        DB_NAME = "selfdata"
-        
-        # URL Encode password to handle special characters safely
-        encoded_password = urllib.parse.quote_plus(DB_PASSWORD)
-        
-        # SQLAlchemy connection string
-        # Added charset to match JDBC params like allowPublicKeyRetrieval
-        db_url = f"mysql+pymysql://{DB_USER}:{encoded_password}@{DB_HOST}:{DB_PORT}/{DB_NAME}?charset=utf8mb4"
-        
-        # Remove connect_args for now as it might cause issues with some drivers/versions
-        # or pymysql might not support it directly in create_engine this way.
-        # But 'allow_public_key_retrieval' is a valid connection arg for pymysql.
-        # The error "Connection.__init__() got an unexpected keyword argument 'allow_public_key_retrieval'"
-        # suggests that the installed pymysql version or the way sqlalchemy passes it is not compatible.
-        # 
-        # Fix: Pass it via the query string in the URL or check pymysql version.
-        # Or simply remove it if not strictly needed (usually needed for caching_sha2_password with RSA).
-        # Alternatively, try passing it in the query string of the URL if supported by pymysql.
-        # db_url = f"...?charset=utf8mb4&allow_public_key_retrieval=true"
-        
-        # Let's try adding it to the URL query parameters instead of connect_args
-        # Pymysql might not accept it as a kwarg in __init__ but maybe as part of the connection dict?
-        # Actually, for pymysql, it is often not needed if we are not using SSL or specific auth plugins?
-        # But DBeaver used it.
-        # Let's try to remove it first. If it fails with "Public Key Retrieval is not allowed", then we add it back differently.
-        
-        engine = create_engine(db_url)
+        engine = get_cockpit_engine()
         
         # --- 0. Delete existing data for the selected date (Idempotency) ---
         from sqlalchemy import text
-        with engine.begin() as conn:
+        with span("cockpit_db_delete"), engine.begin() as conn:
              # Delete from grading_data
              conn.execute(text("DELETE FROM grading_data WHERE date_str = :date"), {"date": date})
              # Delete from grading_line
@@ -252,7 +736,8 @@ async def cockpit_upload(file: UploadFile = File(...), date: str = Form(...)):
         
         # --- Process 明细表 -> grading_data ---
         if '明细表' in xl.sheet_names:
-            df_detail = pd.read_excel(excel_data, sheet_name='明细表')
+            with span("cockpit_read_detail"):
+                df_detail = pd.read_excel(excel_data, sheet_name='明细表')
             
             # Map columns from Excel to DB
             # Excel Columns: 许可证号, 原档位, 新档位, 档位编码, 卷烟购进金额指标值, ...
@@ -306,11 +791,13 @@ async def cockpit_upload(file: UploadFile = File(...), date: str = Form(...)):
             # This significantly reduces the number of queries (questions).
             
             chunk_size = 1000 # Insert 1000 rows per query
-            df_to_db_detail.to_sql('grading_data', con=engine, if_exists='append', index=False, chunksize=chunk_size, method='multi')
+            with span("cockpit_db_insert_detail"):
+                df_to_db_detail.to_sql('grading_data', con=engine, if_exists='append', index=False, chunksize=chunk_size, method='multi')
             
         # --- Process 汇总表 -> grading_line ---
         if '汇总表' in xl.sheet_names:
-            df_summary = pd.read_excel(excel_data, sheet_name='汇总表')
+            with span("cockpit_read_summary"):
+                df_summary = pd.read_excel(excel_data, sheet_name='汇总表')
             
             # Map columns
             # Excel: 客户类别(Grade Name), 分档线(Min Score)
@@ -336,7 +823,8 @@ async def cockpit_upload(file: UploadFile = File(...), date: str = Form(...)):
             df_to_db_summary = df_to_db_summary[final_cols_summary]
             
             # Use multi insert here too just in case
-            df_to_db_summary.to_sql('grading_line', con=engine, if_exists='append', index=False, method='multi')
+            with span("cockpit_db_insert_summary"):
+                df_to_db_summary.to_sql('grading_line', con=engine, if_exists='append', index=False, method='multi')
 
         return {"message": "上传数据成功！"}
     except Exception as e:
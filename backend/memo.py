@@ -0,0 +1,102 @@
+"""
+Bounded memo cache for grading aggregates.
+
+Entries are keyed by (scope, key) where scope names the source frame
+('result' or 'data') and key is e.g. a normalized threshold tuple. Each
+scope remembers the version of the frame its entries were computed from;
+seeing a new version drops the stale entries of that scope, so a new
+upload or a saved result can never serve old aggregates.
+Eviction is LRU, bounded both by entry count and by encoded payload size.
+Each entry keeps its JSON encoding too: put() encodes the value once,
+and hits can be served as-is (json_response(..., body=...)).
+"""
+import threading
+from collections import OrderedDict
+
+from .fast_json import dumps
+
+MAX_ENTRIES = 128
+MAX_BYTES = 64 * 1024 * 1024
+
+
+def threshold_key(thresholds):
+    """
+    Canonical form of a manual threshold dict: ((grade, min_score), ...)
+    for grades 2-30, sorted. Grades assign_grades_by_thresholds ignores
+    are left out so they don't split the cache.
+    """
+    items = {int(k): float(v) for k, v in thresholds.items()}
+    return tuple(sorted((g, v) for g, v in items.items() if 2 <= g <= 30))
+
+
+class MemoCache:
+    def __init__(self, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # (scope, key) -> (value, encoded JSON)
+        self._versions = {}             # scope -> version of its entries
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, scope, version, key, encoded=False):
+        """The cached value (its JSON bytes if `encoded`), or None."""
+        with self._lock:
+            self._check_version(scope, version)
+            entry = self._entries.get((scope, key))
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end((scope, key))
+            return entry[1] if encoded else entry[0]
+
+    def put(self, scope, version, key, value):
+        """Cache `value`; returns its JSON encoding."""
+        body = dumps(value)
+        if len(body) > self.max_bytes:
+            return body
+        with self._lock:
+            self._check_version(scope, version)
+            old = self._entries.pop((scope, key), None)
+            if old is not None:
+                self._bytes -= len(old[1])
+            self._entries[(scope, key)] = (value, body)
+            self._bytes += len(body)
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+                self.evictions += 1
+        return body
+
+    def invalidate(self, scope, version):
+        """Drop entries of `scope` not computed from `version`."""
+        with self._lock:
+            self._check_version(scope, version)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+            }
+
+    def _check_version(self, scope, version):
+        if self._versions.get(scope) == version:
+            return
+        stale = [k for k in self._entries if k[0] == scope]
+        for k in stale:
+            self._bytes -= len(self._entries.pop(k)[1])
+        self.invalidations += len(stale)
+        self._versions[scope] = version
@@ -0,0 +1,559 @@
+"""
+Out-of-core grading for datasets that don't fit in memory (a province of
+several million customers).
+
+    python -m backend.out_of_core customers.csv graded.csv --chunk-rows 200000
+
+Produces the same columns and values as calculate_metrics +
+optimize_grading, while only ever holding about one chunk of rows:
+
+1. ingest   - stream the input (CSV, or xlsx via openpyxl read-only) in
+              chunks, compute the row-local scores (calculate_row_scores),
+              append the numeric columns to flat files read back as
+              np.memmap, keep each chunk's rows for the final output, and
+              write a sorted run of its purchase amounts.
+2. ranks    - the sorted runs are merged once into one sorted file;
+              卷烟购进金额指标排名 (method='min') = 1 + number of larger
+              amounts, counted by binary search in it.
+3. ordering - histogram-partitioned external sort of (总分 desc,
+              卷烟购进金额指标值 desc, row) -- the order
+              assign_grades_by_percentiles grades in. Value bins of 总分
+              are merged into partitions of about one chunk; larger
+              partitions (NaN scores, long ties) are split again by
+              总分, then amount, then into row-ordered slices. Pieces are
+              sorted in memory one at a time, which also yields 总分排名
+              (carried across pieces for ties) and each row's position.
+4. search   - cut_search over the memory-mapped old grades in that order.
+5. output   - new grade of every row from its position, written chunk by
+              chunk in input order (CSV); the metrics come from rules.evaluate
+              over per-grade stats collected in one pass (sorted_stats).
+
+Work files live in `workdir` (a temporary directory by default).
+"""
+import argparse
+import json
+import os
+import pickle
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from . import cut_search, grading_utils, rules
+from .instrumentation import span
+
+CHUNK_ROWS = 200_000
+# Value bins of 总分 per expected partition; more bins = partitions closer to CHUNK_ROWS
+BINS_PER_PARTITION = 16
+
+_KEY_DTYPE = np.dtype([('total', '<f8'), ('amount', '<f8'), ('row', '<i8')])
+
+
+# --- input ---
+
+def iter_input_chunks(path, chunk_rows=CHUNK_ROWS):
+    """DataFrames of at most `chunk_rows` rows read from a CSV or xlsx file."""
+    ext = os.path.splitext(path)[1].lower()
+    if ext in ('.csv', '.txt'):
+        yield from pd.read_csv(path, chunksize=chunk_rows)
+    elif ext in ('.xlsx', '.xlsm'):
+        yield from _iter_xlsx(path, chunk_rows)
+    else:
+        raise ValueError(f"Unsupported input format: {ext} (use .csv or .xlsx)")
+
+
+def _iter_xlsx(path, chunk_rows):
+    from openpyxl import load_workbook
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = wb.active.iter_rows(values_only=True)
+        header = [str(h) if h is not None else '' for h in next(rows)]
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= chunk_rows:
+                yield pd.DataFrame(batch, columns=header)
+                batch = []
+        if batch:
+            yield pd.DataFrame(batch, columns=header)
+    finally:
+        wb.close()
+
+
+# --- column files ---
+
+class ColumnFile:
+    """Append-only flat binary column, read back as an np.memmap."""
+
+    def __init__(self, path, dtype):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self._f = None
+
+    def append(self, values):
+        if self._f is None:
+            self._f = open(self.path, 'ab')
+        self._f.write(np.ascontiguousarray(values, dtype=self.dtype).tobytes())
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+    def create(self, length):
+        """Preallocate `length` zeros and return them writable."""
+        self.close()
+        if length == 0:
+            return np.zeros(0, dtype=self.dtype)
+        return np.memmap(self.path, dtype=self.dtype, mode='w+', shape=(length,))
+
+    def open(self, mode='r'):
+        self.close()
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+            return np.zeros(0, dtype=self.dtype)
+        return np.memmap(self.path, dtype=self.dtype, mode=mode)
+
+
+class Workspace:
+    def __init__(self, workdir):
+        self.dir = workdir
+        os.makedirs(os.path.join(workdir, 'chunks'), exist_ok=True)
+        os.makedirs(os.path.join(workdir, 'runs'), exist_ok=True)
+        os.makedirs(os.path.join(workdir, 'parts'), exist_ok=True)
+
+    def column(self, name, dtype):
+        return ColumnFile(os.path.join(self.dir, f"{name}.bin"), dtype)
+
+    def run(self, name, i, dtype):
+        return ColumnFile(os.path.join(self.dir, 'runs', f"{name}_{i:05d}.bin"), dtype)
+
+    def part(self, label):
+        return ColumnFile(os.path.join(self.dir, 'parts', f"part_{label}.bin"), _KEY_DTYPE)
+
+    def chunk_path(self, i):
+        return os.path.join(self.dir, 'chunks', f"chunk_{i:05d}.pkl")
+
+
+def _slices(n, chunk_rows):
+    for c0 in range(0, n, chunk_rows):
+        yield c0, min(n, c0 + chunk_rows)
+
+
+# --- stages ---
+
+def ingest(path, ws, chunk_rows):
+    """Stage 1. Returns (input columns, row count, chunk row counts)."""
+    amount_col = ws.column('amount', 'f8')
+    nonpurchase_col = ws.column('nonpurchase', 'f8')
+    old_col = ws.column('old', 'i4')
+    input_cols = None
+    chunk_sizes = []
+    for i, chunk in enumerate(iter_input_chunks(path, chunk_rows)):
+        if input_cols is None:
+            input_cols = list(chunk.columns)
+        chunk = grading_utils.calculate_row_scores(chunk.reset_index(drop=True))
+        amount = chunk['卷烟购进金额指标值'].to_numpy(dtype=float)
+        amount_col.append(amount)
+        nonpurchase_col.append(chunk['卷烟非购进金额得分'].to_numpy(dtype=float))
+        old_col.append(chunk['原档位_Num'].to_numpy())
+        run = ws.run('amount', i, 'f8')
+        run.append(np.sort(amount[~np.isnan(amount)]))
+        run.close()
+        with open(ws.chunk_path(i), 'wb') as f:
+            pickle.dump(chunk, f, protocol=pickle.HIGHEST_PROTOCOL)
+        chunk_sizes.append(len(chunk))
+    for col in (amount_col, nonpurchase_col, old_col):
+        col.close()
+    return input_cols or [], sum(chunk_sizes), chunk_sizes
+
+
+def _merge_runs(runs, out, chunk_rows):
+    """
+    k-way merge of sorted runs into the ColumnFile `out`, reading about
+    `chunk_rows` values at a time across all runs. Every buffered value up
+    to the smallest buffer end is final, so each round writes at least one
+    whole buffer.
+    """
+    pos = [0] * len(runs)
+    buffer_rows = max(1, chunk_rows // max(1, len(runs)))
+    while True:
+        heads = [(i, run[pos[i]:pos[i] + buffer_rows]) for i, run in enumerate(runs) if pos[i] < len(run)]
+        if not heads:
+            break
+        bound = min(h[-1] for _, h in heads)
+        taken = []
+        for i, h in heads:
+            c = int(np.searchsorted(h, bound, side='right'))
+            taken.append(h[:c])
+            pos[i] += c
+        out.append(np.sort(np.concatenate(taken)))
+    out.close()
+
+
+def purchase_scores(ws, n, n_chunks, chunk_rows):
+    """Stage 2: 卷烟购进金额指标排名 / 卷烟购进金额得分 / 总分."""
+    amount = ws.column('amount', 'f8').open()
+    nonpurchase = ws.column('nonpurchase', 'f8').open()
+    merged_col = ws.column('amount_merged', 'f8')
+    _merge_runs([ws.run('amount', i, 'f8').open() for i in range(n_chunks)], merged_col, chunk_rows)
+    for i in range(n_chunks):
+        os.remove(ws.run('amount', i, 'f8').path)
+    merged = merged_col.open()
+    rank_col = ws.column('amount_rank', 'f8')
+    score_col = ws.column('amount_score', 'f8')
+    total_col = ws.column('total', 'f8')
+    for c0, c1 in _slices(n, chunk_rows):
+        v = np.asarray(amount[c0:c1])
+        # rank(ascending=False, method='min') = 1 + count of strictly larger values
+        rank = len(merged) - np.searchsorted(merged, v, side='right') + 1.0
+        rank[np.isnan(v)] = np.nan
+        score = (2 - rank / n) * 40
+        rank_col.append(rank)
+        score_col.append(score)
+        total_col.append(score + nonpurchase[c0:c1])
+    for col in (rank_col, score_col, total_col):
+        col.close()
+
+
+def _value_range(values):
+    """(min, max, NaN count) over the arrays of `values()`."""
+    lo, hi, nan = np.inf, -np.inf, 0
+    for v in values():
+        missing = np.isnan(v)
+        nan += int(missing.sum())
+        v = v[~missing]
+        if len(v):
+            lo, hi = min(lo, v.min()), max(hi, v.max())
+    return lo, hi, nan
+
+
+def _partition_bounds(values, lo, hi, m, chunk_rows):
+    """
+    Descending lower bounds splitting the non-NaN `values()` (within
+    [lo, hi], m in all) into ranges of about `chunk_rows` values; a
+    partition holds the values above its bound, up to the previous one.
+    """
+    if not lo < hi:
+        return np.zeros(0)
+    n_bins = max(1, BINS_PER_PARTITION * -(-m // chunk_rows))
+    edges = np.linspace(lo, hi, n_bins + 1)
+    cuts = []
+    if len(np.unique(edges)) > n_bins:
+        hist = np.zeros(n_bins, dtype=np.int64)
+        for v in values():
+            hist += np.histogram(v[~np.isnan(v)], bins=edges)[0]
+        # Greedily merge bins from the top value down into partitions
+        acc = 0
+        for b in range(n_bins - 1, 0, -1):
+            acc += hist[b]
+            if acc >= chunk_rows:
+                cuts.append(edges[b])
+                acc = 0
+    if not cuts:
+        # One bin holds everything, or the bins are below float resolution:
+        # split at the median of the first values instead
+        cuts.append(_pivot(values, hi))
+    return np.array(cuts)
+
+
+def _pivot(values, hi):
+    """Median of the first non-NaN `values()`, below `hi` so both sides are non-empty."""
+    for v in values():
+        v = v[~np.isnan(v)]
+        if len(v):
+            cut = np.percentile(v, 50, method='lower')
+            return cut if cut < hi else np.nextafter(hi, -np.inf)
+
+
+def _scatter(pieces, field, lower, parts):
+    """
+    Append the records of `pieces` to `parts` by `field`: parts[p] for the
+    values between lower[p] and lower[p - 1], the last two parts for
+    values below the last bound and NaN. Records keep their order.
+    """
+    n_parts = len(parts)
+    for keys in pieces:
+        v = keys[field]
+        pid = np.searchsorted(-lower, -v, side='right')  # lower is descending
+        pid[np.isnan(v)] = n_parts - 1
+        order = np.argsort(pid, kind='stable')
+        bounds = np.searchsorted(pid[order], np.arange(n_parts + 1))
+        for p in range(n_parts):
+            if bounds[p + 1] > bounds[p]:
+                parts[p].append(keys[order[bounds[p]:bounds[p + 1]]])
+    for part in parts:
+        part.close()
+
+
+def _sorted_pieces(ws, part, label, chunk_rows):
+    """
+    Records of a partition file in grading order, in arrays of at most
+    `chunk_rows`. A larger partition (NaN totals, a long run of equal
+    总分, a dense score range) is partitioned again by 总分, then within
+    one 总分 by purchase amount; records equal on both are in row order in
+    the file already and are read back in slices.
+    """
+    keys = part.open()
+    m = len(keys)
+    if m <= chunk_rows:
+        if m:
+            keys = np.array(keys)
+            # sort_values(['总分', '卷烟购进金额指标值'], ascending=False): NaN last, ties by row
+            yield keys[np.lexsort((keys['row'], -keys['amount'], -keys['total']))]
+            os.remove(part.path)
+        return
+
+    def pieces():
+        for c0, c1 in _slices(m, chunk_rows):
+            yield np.array(keys[c0:c1])
+
+    for field in ('total', 'amount'):
+        def values():
+            for c0, c1 in _slices(m, chunk_rows):
+                yield np.asarray(keys[field][c0:c1])
+        lo, hi, nan = _value_range(values)
+        if nan < m and (nan or lo < hi):
+            break
+    else:
+        yield from pieces()
+        os.remove(part.path)
+        return
+
+    lower = _partition_bounds(values, lo, hi, m, chunk_rows)
+    labels = [f"{label}_{j:03d}" for j in range(len(lower) + 2)]
+    subparts = [ws.part(sub) for sub in labels]
+    _scatter(pieces(), field, lower, subparts)
+    del keys
+    os.remove(part.path)
+    for sub, sub_label in zip(subparts, labels):
+        yield from _sorted_pieces(ws, sub, sub_label, chunk_rows)
+
+
+def order_and_rank(ws, n, chunk_rows):
+    """
+    Stage 3: position of every row in grading order, 总分排名, and the old
+    grades / purchase amounts laid out in that order. Returns the largest
+    number of records sorted in memory at once (at most `chunk_rows`).
+    """
+    total = ws.column('total', 'f8').open()
+    amount = ws.column('amount', 'f8').open()
+
+    def totals():
+        for c0, c1 in _slices(n, chunk_rows):
+            yield np.asarray(total[c0:c1])
+
+    def pieces():
+        for c0, c1 in _slices(n, chunk_rows):
+            keys = np.empty(c1 - c0, dtype=_KEY_DTYPE)
+            keys['total'] = total[c0:c1]
+            keys['amount'] = amount[c0:c1]
+            keys['row'] = np.arange(c0, c1)
+            yield keys
+
+    lo, hi, _ = _value_range(totals)
+    lower = _partition_bounds(totals, lo, hi, n, chunk_rows)
+    # + everything below the last cut, + NaN totals
+    labels = [f"{i:05d}" for i in range(len(lower) + 2)]
+    parts = [ws.part(label) for label in labels]
+    # Scatter (total, amount, row) records into partitions, best scores first
+    _scatter(pieces(), 'total', lower, parts)
+
+    old = ws.column('old', 'i4').open()
+    position = ws.column('position', 'i8').create(n)
+    total_rank = ws.column('total_rank', 'f8').create(n)
+    old_sorted = ws.column('old_sorted', 'i4').create(n)
+    amount_sorted = ws.column('amount_sorted', 'f8').create(n)
+
+    offset = 0
+    largest = 0
+    # A run of equal 总分 may span pieces: its value and first position carry over
+    prev_total, prev_start = np.nan, 0
+    for part, label in zip(parts, labels):
+        for keys in _sorted_pieces(ws, part, label, chunk_rows):
+            m = len(keys)
+            largest = max(largest, m)
+            rows = keys['row']
+            t = keys['total']
+            # rank(ascending=False, method='min'): 1 + position of the first equal score
+            first = np.ones(m, dtype=bool)
+            first[1:] = t[1:] != t[:-1]
+            starts = np.where(first, offset + np.arange(m), 0)
+            if t[0] == prev_total:
+                starts[0] = prev_start
+            run_start = np.maximum.accumulate(starts)
+            rank = run_start + 1.0
+            rank[np.isnan(t)] = np.nan
+            prev_total, prev_start = t[-1], run_start[-1]
+
+            position[rows] = offset + np.arange(m)
+            total_rank[rows] = rank
+            old_sorted[offset:offset + m] = old[rows]
+            amount_sorted[offset:offset + m] = keys['amount']
+            offset += m
+
+    for arr in (position, total_rank, old_sorted, amount_sorted):
+        if isinstance(arr, np.memmap):
+            arr.flush()
+    return largest
+
+
+def sorted_stats(ws, n, layout, chunk_rows):
+    """
+    The rules.grade_stats arrays rules.evaluate needs (counts, up/down,
+    purchase amount count / M2 per grade, weighted sums), in one pass over
+    the rows in grading order.
+    """
+    old_sorted = ws.column('old_sorted', 'i4').open()
+    amount_sorted = ws.column('amount_sorted', 'f8').open()
+    ends = np.array([e for _, _, e in layout])
+    grades = np.array([g for g, _, _ in layout])
+
+    counts = np.zeros(rules.GRADES, dtype=np.int64)
+    up = np.zeros(rules.GRADES, dtype=np.int64)
+    down = np.zeros(rules.GRADES, dtype=np.int64)
+    # Per-grade count / mean / M2 combined across chunks (Chan et al.)
+    cnt = np.zeros(rules.GRADES)
+    mean = np.zeros(rules.GRADES)
+    m2 = np.zeros(rules.GRADES)
+    weighted_old = 0.0
+    weighted_new = 0.0
+    for c0, c1 in _slices(n, chunk_rows):
+        x = np.asarray(amount_sorted[c0:c1])
+        old = np.asarray(old_sorted[c0:c1])
+        g_new = grades[np.searchsorted(ends, np.arange(c0, c1), side='right')]
+        counts += np.bincount(g_new, minlength=rules.GRADES)
+        up += np.bincount(g_new[g_new > old], minlength=rules.GRADES)
+        down += np.bincount(g_new[g_new < old], minlength=rules.GRADES)
+        ok = ~np.isnan(x)
+        weighted_old += np.sum(old[ok] * x[ok])
+        weighted_new += np.sum(g_new[ok] * x[ok])
+        g, x = g_new[ok], x[ok]
+        c_cnt = np.bincount(g, minlength=rules.GRADES).astype(float)
+        c_sum = np.bincount(g, weights=x, minlength=rules.GRADES)
+        c_mean = np.divide(c_sum, c_cnt, out=np.zeros(rules.GRADES), where=c_cnt > 0)
+        c_m2 = np.bincount(g, weights=(x - c_mean[g]) ** 2, minlength=rules.GRADES)
+        tot = cnt + c_cnt
+        delta = c_mean - mean
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(tot > 0, mean + delta * c_cnt / tot, 0)
+            m2 = np.where(tot > 0, m2 + c_m2 + delta ** 2 * cnt * c_cnt / tot, 0)
+        cnt = tot
+
+    return {
+        'total': n,
+        'counts': counts.tolist(), 'up': up.tolist(), 'down': down.tolist(),
+        'amount_n': cnt.astype(np.int64).tolist(), 'amount_m2': m2.tolist(),
+        'weighted_old': float(weighted_old), 'weighted_new': float(weighted_new),
+    }
+
+
+def write_output(ws, input_cols, chunk_sizes, layout, output_path):
+    """Stage 5: graded rows in input order, calculate_metrics column layout."""
+    position = ws.column('position', 'i8').open()
+    rank = ws.column('amount_rank', 'f8').open()
+    score = ws.column('amount_score', 'f8').open()
+    total = ws.column('total', 'f8').open()
+    total_rank = ws.column('total_rank', 'f8').open()
+    ends = np.array([e for _, _, e in layout])
+    grades = np.array([g for g, _, _ in layout])
+
+    header = True
+    r0 = 0
+    for i, size in enumerate(chunk_sizes):
+        with open(ws.chunk_path(i), 'rb') as f:
+            chunk = pickle.load(f)
+        r1 = r0 + size
+        chunk['卷烟购进金额指标排名'] = rank[r0:r1]
+        chunk['卷烟购进金额得分'] = score[r0:r1]
+        chunk['总分'] = total[r0:r1]
+        chunk['总分排名'] = total_rank[r0:r1]
+        cols = input_cols + [c for c in grading_utils.METRIC_COLS if c not in input_cols]
+        chunk = chunk[cols]
+        chunk['新档位_Num'] = grades[np.searchsorted(ends, position[r0:r1], side='right')]
+        chunk['新档位'] = chunk['新档位_Num'].map(grading_utils.num_to_cn)
+        chunk.to_csv(output_path, mode='w' if header else 'a', header=header, index=False)
+        header = False
+        r0 = r1
+
+
+def grade_file(input_path, output_path, workdir=None, chunk_rows=CHUNK_ROWS, keep_workdir=False,
+               warm_start=None, tolerance=cut_search.WARM_TOLERANCE):
+    """
+    Grade `input_path` out of core and write the graded rows to
+    `output_path` (CSV). Returns the optimizer metrics (same keys as
+    optimize_grading) plus the row count. `warm_start`: shifts of a
+    previous run, as in optimize_grading.
+    """
+    own_dir = workdir is None
+    if own_dir:
+        workdir = tempfile.mkdtemp(prefix='grading-ooc-')
+    ws = Workspace(workdir)
+    try:
+        with span("ooc_ingest"):
+            input_cols, n, chunk_sizes = ingest(input_path, ws, chunk_rows)
+        if n == 0:
+            raise ValueError("Input has no rows")
+        with span("ooc_purchase_rank"):
+            purchase_scores(ws, n, len(chunk_sizes), chunk_rows)
+        with span("ooc_order_and_rank"):
+            order_and_rank(ws, n, chunk_rows)
+        with span("ooc_cut_search"):
+            old_sorted = ws.column('old_sorted', 'i4').open()
+            if warm_start:
+                best, evaluated = cut_search.warm_search(old_sorted, warm_start, tolerance=tolerance,
+                                                         skew=True, chunk_rows=chunk_rows)
+            else:
+                best, evaluated = cut_search.search(old_sorted, skew=True, chunk_rows=chunk_rows)
+            layout = [tuple(int(v) for v in row) for row in best.layout]
+        with span("ooc_metrics"):
+            metrics = grading_utils.stats_metrics(sorted_stats(ws, n, layout, chunk_rows), best.shifts)
+        with span("ooc_write_output"):
+            write_output(ws, input_cols, chunk_sizes, layout, output_path)
+    finally:
+        if own_dir and not keep_workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        **metrics,
+        'search': {
+            'mode': 'warm' if warm_start else 'cold',
+            'seed': warm_start or None,
+            'evaluated': len(evaluated),
+            'cold_evaluations': len(cut_search.shift_grid()),
+            'saved': len(cut_search.shift_grid()) - len(evaluated),
+        },
+        'candidates': cut_search.candidate_set(evaluated),
+        'rows': n,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Grade a large customer file out of core")
+    parser.add_argument('input', help="customer table (.csv or .xlsx)")
+    parser.add_argument('output', help="graded rows (.csv)")
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS)
+    parser.add_argument('--workdir', help="directory for work files (default: temporary)")
+    parser.add_argument('--keep-workdir', action='store_true')
+    parser.add_argument('--metrics', help="also write the metrics as JSON to this file")
+    parser.add_argument('--warm-start', help="metrics JSON of a previous run: search from its shifts")
+    parser.add_argument('--tolerance', type=float, default=cut_search.WARM_TOLERANCE,
+                        help="warm start: stop once a ring improves the score by no more than this")
+    args = parser.parse_args()
+
+    warm_start = None
+    if args.warm_start:
+        with open(args.warm_start, encoding='utf-8') as f:
+            warm_start = json.load(f)['shifts']
+    metrics = grade_file(args.input, args.output, workdir=args.workdir,
+                         chunk_rows=args.chunk_rows, keep_workdir=args.keep_workdir,
+                         warm_start=warm_start, tolerance=args.tolerance)
+    text = json.dumps(metrics, ensure_ascii=False, indent=2, default=float)
+    print(text)
+    if args.metrics:
+        with open(args.metrics, 'w', encoding='utf-8') as f:
+            f.write(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,311 @@
+"""
+On-demand profiling of API requests.
+
+Off unless asked for, and then only for the requests concerned: the ASGI
+middleware checks one integer and the request headers before handing the
+request on untouched. A request is profiled when
+  - it carries `X-Profile: sample` (or `cprofile`), or
+  - the next N requests of the worker (optionally only those under a
+    path, e.g. /api/auto-grade) were armed with POST /api/profiling.
+
+Modes:
+  sample    a thread samples the stack of the thread serving the request
+            every GRADING_PROFILE_INTERVAL seconds (default 5 ms); saved as
+            folded stacks (input of flamegraph.pl, speedscope, inferno)
+  cprofile  deterministic cProfile of the request; saved as a pstats .prof
+            file (snakeviz, flameprof)
+Both keep per-function totals, with the grading code (GRADING_MODULES)
+listed separately. Profiles go to a directory shared by the workers; the
+newest PROFILE_KEEP are kept. The response of a profiled request carries
+its id in X-Profile-Id.
+
+Disabled unless GRADING_PROFILE_TOKEN is set: the X-Profile header and the
+profiling API then require a matching X-Profile-Token header. (The server
+usually sits behind a reverse proxy, so the client address can't tell
+local requests apart.)
+
+Async endpoints run on the worker's event loop, so a profile also sees
+whatever else the loop serves while the request runs.
+"""
+import cProfile
+import hmac
+import itertools
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+
+from .result_store import entry_path, list_entries, read_json, remove_entries, write_json
+
+INTERVAL = float(os.environ.get("GRADING_PROFILE_INTERVAL", 0.005))
+TOKEN = os.environ.get("GRADING_PROFILE_TOKEN")
+MODES = ('sample', 'cprofile')
+# Modules whose functions are listed separately ("grading" in the summary)
+GRADING_MODULES = ('grading_utils', 'cut_search', 'rules')
+PROFILE_KEEP = 20
+# Functions listed in a summary (all grading functions are always listed)
+TOP_FUNCTIONS = 200
+# Requests under this path are never profiled (the profiling API itself)
+API_PATH = '/api/profiling'
+
+# profile file per mode: (extension, download media type)
+FILES = {
+    'sample': ('folded', 'text/plain; charset=utf-8'),
+    'cprofile': ('prof', 'application/octet-stream'),
+}
+
+_HEADER = b'x-profile'
+_TOKEN_HEADER = b'x-profile-token'
+
+
+def enabled():
+    return TOKEN is not None
+
+
+def authorized(token):
+    """True if profiling is enabled and `token` (X-Profile-Token) matches."""
+    return TOKEN is not None and token is not None and hmac.compare_digest(token, TOKEN)
+
+
+def _label(frame):
+    code = frame.f_code
+    return f"{frame.f_globals.get('__name__', '?')}:{getattr(code, 'co_qualname', code.co_name)}"
+
+
+def _is_grading(function):
+    return function.split(':', 1)[0].rsplit('.', 1)[-1] in GRADING_MODULES
+
+
+class _Sampling:
+    """Stacks of one thread, sampled from a background thread."""
+
+    def __init__(self, thread_id, interval=INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_label(frame))
+                frame = frame.f_back
+            if stack:
+                self.stacks[tuple(reversed(stack))] += 1
+
+    def totals(self, duration):
+        """Per-function self / inclusive time, estimated from the sample counts."""
+        samples = sum(self.stacks.values())
+        per_sample = duration / samples if samples else 0.0
+        own, total = Counter(), Counter()
+        for stack, n in self.stacks.items():
+            own[stack[-1]] += n
+            for function in set(stack):
+                total[function] += n
+        return [{'function': f, 'samples': total[f], 'self_s': own[f] * per_sample,
+                 'total_s': total[f] * per_sample}
+                for f in sorted(total, key=total.get, reverse=True)]
+
+    def write(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, n in self.stacks.items():
+                f.write(f"{';'.join(stack)} {n}\n")
+
+
+class _Deterministic:
+    """cProfile of the serving thread."""
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def totals(self, duration):
+        rows = []
+        for (filename, _, name), (_, calls, own, total, _) in pstats.Stats(self.profile).stats.items():
+            module = os.path.splitext(os.path.basename(filename))[0]
+            rows.append({'function': f"{module}:{name}", 'calls': calls,
+                         'self_s': own, 'total_s': total})
+        rows.sort(key=lambda r: r['total_s'], reverse=True)
+        return rows
+
+    def write(self, path):
+        self.profile.dump_stats(path)
+
+
+class Profiler:
+    def __init__(self):
+        self.directory = None
+        self.remaining = 0          # armed requests left in this worker
+        self._mode = 'sample'
+        self._path = None
+        self._busy = False          # one profile at a time per worker
+        self._lock = threading.Lock()
+        self._seq = itertools.count(1)
+
+    # --- arming ---
+
+    def arm(self, requests=1, mode='sample', path=None):
+        if mode not in MODES:
+            raise ValueError(f"mode must be one of {list(MODES)}")
+        if requests < 1:
+            raise ValueError("requests must be >= 1")
+        with self._lock:
+            self._mode, self._path, self.remaining = mode, path, int(requests)
+
+    def disarm(self):
+        with self._lock:
+            self.remaining = 0
+
+    def armed(self):
+        with self._lock:
+            if not self.remaining:
+                return None
+            return {'requests': self.remaining, 'mode': self._mode, 'path': self._path}
+
+    def take(self, scope, header_mode):
+        """Mode to profile this request with (None: don't), reserving the profiler."""
+        path = scope.get('path', '')
+        with self._lock:
+            if self._busy or path.startswith(API_PATH):
+                return None
+            mode = header_mode
+            if mode is None and self.remaining and (self._path is None or path.startswith(self._path)):
+                mode = self._mode
+                self.remaining -= 1
+            if mode is not None:
+                self._busy = True
+            return mode
+
+    def release(self):
+        with self._lock:
+            self._busy = False
+
+    # --- stored profiles ---
+
+    def new_id(self):
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        return f"{stamp}-{os.getpid()}-{next(self._seq)}"
+
+    def _file(self, profile_id, ext):
+        return entry_path(self.directory, profile_id, ext)
+
+    def save(self, profile_id, mode, run, request, duration):
+        os.makedirs(self.directory, exist_ok=True)
+        ext, _ = FILES[mode]
+        run.write(self._file(profile_id, ext))
+        functions = run.totals(duration)
+        write_json(self._file(profile_id, 'json'), {
+            **request,
+            'id': profile_id,
+            'mode': mode,
+            'created_at': time.time(),
+            'duration_s': duration,
+            'samples': sum(run.stacks.values()) if mode == 'sample' else None,
+            'grading': [f for f in functions if _is_grading(f['function'])],
+            'functions': functions[:TOP_FUNCTIONS],
+        })
+        remove_entries(self.directory, [old['id'] for old in self.profiles()[PROFILE_KEEP:]],
+                       ('json', 'folded', 'prof'))
+
+    def profiles(self):
+        """Stored profiles (without their function lists), newest first."""
+        entries = list_entries(self.directory, 'created_at')
+        for meta in entries:
+            meta.pop('functions', None)
+            meta.pop('grading', None)
+        return entries
+
+    def summary(self, profile_id):
+        """Stored summary of a profile (KeyError if there is none)."""
+        meta = read_json(self._file(profile_id, 'json'))
+        if meta is None:
+            raise KeyError(profile_id)
+        return meta
+
+    def profile_file(self, profile_id):
+        """(path, media type, file name) of the flamegraph / pstats file."""
+        mode = self.summary(profile_id)['mode']
+        ext, media_type = FILES[mode]
+        return self._file(profile_id, ext), media_type, f"{profile_id}.{ext}"
+
+
+profiler = Profiler()
+
+
+def _header_mode(scope):
+    """Mode requested by the X-Profile header, if any (and allowed)."""
+    value = token = None
+    for name, v in scope.get('headers', ()):
+        if name == _HEADER:
+            value = v.decode('latin-1').strip().lower()
+        elif name == _TOKEN_HEADER:
+            token = v.decode('latin-1')
+    if not value or value in ('0', 'off') or not authorized(token):
+        return None
+    return value if value in MODES else 'sample'
+
+
+class ProfilingMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        header_mode = _header_mode(scope)
+        if header_mode is None and not profiler.remaining:
+            return await self.app(scope, receive, send)
+        mode = profiler.take(scope, header_mode)
+        if mode is None:
+            return await self.app(scope, receive, send)
+
+        profile_id = profiler.new_id()
+        status = []
+
+        async def send_with_id(message):
+            if message['type'] == 'http.response.start':
+                status.append(message['status'])
+                message['headers'] = list(message.get('headers', [])) + [
+                    (b'x-profile-id', profile_id.encode())]
+            await send(message)
+
+        run = _Sampling(threading.get_ident()) if mode == 'sample' else _Deterministic()
+        start = time.perf_counter()
+        run.start()
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            run.stop()
+            duration = time.perf_counter() - start
+            try:
+                profiler.save(profile_id, mode, run, {
+                    'method': scope.get('method'),
+                    'path': scope.get('path'),
+                    'query': scope.get('query_string', b'').decode('latin-1'),
+                    'status': status[0] if status else None,
+                }, duration)
+            finally:
+                profiler.release()
+
+
+def install(app, directory):
+    """Add the profiling middleware; profiles are stored in `directory`."""
+    profiler.directory = directory
+    app.add_middleware(ProfilingMiddleware)
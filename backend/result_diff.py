@@ -0,0 +1,206 @@
+"""
+Grade changes between two result versions.
+
+Each saved result is reduced to a snapshot (许可证号, 所属区县, 新档位, 总分)
+kept by result_store.ResultHistory. Two snapshots are aligned with a hash
+join on encoded keys: one pd.factorize over both key columns gives shared
+integer codes, and a code -> row table of the base version maps every row
+of the other version to its base row (-1: new customer). The rest is
+masks and bincounts:
+  - transition matrix: matched customers, base grade x new grade (30x30),
+  - per-district movement counts (up / down / same / added / removed),
+  - the changed customers, largest moves first, paged like result_query.
+"""
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from .delta_ingest import KEY
+from .fast_json import column_values
+from .result_query import DEFAULT_LIMIT, MAX_LIMIT, decode_cursor, encode_cursor
+
+DISTRICT = '所属区县'
+GRADES = 30
+MOVEMENTS = ('up', 'down', 'added', 'removed')
+COLUMNS = [KEY, DISTRICT, 'movement', 'base_grade', 'grade', 'delta', 'base_score', 'score']
+MAX_DIFFS = 8
+
+
+def _text(values):
+    """Values as str ('' for missing); 5.0 read back from Excel matches 5."""
+    s = pd.Series(values)
+    if s.dtype.kind in 'iub':
+        return s.astype(str).to_numpy(dtype=str)
+    missing = s.isna().to_numpy()
+    if s.dtype.kind == 'f':
+        text = np.where(missing, '', s.fillna(0).astype(np.int64).astype(str)).astype(object)
+        fractional = ~missing & (s.to_numpy() % 1 != 0)
+        text[fractional] = s[fractional].astype(str).to_numpy()
+        return text.astype(str)
+    text = s.map(lambda v: str(int(v)) if isinstance(v, (float, np.floating)) and float(v).is_integer() else str(v))
+    return np.where(missing, '', text.to_numpy(dtype=object)).astype(str)
+
+
+def snapshot(df):
+    """Columns of a graded frame needed to diff it, as plain arrays (.npz without pickle)."""
+    n = len(df)
+    return {
+        'key': _text(df[KEY]) if KEY in df.columns else np.full(n, ''),
+        'district': _text(df[DISTRICT]) if DISTRICT in df.columns else np.full(n, ''),
+        'grade': df['新档位_Num'].to_numpy(dtype=float),
+        'score': df['总分'].to_numpy(dtype=float) if '总分' in df.columns else np.full(n, np.nan),
+    }
+
+
+class GradeDiff:
+    def __init__(self, base, other, version):
+        """`base`, `other`: snapshots; version: identifies the pair in cursors."""
+        self.version = version
+        n_base = len(base['key'])
+
+        # Hash join: shared codes for both key columns, missing keys never match
+        keys = np.concatenate([base['key'], other['key']])
+        codes, _ = pd.factorize(keys)
+        codes[keys == ''] = -1
+        base_codes, other_codes = codes[:n_base], codes[n_base:]
+        table = np.full(codes.max(initial=-1) + 1, -1, dtype=np.int64)
+        ok = base_codes >= 0
+        table[base_codes[ok]] = np.flatnonzero(ok)
+        base_row = np.where(other_codes >= 0, table[np.maximum(other_codes, 0)], -1)
+
+        matched = base_row >= 0
+        hit = np.zeros(n_base, dtype=bool)
+        hit[base_row[matched]] = True
+        removed = np.flatnonzero(~hit)
+
+        grade = other['grade']
+        base_grade = np.full(len(grade), np.nan)
+        base_grade[matched] = base['grade'][base_row[matched]]
+        up = matched & (grade > base_grade)
+        down = matched & (grade < base_grade)
+        same = matched & ~up & ~down
+        added = ~matched
+
+        # 1. Transition matrix (rows: base grade 1-30, columns: new grade 1-30)
+        valid = matched & _is_grade(grade) & _is_grade(base_grade)
+        cells = (base_grade[valid].astype(np.int64) - 1) * GRADES + grade[valid].astype(np.int64) - 1
+        self.transition = np.bincount(cells, minlength=GRADES * GRADES).reshape(GRADES, GRADES)
+
+        # 2. Per district: other-version district, base district for removed customers
+        districts = np.concatenate([other['district'], base['district'][removed]])
+        d_codes, d_names = pd.factorize(districts)
+        n_other = len(grade)
+        self.district_names = d_names
+        self.district_counts = {
+            name: np.bincount(d_codes[np.flatnonzero(mask)], minlength=len(d_names))
+            for name, mask in (('up', up), ('down', down), ('same', same), ('added', added))
+        }
+        self.district_counts['removed'] = np.bincount(d_codes[n_other:], minlength=len(d_names))
+        self.counts = {
+            'base_rows': n_base, 'rows': n_other, 'matched': int(matched.sum()),
+            'up': int(up.sum()), 'down': int(down.sum()), 'same': int(same.sum()),
+            'added': int(added.sum()), 'removed': len(removed),
+        }
+
+        # 3. Changed customers: moves by size (stable: ties keep result order), then added, removed
+        moved = np.flatnonzero(up | down)
+        moved = moved[np.argsort(-np.abs(grade[moved] - base_grade[moved]), kind='stable')]
+        new_rows = np.flatnonzero(added)
+        rows = np.concatenate([moved, new_rows])
+        base_rows = np.concatenate([base_row[rows], removed])
+        movement = np.concatenate([
+            np.where(up[moved], 'up', 'down'), np.full(len(new_rows), 'added'),
+            np.full(len(removed), 'removed'),
+        ]).astype(object)
+
+        def pick(values, ids, fill):
+            out = np.full(len(ids), fill, dtype=values.dtype)
+            out[ids >= 0] = values[ids[ids >= 0]]
+            return out
+
+        other_rows = np.concatenate([rows, np.full(len(removed), -1)])
+        key = np.concatenate([other['key'][rows], base['key'][removed]])
+        district = districts[np.concatenate([rows, n_other + np.arange(len(removed))])]
+        self._changes = {
+            KEY: key,
+            DISTRICT: district,
+            'movement': movement,
+            'base_grade': pick(base['grade'], base_rows, np.nan),
+            'grade': pick(grade, other_rows, np.nan),
+            'base_score': pick(base['score'], base_rows, np.nan),
+            'score': pick(other['score'], other_rows, np.nan),
+        }
+        self._changes['delta'] = self._changes['grade'] - self._changes['base_grade']
+
+    def districts(self):
+        """Movement counts per district, sorted by district name."""
+        stats = []
+        lists = {name: counts.tolist() for name, counts in self.district_counts.items()}
+        for i, district in enumerate(self.district_names):
+            up, down, same = lists['up'][i], lists['down'][i], lists['same'][i]
+            stats.append({
+                'District': str(district),
+                'Total': up + down + same + lists['added'][i],
+                'Upgrades': up,
+                'Downgrades': down,
+                'Unchanged': same,
+                'Added': lists['added'][i],
+                'Removed': lists['removed'][i],
+            })
+        stats.sort(key=lambda x: x['District'])
+        return stats
+
+    def changes(self, cursor=None, limit=DEFAULT_LIMIT, district=None, movement=None):
+        """One page of the changed customers, columnar like result_query.query."""
+        limit = max(1, min(int(limit), MAX_LIMIT))
+        view = (tuple(sorted(set(str(d) for d in district or ()))), tuple(sorted(set(movement or ()))))
+        offset = decode_cursor(cursor, self.version, view) if cursor else 0
+        mask = None
+        if district:
+            mask = np.isin(self._changes[DISTRICT], [str(d) for d in district])
+        if movement:
+            bad = [m for m in movement if m not in MOVEMENTS]
+            if bad:
+                raise ValueError(f"Unknown movement {bad}, expected one of {list(MOVEMENTS)}")
+            m = np.isin(self._changes['movement'], list(movement))
+            mask = m if mask is None else (mask & m)
+        rows = np.arange(len(self._changes[KEY])) if mask is None else np.flatnonzero(mask)
+
+        ids = rows[offset:offset + limit]
+        end = offset + limit
+        return {
+            'total': int(len(rows)),
+            'columns': list(COLUMNS),
+            'data': [column_values(self._changes[c][ids]) for c in COLUMNS],
+            'next_cursor': encode_cursor(self.version, end, view) if end < len(rows) else None,
+        }
+
+
+def _is_grade(values):
+    return (values >= 1) & (values <= GRADES) & (values % 1 == 0)
+
+
+class DiffCache:
+    """LRU of GradeDiff per (base, other) version pair; versions never change."""
+
+    def __init__(self, max_entries=MAX_DIFFS):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, base_version, other_version, load):
+        """GradeDiff of the two versions; `load(version)` returns a snapshot."""
+        key = (base_version, other_version)
+        with self._lock:
+            diff = self._entries.get(key)
+            if diff is not None:
+                self._entries.move_to_end(key)
+                return diff
+        diff = GradeDiff(load(base_version), load(other_version), f"{base_version}:{other_version}")
+        with self._lock:
+            self._entries[key] = diff
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return diff
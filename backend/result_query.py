@@ -0,0 +1,240 @@
+"""
+Paginated browsing of a graded result.
+
+A ResultIndex is built once per result version and holds:
+  - one stable sort order per column (built lazily on first use),
+  - posting lists (value -> row ids) for the filterable columns,
+  - a small LRU of materialized views (sort + filters -> row ids).
+The first page of a new view costs O(n); every following page is a slice
+of the cached view, i.e. O(page size).
+"""
+import base64
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from .fast_json import column_values
+
+# Query parameter -> result column
+FILTER_COLUMNS = {
+    'district': '所属区县',
+    'route': '营销线路',
+    'grade': '新档位_Num',
+}
+MOVEMENTS = ('up', 'down', 'same')
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+MAX_VIEWS = 32
+
+
+class CursorError(ValueError):
+    """Cursor is malformed or belongs to another view (sort, order, filters)."""
+
+
+class CursorExpired(CursorError):
+    """Cursor belongs to an earlier result version."""
+
+
+def _view_hash(view):
+    """Short digest of a normalized (sort, order, filters) tuple."""
+    return hashlib.sha1(repr(view).encode()).hexdigest()[:10]
+
+
+def encode_cursor(version, offset, view=()):
+    raw = f"{version}:{_view_hash(view)}:{offset}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor, version, view=()):
+    """Offset of `cursor`, which must come from a page of the same version and view."""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        cur_version, digest, offset = base64.urlsafe_b64decode(padded).decode().rsplit(':', 2)
+        offset = int(offset)
+    except Exception:
+        raise CursorError("Invalid cursor")
+    if offset < 0:
+        raise CursorError("Invalid cursor")
+    if cur_version != version:
+        raise CursorExpired("Cursor expired: the result has changed, restart from the first page")
+    if digest != _view_hash(view):
+        raise CursorError("Cursor belongs to another sort or filter, restart from the first page")
+    return offset
+
+
+def _sort_codes(values):
+    """Dense integer codes preserving value order; nulls get -1."""
+    s = pd.Series(values)
+    if s.dtype == object:
+        # Mixed str/int columns (e.g. 许可证号) are ordered as text
+        s = s.where(s.isna(), s.astype(str))
+    codes, _ = pd.factorize(s, sort=True)
+    return codes
+
+
+def _filter_key(value):
+    """Filter values arrive as strings; 5.0 read back from Excel must match '5'."""
+    if isinstance(value, (float, np.floating)) and float(value).is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class ResultIndex:
+    def __init__(self, df, version):
+        self.version = version
+        self.columns = list(df.columns)
+        self.n = len(df)
+        self._arrays = {c: df[c].to_numpy() for c in self.columns}
+        self._lock = threading.Lock()
+        self._orders = {}
+        self._postings = {}
+        self._views = OrderedDict()
+
+        if '新档位_Num' in df.columns and '原档位_Num' in df.columns:
+            new = df['新档位_Num'].to_numpy()
+            old = df['原档位_Num'].to_numpy()
+            self._movement = {
+                'up': np.flatnonzero(new > old),
+                'down': np.flatnonzero(new < old),
+                'same': np.flatnonzero(new == old),
+            }
+        else:
+            self._movement = None
+
+    # --- precomputed structures ---
+
+    def _order(self, column, descending):
+        """Stable row order for `column`; nulls always sort last."""
+        key = (column, descending)
+        order = self._orders.get(key)
+        if order is None:
+            codes = _sort_codes(self._arrays[column])
+            null = codes < 0
+            if descending:
+                codes = codes.max(initial=0) - codes
+            codes = np.where(null, np.iinfo(np.int64).max, codes)
+            order = np.argsort(codes, kind='stable')
+            self._orders[key] = order
+        return order
+
+    def _posting(self, column):
+        """{value: row ids} for a filterable column. Keys are compared as str."""
+        posting = self._postings.get(column)
+        if posting is None:
+            codes, uniques = pd.factorize(pd.Series(self._arrays[column]))
+            order = np.argsort(codes, kind='stable')
+            bounds = np.searchsorted(codes[order], np.arange(len(uniques) + 1))
+            posting = {}
+            for i, value in enumerate(uniques):
+                posting[_filter_key(value)] = order[bounds[i]:bounds[i + 1]]
+            self._postings[column] = posting
+        return posting
+
+    def _mask(self, filters):
+        mask = None
+        for name, wanted in filters:
+            if name == 'movement':
+                if self._movement is None:
+                    raise KeyError("movement")
+                rows = [self._movement[m] for m in wanted]
+            else:
+                column = FILTER_COLUMNS[name]
+                if column not in self._arrays:
+                    raise KeyError(column)
+                posting = self._posting(column)
+                rows = [posting[v] for v in wanted if v in posting]
+            m = np.zeros(self.n, dtype=bool)
+            for r in rows:
+                m[r] = True
+            mask = m if mask is None else (mask & m)
+        return mask
+
+    def view(self, sort=None, descending=False, filters=()):
+        """Row ids of the filtered, sorted view (cached per query shape)."""
+        key = (sort, descending, filters)
+        with self._lock:
+            rows = self._views.get(key)
+            if rows is not None:
+                self._views.move_to_end(key)
+                return rows
+
+            if sort is None:
+                rows = np.arange(self.n)
+                if descending:
+                    rows = rows[::-1]
+            else:
+                rows = self._order(sort, descending)
+            mask = self._mask(filters)
+            if mask is not None:
+                rows = rows[mask[rows]]
+
+            self._views[key] = rows
+            if len(self._views) > MAX_VIEWS:
+                self._views.popitem(last=False)
+            return rows
+
+    # --- page extraction ---
+
+    def page(self, rows, offset, limit, columns):
+        """Columnar page: one value list per column for rows[offset:offset+limit]."""
+        ids = rows[offset:offset + limit]
+        return [column_values(self._arrays[c][ids]) for c in columns]
+
+
+def normalize_filters(district=None, route=None, grade=None, movement=None):
+    """Canonical (hashable, order-independent) filter tuple for view caching."""
+    filters = []
+    for name, values in (('district', district), ('route', route),
+                         ('grade', grade), ('movement', movement)):
+        if not values:
+            continue
+        if name == 'movement':
+            bad = [v for v in values if v not in MOVEMENTS]
+            if bad:
+                raise ValueError(f"Unknown movement {bad}, expected one of {list(MOVEMENTS)}")
+        elif name == 'grade':
+            try:
+                values = [str(int(v)) for v in values]
+            except ValueError:
+                raise ValueError("grade must be an integer 1-30")
+        filters.append((name, tuple(sorted(set(str(v) for v in values)))))
+    return tuple(filters)
+
+
+def query(index, sort=None, order='asc', cursor=None, limit=DEFAULT_LIMIT,
+          columns=None, filters=()):
+    """Run one page query against a ResultIndex; returns a JSON-ready dict."""
+    if sort is not None and sort not in index.columns:
+        raise ValueError(f"Unknown sort column: {sort}")
+    if order not in ('asc', 'desc'):
+        raise ValueError("order must be 'asc' or 'desc'")
+    if columns:
+        unknown = [c for c in columns if c not in index.columns]
+        if unknown:
+            raise ValueError(f"Unknown columns: {unknown}")
+    else:
+        columns = index.columns
+    limit = max(1, min(int(limit), MAX_LIMIT))
+
+    # Offsets only mean something in the view they were taken from
+    view = (sort, order, filters)
+    offset = decode_cursor(cursor, index.version, view) if cursor else 0
+    try:
+        rows = index.view(sort, order == 'desc', filters)
+    except KeyError as e:
+        raise ValueError(f"Result has no column for filter {e}")
+
+    end = offset + limit
+    return {
+        'version': index.version,
+        'total': int(len(rows)),
+        'sort': sort,
+        'order': order,
+        'columns': list(columns),
+        'data': index.page(rows, offset, limit, columns),
+        'next_cursor': encode_cursor(index.version, end, view) if end < len(rows) else None,
+    }
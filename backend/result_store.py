@@ -0,0 +1,209 @@
+"""
+Process-local cache of the DataFrames the API persists to disk
+(uploaded data, graded result).
+
+Every uvicorn worker keeps its own copy. The file signature (mtime + size)
+is used as the dataset version, so a worker reloads as soon as another
+worker writes a new file, and anything derived from a frame (sort orders,
+indexes, ...) is dropped together with it.
+"""
+import contextlib
+import os
+import json
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from .fast_json import dumps
+from .instrumentation import span
+
+# Saved result versions kept by ResultHistory
+HISTORY_KEEP = int(os.environ.get("GRADING_RESULT_HISTORY", 20))
+# Snapshots kept in memory per worker
+HISTORY_CACHE = 4
+
+
+def file_version(path):
+    """Version string of the file at `path` (raises FileNotFoundError)."""
+    st = os.stat(path)
+    return f"{st.st_mtime_ns:x}-{st.st_size:x}"
+
+
+def read_json(path):
+    """Parsed JSON file at `path`, or None if there is none."""
+    try:
+        with open(path, 'rb') as f:
+            return json.loads(f.read())
+    except FileNotFoundError:
+        return None
+
+
+def write_json(path, payload):
+    """Write `payload` as JSON, atomically (other workers may be reading it)."""
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(dumps(payload))
+    os.replace(tmp, path)
+
+
+class FrameCache:
+    def __init__(self, path, name="frame", loader=None, writer=None):
+        self.path = path
+        self.name = name
+        self._loader = loader or pd.read_excel
+        self._writer = writer or (lambda df, p: df.to_excel(p, index=False))
+        self._lock = threading.RLock()
+        self._version = None
+        self._df = None
+        self._derived = {}
+        self._listeners = []
+
+    def on_change(self, callback):
+        """Call `callback(version)` whenever a new frame is loaded or saved."""
+        self._listeners.append(callback)
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def get(self):
+        """
+        Return (version, df) for the current file.
+        The DataFrame is shared: callers must copy before mutating it.
+        """
+        version = file_version(self.path)
+        with self._lock:
+            if version != self._version:
+                with span(f"{self.name}_load"):
+                    df = self._loader(self.path)
+                self._set(version, df)
+            return self._version, self._df
+
+    def save(self, df, derived=None):
+        """
+        Persist `df` and make it the cached frame without re-reading it.
+        `derived`: {key: value} already known for the new frame (see derived()).
+        """
+        with self._lock:
+            # Write next to the file and swap it in: other workers may be reading it
+            root, ext = os.path.splitext(self.path)
+            tmp = f"{root}.{os.getpid()}.tmp{ext}"
+            with span(f"{self.name}_save"):
+                self._writer(df, tmp)
+            os.replace(tmp, self.path)
+            self._set(file_version(self.path), df)
+            for key, value in (derived or {}).items():
+                self._derived[key] = (self._version, value)
+            return self._version
+
+    def derived(self, key, build):
+        """
+        Memoize `build(df, version)` for the current version.
+        Entries are discarded whenever the frame changes.
+        """
+        version, df = self.get()
+        with self._lock:
+            entry = self._derived.get(key)
+            if entry is None or entry[0] != version:
+                entry = (version, build(df, version))
+                self._derived[key] = entry
+            return entry[1]
+
+    def _set(self, version, df):
+        self._version = version
+        self._df = df
+        self._derived = {}
+        for callback in self._listeners:
+            callback(version)
+
+
+def entry_path(directory, entry_id, ext):
+    """
+    File `<entry_id>.<ext>` of a directory of stored entries (KeyError for
+    ids that are empty, hidden or contain a path).
+    """
+    # Ids come from URLs and query strings: never let one leave the directory
+    if not entry_id or os.path.basename(entry_id) != entry_id or entry_id.startswith("."):
+        raise KeyError(entry_id)
+    return os.path.join(directory, f"{entry_id}.{ext}")
+
+
+def list_entries(directory, newest_key):
+    """Metadata of the entries in `directory` (their .json files), newest first."""
+    if directory is None or not os.path.isdir(directory):
+        return []
+    entries = []
+    for name in os.listdir(directory):
+        if name.endswith(".json") and ".tmp" not in name:
+            meta = read_json(os.path.join(directory, name))
+            if meta is not None:
+                entries.append(meta)
+    return sorted(entries, key=lambda m: m[newest_key], reverse=True)
+
+
+def remove_entries(directory, entry_ids, exts):
+    """Delete the files of `entry_ids` (those that exist)."""
+    for entry_id in entry_ids:
+        for ext in exts:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(entry_path(directory, entry_id, ext))
+
+
+class ResultHistory:
+    """
+    Compact snapshots of saved results ({name: array}, e.g. key, district,
+    grades), one .npz + .json per result version, so versions can still be
+    compared after the current result has been replaced. Keeps the newest
+    `keep` versions. Snapshots never change once written, so loaded ones
+    are cached without version checks.
+    """
+
+    def __init__(self, directory, keep=HISTORY_KEEP):
+        self.directory = directory
+        self.keep = keep
+        self._lock = threading.Lock()
+        self._loaded = OrderedDict()
+
+    def _path(self, version, ext):
+        return entry_path(self.directory, version, ext)
+
+    def record(self, version, arrays, **meta):
+        """Store the snapshot of result `version`; `meta` is listed by versions()."""
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = self._path(f"{version}.{os.getpid()}.tmp", "npz")
+        with span("history_save"):
+            np.savez_compressed(tmp, **arrays)
+            os.replace(tmp, self._path(version, "npz"))
+        n = len(next(iter(arrays.values()))) if arrays else 0
+        write_json(self._path(version, "json"),
+                   {"version": version, "saved_at": time.time(), "rows": n, **meta})
+        remove_entries(self.directory, [old["version"] for old in self.versions()[self.keep:]],
+                       ("npz", "json"))
+
+    def versions(self):
+        """Metadata of the stored versions, newest first."""
+        return list_entries(self.directory, "saved_at")
+
+    def meta(self, version):
+        return read_json(self._path(version, "json"))
+
+    def load(self, version):
+        """{name: array} of `version` (KeyError if it isn't stored)."""
+        path = self._path(version, "npz")
+        with self._lock:
+            arrays = self._loaded.get(version)
+            if arrays is not None:
+                self._loaded.move_to_end(version)
+                return arrays
+        try:
+            with span("history_load"), np.load(path) as npz:
+                arrays = {name: npz[name] for name in npz.files}
+        except FileNotFoundError:
+            raise KeyError(version)
+        with self._lock:
+            self._loaded[version] = arrays
+            if len(self._loaded) > HISTORY_CACHE:
+                self._loaded.popitem(last=False)
+        return arrays
@@ -0,0 +1,224 @@
+"""
+大规则 / 小规则 evaluation, shared by the optimizer, the grading endpoints
+and the export.
+
+Everything is computed from per-grade arrays: cut_search passes the counts
+it already has to count_rules; a graded frame is reduced once by
+grade_stats (counts, up/down per grade, score ranges, purchase amount
+moments) and evaluate() / summary_table() / rules_table() work from that.
+The stats are small (a few arrays of 31) and JSON-ready, so they are
+stored next to each saved result and the export reuses them.
+"""
+import numpy as np
+import pandas as pd
+
+from .grading_utils import NORMAL_WEIGHTS, num_to_cn
+
+# (name, first grade, last grade, target share of all customers)
+BIG_RULES = [
+    ('大规则A', 26, 30, 0.09),
+    ('大规则B', 21, 25, 0.18),
+    ('大规则C', 16, 20, 0.23),
+    ('大规则D', 11, 15, 0.23),
+    ('大规则E', 1, 10, 0.27),
+]
+BIG_RULE_TOLERANCE = 0.001
+MIN_GRADE_SHARE = 0.01       # Small Rule A (soft)
+CORR_TARGET = 0.8            # Small Rule E
+CHANGE_RATE_LIMIT = 0.05     # Small Rule D (reported only)
+
+GRADES = 31  # index = grade, 0 unused
+
+
+def big_rule_shares(counts, total):
+    return [counts[start:end + 1].sum() / total for _, start, end, _ in BIG_RULES]
+
+
+def count_rules(counts, total, n_up, n_down):
+    """
+    Rules that only need the customers per new grade (`counts[g]`,
+    g = 1..30) and the city-wide up/down counts.
+    """
+    actual_vector = counts[1:31]
+    present = actual_vector[actual_vector > 0]
+    min_pct = (present / total).min() if present.size else 0
+
+    # Big Rules (Percentages)
+    shares = big_rule_shares(counts, total)
+    rule_big = all((target - BIG_RULE_TOLERANCE) <= p <= (target + BIG_RULE_TOLERANCE)
+                   for p, (_, _, _, target) in zip(shares, BIG_RULES))
+    # Small Rule A: every grade used (hard), >= 1% each (soft)
+    rule_a_hard = present.size > 0
+    rule_a_pass = min_pct >= MIN_GRADE_SHARE
+    # Small Rule B: Upgrade >= Downgrade (CITY WIDE)
+    rule_b_pass = n_up >= n_down
+    # Small Rule E: correlation with the ideal normal shape
+    if np.std(actual_vector) > 0 and np.std(NORMAL_WEIGHTS) > 0:
+        corr = np.corrcoef(actual_vector, NORMAL_WEIGHTS)[0, 1]
+    else:
+        corr = 0
+    rule_e_pass = corr > CORR_TARGET
+
+    return {
+        'min_pct': min_pct, 'n_up': int(n_up), 'n_down': int(n_down),
+        'rule_b_pass': bool(rule_b_pass), 'rule_big': bool(rule_big),
+        'rule_a_hard': bool(rule_a_hard), 'rule_a_pass': bool(rule_a_pass),
+        'rule_e_pass': bool(rule_e_pass),
+        'mandatory_pass': bool(rule_big and rule_b_pass and rule_a_hard),
+        'corr': corr,
+    }
+
+
+def _by_grade(grades, values=None):
+    ok = (grades >= 0) & (grades < GRADES)
+    weights = None if values is None else values[ok]
+    return np.bincount(grades[ok], weights=weights, minlength=GRADES)[:GRADES]
+
+
+def _score_range(grades, scores):
+    """
+    Min / max 总分 per grade: 0 where a grade has no customers, NaN where
+    none of its customers has a score (NaN is stored as null in JSON).
+    """
+    s = pd.Series(scores).groupby(grades)
+    empty = _by_grade(grades) == 0
+    lo = s.min().reindex(range(GRADES)).to_numpy(copy=True)
+    hi = s.max().reindex(range(GRADES)).to_numpy(copy=True)
+    lo[empty] = 0
+    hi[empty] = 0
+    return lo, hi
+
+
+def _score(value):
+    return np.nan if value is None else value
+
+
+def grade_stats(df):
+    """Per-grade arrays of a graded frame ('新档位_Num', '原档位_Num', '总分', amount)."""
+    new = df['新档位_Num'].to_numpy().astype(np.int64)
+    old = df['原档位_Num'].to_numpy(dtype=float)
+    score = df['总分'].to_numpy(dtype=float)
+    amount = df['卷烟购进金额指标值'].to_numpy(dtype=float)
+
+    up = new > old
+    down = new < old
+    old_grades = np.where(np.isnan(old), -1, old).astype(np.int64)
+
+    # Small Rule C: per-grade variance of the purchase amount (two-pass, ddof=1)
+    valid = ~np.isnan(amount)
+    n_valid = _by_grade(new[valid])
+    amount_sum = _by_grade(new[valid], amount[valid])
+    mean = np.divide(amount_sum, n_valid, out=np.zeros(GRADES), where=n_valid > 0)
+    m2 = _by_grade(new[valid], (amount[valid] - mean[new[valid]]) ** 2)
+
+    new_min, new_max = _score_range(new, score)
+    old_min, old_max = _score_range(old_grades, score)
+    return {
+        'total': len(df),
+        'counts': _by_grade(new).tolist(),
+        'up': _by_grade(new[up]).tolist(),
+        'down': _by_grade(new[down]).tolist(),
+        'old_counts': _by_grade(old_grades).tolist(),
+        'new_min': new_min.tolist(), 'new_max': new_max.tolist(),
+        'old_min': old_min.tolist(), 'old_max': old_max.tolist(),
+        'amount_n': n_valid.tolist(), 'amount_m2': m2.tolist(),
+        # Small Rule D: weighted purchase index, old vs new grade
+        'weighted_old': float(np.nansum(old * amount)),
+        'weighted_new': float(np.nansum(new * amount)),
+    }
+
+
+def evaluate(stats):
+    """All rule metrics of a graded frame from its grade_stats."""
+    counts = np.asarray(stats['counts'])
+    metrics = count_rules(counts, stats['total'], sum(stats['up']), sum(stats['down']))
+
+    rows = np.asarray(counts)
+    n = np.asarray(stats['amount_n'], dtype=float)
+    m2 = np.asarray(stats['amount_m2'], dtype=float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        var = np.where(n > 1, m2 / (n - 1), np.nan)
+    # Grades with several customers but < 2 amounts have no variance (NaN), as in pandas
+    several = rows[1:] > 1
+    total_variance = var[1:][several].sum() if several.any() else 0
+
+    weighted_old, weighted_new = stats['weighted_old'], stats['weighted_new']
+    change_rate = (weighted_new - weighted_old) / weighted_old if weighted_old != 0 else 0
+
+    metrics.update({
+        'rule_d_pass': bool(-CHANGE_RATE_LIMIT <= change_rate <= CHANGE_RATE_LIMIT),
+        'change_rate': change_rate,
+        'total_variance': total_variance,
+        'min_count': int(rows[1:][rows[1:] > 0].min()) if (rows[1:] > 0).any() else 0,
+        'big_rule_shares': big_rule_shares(counts, stats['total']),
+    })
+    return metrics
+
+
+def rules_table(metrics):
+    """The 规则校验 sheet."""
+    rows = []
+    for (name, start, end, target), p in zip(BIG_RULES, metrics['big_rule_shares']):
+        passed = (target - BIG_RULE_TOLERANCE) <= p <= (target + BIG_RULE_TOLERANCE)
+        rows.append((f'{name}({start}-{end}档)', f'占比 {p:.2%} (目标{target:.0%}±0.1%)', passed))
+    rows += [
+        ('小规则A(强制)', f'最小档位人数 {metrics["min_count"]} (必须>0)', metrics['rule_a_hard']),
+        ('小规则A(优先)', f'最小档位占比 {metrics["min_pct"]:.2%} (建议>=1%)', metrics['rule_a_pass']),
+        ('小规则B(强制)', f'升档{metrics["n_up"]} vs 降档{metrics["n_down"]} (必须 升>=降)', metrics['rule_b_pass']),
+        ('小规则E(优先)', f'正态分布相关性 {metrics["corr"]:.4f} (目标>0.8, 全局或区间正态)', metrics['rule_e_pass']),
+        ('小规则C(参考)', f'总方差 {metrics["total_variance"]:.2f} (忽略)', True),
+        ('小规则D(参考)', f'指标变化率 {metrics["change_rate"]:.2%} (忽略)', True),
+    ]
+    return pd.DataFrame([{'规则': name, '内容': content, '是否满足': '是' if passed else '否'}
+                         for name, content, passed in rows])
+
+
+def grade_rows(stats):
+    """Per-grade arrays of `stats` for the summaries, grade 30 down to 1."""
+    g = np.arange(30, 0, -1)
+
+    def pick(name, score=False):
+        values = stats[name]
+        return np.array([_score(values[x]) if score else values[x] for x in g],
+                        dtype=float if score else np.int64)
+
+    return {
+        'grade': g,
+        'count': pick('counts'), 'old_count': pick('old_counts'),
+        'up': pick('up'), 'down': pick('down'),
+        'new_min': pick('new_min', True), 'new_max': pick('new_max', True),
+        'old_min': pick('old_min', True), 'old_max': pick('old_max', True),
+    }
+
+
+def summary_table(stats):
+    """The 汇总表 sheet: one row per new grade, 30 down to 1."""
+    total = stats['total']
+    r = grade_rows(stats)
+    rows = []
+    for i, g in enumerate(r['grade']):
+        count = int(r['count'][i])
+        old_count = int(r['old_count'][i])
+        n_up = int(r['up'][i])
+        n_down = int(r['down'][i])
+        rows.append({
+            '客户类别': num_to_cn(g),
+            '分档线': r['new_min'][i],
+            '分档前_结果最小值': r['old_min'][i],
+            '分档前_结果最大值': r['old_max'][i],
+            '分档前_客户数': old_count,
+            '分档前_实际占比': old_count / total if total > 0 else 0,
+            '分档后_结果最小值': r['new_min'][i],
+            '分档后_结果最大值': r['new_max'][i],
+            '分档后_客户数': count,
+            '分档后_实际占比': count / total if total > 0 else 0,
+            '升档人数': n_up,
+            '升档比例': n_up / count if count > 0 else 0,
+            '降档人数': n_down,
+            '降档比例': n_down / count if count > 0 else 0,
+        })
+    summary_df = pd.DataFrame(rows)
+    # The requirement example shows "9.10%": keep them as strings
+    for col in ['分档前_实际占比', '分档后_实际占比', '升档比例', '降档比例']:
+        summary_df[col] = summary_df[col].apply(lambda x: f"{x:.2%}")
+    return summary_df
@@ -0,0 +1,26 @@
+import numpy as np
+
+from backend import cut_search
+
+
+def _candidate(score, layout, corr=0.9, n_up=10, n_down=10, min_pct=0.01):
+    metrics = {'corr': corr, 'n_up': n_up, 'n_down': n_down, 'min_pct': min_pct, 'mandatory_pass': True}
+    layout = np.array([[30, 0, layout], [29, layout, 100]], dtype=np.int64)
+    return cut_search.Candidate({'A': score}, score, metrics, layout)
+
+
+def test_top_candidates_have_distinct_layouts():
+    candidates = [_candidate(5, 40), _candidate(5, 40), _candidate(4, 40), _candidate(3, 41),
+                  _candidate(2, 42), _candidate(1, 43)]
+    top = cut_search.top_candidates(candidates, k=3)
+    assert [int(c.layout[0, 2]) for c in top] == [40, 41, 42]
+    assert top[0] is candidates[0]
+
+
+def test_candidate_set_merges_the_front_by_layout():
+    front = dict(corr=0.95, min_pct=0.05)
+    candidates = [_candidate(5, 40, corr=0.5), _candidate(4, 41, **front), _candidate(4, 41, **front),
+                  _candidate(1, 42, corr=0.99)]
+    chosen = cut_search.candidate_set(candidates, k=2)
+    assert [c['score'] for c in chosen] == [5, 4, 1]
+    assert [c['pareto'] for c in chosen] == [False, True, True]
@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from backend import delta_ingest, grading_utils
+from backend.benchmarks import synthetic
+
+
+@pytest.fixture
+def data():
+    df = synthetic.make_customers(3000, seed=7)
+    # a long run of equal amounts and missing amounts
+    df.loc[df.index[:40], '卷烟购进金额指标值'] = df['卷烟购进金额指标值'].iloc[500]
+    df.loc[df.index[40:45], '卷烟购进金额指标值'] = np.nan
+    return df
+
+
+def _apply(data, state, delta):
+    new_data, new_state, stats = state.upsert(data, delta)
+    pd.testing.assert_frame_equal(new_state.scored, grading_utils.calculate_metrics(new_data))
+    return new_data, new_state, stats
+
+
+def test_credit_edits_update_ranks_incrementally(data):
+    state = delta_ingest.ScoringState(grading_utils.calculate_metrics(data))
+    delta = data.loc[data.index[::300], ['许可证号', '信用等级指标值']].copy()
+    delta['信用等级指标值'] = 'D'
+    _, _, stats = _apply(data, state, delta)
+    assert stats['updated'] == len(delta)
+    assert stats['total_rank_changes'] == len(delta)
+    assert not stats['total_rank_rebuilt']
+
+
+def test_small_amount_edit_is_not_rebuilt(data):
+    state = delta_ingest.ScoringState(grading_utils.calculate_metrics(data))
+    delta = data.loc[data.index[[10, 2000]], ['许可证号', '卷烟购进金额指标值']].copy()
+    delta['卷烟购进金额指标值'] *= 1.01
+    _, _, stats = _apply(data, state, delta)
+    assert len(delta) < stats['total_rank_changes'] <= delta_ingest.REBUILD_FRACTION * len(data)
+    assert not stats['total_rank_rebuilt']
+
+
+def test_upsert_matches_calculate_metrics(data):
+    rng = np.random.default_rng(0)
+    state = delta_ingest.ScoringState(grading_utils.calculate_metrics(data))
+    tie = data['卷烟购进金额指标值'].iloc[500]
+    for step, k in enumerate([1, 30, 200, 5]):
+        delta = data.sample(k, random_state=step)[['许可证号', '卷烟购进金额指标值', '信用等级指标值']].copy()
+        amount = delta['卷烟购进金额指标值'] * rng.uniform(0.5, 1.5, k)
+        delta['卷烟购进金额指标值'] = np.where(rng.random(k) < 0.3, tie, amount)
+        if step == 2:
+            delta.iloc[:3, 1] = np.nan
+        if step == 3:
+            added = synthetic.make_customers(20, seed=100)
+            added['许可证号'] = added['许可证号'].astype(str) + 'N'
+            delta = pd.concat([delta, added])
+        data, state, stats = _apply(data, state, delta)
+    assert stats['added'] == 20
+    assert stats['rows'] == 3020
@@ -0,0 +1,23 @@
+from backend import memo
+from backend.fast_json import dumps
+
+
+def test_put_encodes_once_and_hits_serve_the_bytes():
+    cache = memo.MemoCache()
+    payload = {'summary': [{'Grade': 30, 'Count': 12}], 'rules': []}
+    body = cache.put('result', 'v1', (30, 95.0), payload)
+    assert body == dumps(payload)
+    assert cache.get('result', 'v1', (30, 95.0), encoded=True) is body
+    assert cache.get('result', 'v1', (30, 95.0)) is payload
+    assert cache.stats()['bytes'] == len(body)
+
+
+def test_bounded_by_encoded_size_and_version():
+    cache = memo.MemoCache(max_bytes=100)
+    for i in range(5):
+        cache.put('data', 'v1', i, {'values': 'x' * 30})
+    assert cache.stats()['bytes'] <= 100
+    assert cache.get('data', 'v1', 0) is None
+    assert cache.get('data', 'v1', 4) is not None
+    assert cache.get('data', 'v2', 4) is None
+    assert cache.stats()['bytes'] == 0
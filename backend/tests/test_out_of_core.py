@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from backend import grading_utils, out_of_core, rules
+from backend.benchmarks import synthetic
+
+METRICS = ['min_pct', 'n_up', 'n_down', 'rule_b_pass', 'rule_big', 'rule_d_pass', 'corr', 'shifts']
+
+
+def _customers(n, seed=3):
+    df = synthetic.make_customers(n, seed=seed)
+    # ties and missing purchase amounts
+    df.loc[df.index[:50], '卷烟购进金额指标值'] = df['卷烟购进金额指标值'].iloc[100]
+    df.loc[df.index[60:65], '卷烟购进金额指标值'] = np.nan
+    return df
+
+
+@pytest.mark.parametrize('chunk_rows', [700, 5000])
+def test_grade_file_matches_in_memory(tmp_path, chunk_rows):
+    path = tmp_path / 'in.csv'
+    _customers(3000).to_csv(path, index=False)
+    expected, metrics = grading_utils.optimize_grading(grading_utils.calculate_metrics(pd.read_csv(path)))
+    expected = pd.read_csv(pd.io.common.StringIO(expected.sort_index().to_csv(index=False)))
+
+    result = out_of_core.grade_file(str(path), str(tmp_path / 'out.csv'), chunk_rows=chunk_rows)
+
+    graded = pd.read_csv(tmp_path / 'out.csv')
+    pd.testing.assert_frame_equal(graded, expected, check_dtype=False)
+    # Same rules on the same data: optimizer metrics and rules.evaluate of the graded frame
+    evaluated = rules.evaluate(rules.grade_stats(graded))
+    for key in METRICS:
+        assert result[key] == metrics[key], key
+        if key != 'shifts':
+            assert result[key] == evaluated[key], key
+    for key in ('change_rate', 'total_variance'):
+        assert result[key] == pytest.approx(metrics[key], nan_ok=True), key
+        assert result[key] == pytest.approx(evaluated[key], nan_ok=True), key
+
+
+def test_order_and_rank_is_bounded_by_chunk_rows(tmp_path):
+    n, chunk_rows = 20_000, 1000
+    df = _customers(n)
+    rng = np.random.default_rng(0)
+    df.loc[rng.random(n) < 0.4, '卷烟购进金额指标值'] = np.nan
+    df.loc[df.index[1000:4000], '卷烟购进金额指标值'] = 1234.0  # one long tie run
+    path = tmp_path / 'in.csv'
+    df.to_csv(path, index=False)
+
+    ws = out_of_core.Workspace(str(tmp_path / 'work'))
+    _, rows, chunk_sizes = out_of_core.ingest(str(path), ws, chunk_rows)
+    out_of_core.purchase_scores(ws, rows, len(chunk_sizes), chunk_rows)
+    largest = out_of_core.order_and_rank(ws, rows, chunk_rows)
+    assert largest <= chunk_rows
+
+    expected = grading_utils.calculate_metrics(pd.read_csv(path))
+    np.testing.assert_array_equal(ws.column('total_rank', 'f8').open(), expected['总分排名'].to_numpy())
+    np.testing.assert_array_equal(ws.column('amount_rank', 'f8').open(),
+                                  expected['卷烟购进金额指标排名'].to_numpy())
+    order = expected.sort_values(['总分', '卷烟购进金额指标值'], ascending=False).index.to_numpy()
+    np.testing.assert_array_equal(ws.column('position', 'i8').open()[order], np.arange(n))
@@ -0,0 +1,44 @@
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from backend import profiling
+from backend.result_store import entry_path
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiling.profiler, 'directory', str(tmp_path))
+    app = FastAPI()
+    app.add_middleware(profiling.ProfilingMiddleware)
+
+    @app.get('/work')
+    def work():
+        return {'total': sum(range(100_000))}
+
+    return TestClient(app)
+
+
+def test_disabled_without_token(app, monkeypatch):
+    monkeypatch.setattr(profiling, 'TOKEN', None)
+    assert not profiling.enabled()
+    assert not profiling.authorized('anything')
+    r = app.get('/work', headers={'X-Profile': 'sample', 'X-Profile-Token': ''})
+    assert r.status_code == 200 and 'x-profile-id' not in r.headers
+    assert profiling.profiler.profiles() == []
+
+
+def test_header_needs_matching_token(app, monkeypatch):
+    monkeypatch.setattr(profiling, 'TOKEN', 'secret')
+    r = app.get('/work', headers={'X-Profile': 'cprofile', 'X-Profile-Token': 'nope'})
+    assert 'x-profile-id' not in r.headers
+    r = app.get('/work', headers={'X-Profile': 'cprofile', 'X-Profile-Token': 'secret'})
+    profile_id = r.headers['x-profile-id']
+    assert [p['id'] for p in profiling.profiler.profiles()] == [profile_id]
+    assert profiling.profiler.summary(profile_id)['path'] == '/work'
+
+
+@pytest.mark.parametrize('entry_id', ['', '.hidden', '../etc/passwd', 'a/b'])
+def test_entry_ids_stay_in_the_directory(tmp_path, entry_id):
+    with pytest.raises(KeyError):
+        entry_path(str(tmp_path), entry_id, 'json')
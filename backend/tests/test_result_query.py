@@ -0,0 +1,46 @@
+import pandas as pd
+import pytest
+
+from backend import result_query
+
+
+@pytest.fixture
+def index():
+    df = pd.DataFrame({
+        '许可证号': [f'L{i:03d}' for i in range(10)],
+        '所属区县': ['A', 'B'] * 5,
+        '总分': [float(i) for i in range(10)],
+        '新档位_Num': [1, 2, 3, 4, 5] * 2,
+        '原档位_Num': [2, 2, 2, 5, 5] * 2,
+    })
+    return result_query.ResultIndex(df, 'v1')
+
+
+def test_cursor_continues_its_own_view(index):
+    filters = result_query.normalize_filters(district=['A'])
+    first = result_query.query(index, sort='总分', order='desc', limit=2, filters=filters)
+    second = result_query.query(index, sort='总分', order='desc', cursor=first['next_cursor'],
+                                limit=2, filters=result_query.normalize_filters(district=['A']))
+    assert first['data'][2] + second['data'][2] == [8.0, 6.0, 4.0, 2.0]
+
+
+@pytest.mark.parametrize('change', [
+    {'sort': '许可证号'},
+    {'order': 'asc'},
+    {'filters': result_query.normalize_filters(district=['B'])},
+    {'filters': ()},
+])
+def test_cursor_from_another_view_is_rejected(index, change):
+    view = {'sort': '总分', 'order': 'desc', 'filters': result_query.normalize_filters(district=['A'])}
+    cursor = result_query.query(index, limit=2, **view)['next_cursor']
+    with pytest.raises(result_query.CursorError, match='another sort or filter'):
+        result_query.query(index, cursor=cursor, limit=2, **{**view, **change})
+
+
+def test_cursor_from_another_version_expires(index):
+    cursor = result_query.query(index, limit=2)['next_cursor']
+    index.version = 'v2'
+    with pytest.raises(result_query.CursorExpired):
+        result_query.query(index, cursor=cursor, limit=2)
+    with pytest.raises(result_query.CursorError, match='Invalid'):
+        result_query.query(index, cursor='not-a-cursor', limit=2)
@@ -0,0 +1,169 @@
+"""
+The rules module against the implementation it replaced (per-grade
+DataFrame filters in generate_export_data / variance_and_change_rate),
+kept here as the reference.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from backend import grading_utils, rules
+from backend.benchmarks import synthetic
+from backend.grading_utils import NORMAL_WEIGHTS, num_to_cn
+from backend.result_store import read_json, write_json
+
+
+def _previous_variance_and_change_rate(df):
+    total_variance = 0
+    for g in range(1, 31):
+        g_subset = df[df['新档位_Num'] == g]
+        if len(g_subset) > 1:
+            total_variance += g_subset['卷烟购进金额指标值'].var()
+    weighted_sum_old = (df['原档位_Num'] * df['卷烟购进金额指标值']).sum()
+    weighted_sum_new = (df['新档位_Num'] * df['卷烟购进金额指标值']).sum()
+    change_rate = (weighted_sum_new - weighted_sum_old) / weighted_sum_old if weighted_sum_old != 0 else 0
+    return total_variance, change_rate
+
+
+def _previous_summary(df):
+    total_cust = len(df)
+    old_stats = {}
+    for g in range(1, 31):
+        subset = df[df['原档位_Num'] == g]
+        if not subset.empty:
+            old_stats[g] = {'min': subset['总分'].min(), 'max': subset['总分'].max(),
+                            'count': len(subset), 'pct': len(subset) / total_cust}
+        else:
+            old_stats[g] = {'min': 0, 'max': 0, 'count': 0, 'pct': 0}
+    rows = []
+    for g in range(30, 0, -1):
+        subset = df[df['新档位_Num'] == g]
+        count = len(subset)
+        min_score = subset['总分'].min() if count > 0 else 0
+        max_score = subset['总分'].max() if count > 0 else 0
+        n_up = len(subset[subset['原档位_Num'] < g])
+        n_down = len(subset[subset['原档位_Num'] > g])
+        pre = old_stats[g]
+        rows.append({
+            '客户类别': num_to_cn(g), '分档线': min_score,
+            '分档前_结果最小值': pre['min'], '分档前_结果最大值': pre['max'],
+            '分档前_客户数': pre['count'], '分档前_实际占比': pre['pct'],
+            '分档后_结果最小值': min_score, '分档后_结果最大值': max_score,
+            '分档后_客户数': count, '分档后_实际占比': count / total_cust if total_cust > 0 else 0,
+            '升档人数': n_up, '升档比例': n_up / count if count > 0 else 0,
+            '降档人数': n_down, '降档比例': n_down / count if count > 0 else 0,
+        })
+    summary = pd.DataFrame(rows)
+    for col in ['分档前_实际占比', '分档后_实际占比', '升档比例', '降档比例']:
+        summary[col] = summary[col].apply(lambda x: f"{x:.2%}")
+    return summary
+
+
+def _previous_ui_summary(df):
+    new = df['新档位_Num'].to_numpy(dtype=np.int64)
+    old = df['原档位_Num'].to_numpy()
+    score = df['总分'].to_numpy(dtype=float)
+
+    def by_grade(grades):
+        grades = grades[(grades >= 1) & (grades <= 30)]
+        return np.bincount(grades.astype(np.int64), minlength=31)
+
+    count = by_grade(new)
+    up = by_grade(new[old < new])
+    down = by_grade(new[old > new])
+    in_range = (new >= 1) & (new <= 30)
+    min_score = np.full(31, np.inf)
+    max_score = np.full(31, -np.inf)
+    np.fmin.at(min_score, new[in_range], score[in_range])
+    np.fmax.at(max_score, new[in_range], score[in_range])
+    min_score[~np.isfinite(min_score)] = np.nan
+    max_score[~np.isfinite(max_score)] = np.nan
+    min_score[count == 0] = 0
+    max_score[count == 0] = 0
+    g = np.arange(30, 0, -1)
+    safe_count = np.maximum(count[g], 1)
+    return pd.DataFrame({
+        'Grade': g, 'GradeName': [num_to_cn(x) for x in g], 'Count': count[g],
+        'PreCount': by_grade(old)[g], 'Percentage': count[g] / len(df),
+        'Upgrades': up[g], 'Downgrades': down[g],
+        'UpgradeRate': up[g] / safe_count, 'DowngradeRate': down[g] / safe_count,
+        'MinScore': min_score[g], 'MaxScore': max_score[g],
+    })
+
+
+def _previous_metrics(df):
+    total_variance, change_rate = _previous_variance_and_change_rate(df)
+    counts = df['新档位_Num'].value_counts().sort_index()
+    actual = np.array([counts.get(i, 0) for i in range(1, 31)])
+    corr = np.corrcoef(actual, NORMAL_WEIGHTS)[0, 1] if np.std(actual) > 0 else 0
+    return {
+        'min_pct': df['新档位_Num'].value_counts(normalize=True).min(),
+        'min_count': df['新档位_Num'].value_counts().min(),
+        'n_up': int((df['新档位_Num'] > df['原档位_Num']).sum()),
+        'n_down': int((df['新档位_Num'] < df['原档位_Num']).sum()),
+        'corr': corr, 'total_variance': total_variance, 'change_rate': change_rate,
+    }
+
+
+def _previous_rules(df, m):
+    def pct(start, end):
+        return ((df['新档位_Num'] >= start) & (df['新档位_Num'] <= end)).sum() / len(df)
+
+    p = [pct(26, 30), pct(21, 25), pct(16, 20), pct(11, 15), pct(1, 10)]
+    rule_defs = [
+        ('大规则A(26-30档)', f'占比 {p[0]:.2%} (目标9%±0.1%)', 0.089 <= p[0] <= 0.091),
+        ('大规则B(21-25档)', f'占比 {p[1]:.2%} (目标18%±0.1%)', 0.179 <= p[1] <= 0.181),
+        ('大规则C(16-20档)', f'占比 {p[2]:.2%} (目标23%±0.1%)', 0.229 <= p[2] <= 0.231),
+        ('大规则D(11-15档)', f'占比 {p[3]:.2%} (目标23%±0.1%)', 0.229 <= p[3] <= 0.231),
+        ('大规则E(1-10档)', f'占比 {p[4]:.2%} (目标27%±0.1%)', 0.269 <= p[4] <= 0.271),
+        ('小规则A(强制)', f'最小档位人数 {m["min_count"]} (必须>0)', m['min_pct'] > 0),
+        ('小规则A(优先)', f'最小档位占比 {m["min_pct"]:.2%} (建议>=1%)', m['min_pct'] >= 0.01),
+        ('小规则B(强制)', f'升档{m["n_up"]} vs 降档{m["n_down"]} (必须 升>=降)', m['n_up'] >= m['n_down']),
+        ('小规则E(优先)', f'正态分布相关性 {m["corr"]:.4f} (目标>0.8, 全局或区间正态)', m['corr'] > 0.8),
+        ('小规则C(参考)', f'总方差 {m["total_variance"]:.2f} (忽略)', True),
+        ('小规则D(参考)', f'指标变化率 {m["change_rate"]:.2%} (忽略)', True),
+    ]
+    return pd.DataFrame([{'规则': name, '内容': content, '是否满足': '是' if passed else '否'}
+                         for name, content, passed in rule_defs])
+
+
+@pytest.fixture(params=[0, 1])
+def scored(request):
+    df = synthetic.make_customers(3000, seed=request.param)
+    # missing amounts: NaN 总分
+    df.loc[df.index[:30], '卷烟购进金额指标值'] = np.nan
+    return grading_utils.calculate_metrics(df)
+
+
+def _gradings(scored):
+    best, metrics = grading_utils.optimize_grading(scored)
+    yield best, metrics
+    yield grading_utils.assign_grades_by_thresholds(scored, {30: 95, 25: 90, 20: 80, 10: 60, 2: 40}), None
+    # a grade whose customers all have NaN 总分
+    only_nan = best.copy()
+    only_nan.loc[only_nan['新档位_Num'] == 1, '新档位_Num'] = 2
+    only_nan.loc[only_nan['总分'].isna(), '新档位_Num'] = 1
+    yield only_nan, None
+
+
+def test_export_and_metrics_match_previous_implementation(scored, tmp_path):
+    for graded, metrics in _gradings(scored):
+        previous = _previous_metrics(graded)
+        if metrics is not None:
+            for key in ('n_up', 'n_down', 'min_pct', 'corr', 'total_variance', 'change_rate'):
+                assert metrics[key] == pytest.approx(previous[key], rel=1e-9, nan_ok=True), key
+
+        _, summary, rules_sheet = grading_utils.generate_export_data(graded.copy())
+        pd.testing.assert_frame_equal(summary, _previous_summary(graded), check_dtype=False)
+        pd.testing.assert_frame_equal(rules_sheet, _previous_rules(graded, previous))
+
+        # stats saved with the result (NaN stored as null) give the same sheets
+        write_json(tmp_path / 'meta.json', rules.grade_stats(graded))
+        saved = read_json(tmp_path / 'meta.json')
+        _, saved_summary, saved_rules = grading_utils.generate_export_data(graded.copy(), saved)
+        pd.testing.assert_frame_equal(saved_summary, summary)
+        pd.testing.assert_frame_equal(saved_rules, rules_sheet)
+
+        # UI summary: from the frame before, from the (saved) stats now
+        pd.testing.assert_frame_equal(grading_utils.generate_summary(graded, saved), _previous_ui_summary(graded),
+                                      check_dtype=False)